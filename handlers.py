@@ -1,11 +1,237 @@
-from fastapi import FastAPI, Response, status, HTTPException, Header
+from fastapi import FastAPI, Request, Response, status, HTTPException, Header, Query
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import asyncio
 import datetime as dt
-from models import database, student, reservation
-from models.canteen import Canteen, CanteenCapacities, CanteenPut
+import json
+import logging
+import os
+import time
+from models import database, student, reservation, persistence, storage, sqlite_storage, logs, metrics, archive, commit_queue, idempotency, admission
+from models.canteen import Canteen, CanteenCapacities, CanteenPut, FreeSlot
 
 
-app = FastAPI()
-db = database.DB()
+# DB_BACKEND picks where the data is kept: "memory" (the default) or
+# "sqlite", in which case it goes into the file at DB_SQLITE_PATH.
+# every worker process has its own memory, so running several workers
+# (uvicorn takes the number from WEB_CONCURRENCY) needs the sqlite backend,
+# which all of them share
+def make_storage():
+    backend = os.environ.get("DB_BACKEND", "memory")
+    if backend == "memory":
+        if int(os.environ.get("WEB_CONCURRENCY", "1")) > 1:
+            raise ValueError(
+                "Workers can't share the memory backend, use DB_BACKEND=sqlite")
+        return storage.MemoryStorage()
+    if backend == "sqlite":
+        return sqlite_storage.SQLiteStorage(os.environ.get("DB_SQLITE_PATH", "canteens.db"))
+    raise ValueError("Unknown DB_BACKEND {}".format(backend))
+
+
+# LOG_LEVEL is the lowest level that gets logged and LOG_SAMPLE_RATE the
+# part (between 0 and 1) of the records below WARNING that are kept. the
+# records are written to stderr by a background thread, see logs.setup
+log_listener = logs.setup(
+    os.environ.get("LOG_LEVEL", "INFO"),
+    float(os.environ.get("LOG_SAMPLE_RATE", "1")))
+log = logs.get_logger("http")
+
+db = database.DB(make_storage())
+
+# if DB_DATA_DIR is set, the in memory db is kept on disk in that directory
+# and loaded from it on startup. see persistence.Persistence for the rest
+if os.environ.get("DB_DATA_DIR"):
+    if not isinstance(db.storage, storage.MemoryStorage):
+        raise ValueError("DB_DATA_DIR only works with DB_BACKEND=memory")
+    persistence.Persistence(
+        os.environ["DB_DATA_DIR"],
+        fsync_every=int(os.environ.get("DB_FSYNC_EVERY", "1")),
+        fsync_interval=float(os.environ.get("DB_FSYNC_INTERVAL", "0")),
+        snapshot_every=int(os.environ.get("DB_SNAPSHOT_EVERY", "100000")),
+    ).recover(db)
+
+# if ARCHIVE_PATH is set, reservations of past days are moved out of memory
+# into that file every ARCHIVE_INTERVAL seconds, see archive.archive_past_days
+archive_file = None
+if os.environ.get("ARCHIVE_PATH"):
+    if not isinstance(db.storage, storage.MemoryStorage):
+        raise ValueError("ARCHIVE_PATH only works with DB_BACKEND=memory")
+    archive_file = archive.ArchiveFile(os.environ["ARCHIVE_PATH"])
+
+# every POST /reservations goes through this single writer, which commits
+# the reservations of concurrent requests in groups, see commit_queue
+commits = commit_queue.CommitQueue(
+    db, int(os.environ.get("COMMIT_BATCH_SIZE", str(commit_queue.MAX_COMMIT_BATCH))))
+
+
+# responses of the POST requests sent with an Idempotency-Key header, kept
+# for IDEMPOTENCY_TTL seconds, see idempotency.IdempotencyStore
+idempotent = idempotency.IdempotencyStore(
+    int(os.environ.get("IDEMPOTENCY_MAX_KEYS", str(idempotency.DEFAULT_MAX_KEYS))),
+    float(os.environ.get("IDEMPOTENCY_TTL", str(idempotency.DEFAULT_TTL))))
+
+# limits on how much every client and every kind of request can ask for,
+# all off unless set, see admission.Admission
+admitter = admission.Admission(
+    client_rate=float(os.environ.get("ADMISSION_CLIENT_RATE", "0")),
+    client_burst=float(os.environ.get("ADMISSION_CLIENT_BURST", "0")),
+    class_rates=admission.parse_rates(os.environ.get("ADMISSION_CLASS_RATES", "")),
+    status_concurrency=int(os.environ.get("ADMISSION_STATUS_CONCURRENCY", "0")))
+
+
+async def archive_periodically(interval: float):
+    while True:
+        try:
+            await archive.archive_past_days(db, archive_file)
+        except Exception:
+            log.exception("Archiving past reservations failed")
+        await asyncio.sleep(interval)
+
+
+# fsyncs what's left of the log every 'interval' seconds, so the last
+# records before the app goes quiet don't wait for the next write
+async def sync_periodically(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            db.persistence.flush()
+        except Exception:
+            log.exception("Syncing the write-ahead log failed")
+
+
+metrics.REGISTRY.register(metrics.Gauge(
+    "canteens_db_size", "Number of things stored, by kind", ("kind",),
+    lambda: {(kind,): n for kind, n in db.storage.sizes().items()}))
+metrics.REGISTRY.register(metrics.Gauge(
+    "canteens_idempotency_keys", "Entries, hits, misses and evictions of the idempotency keys", ("stat",),
+    lambda: {(stat,): n for stat, n in idempotent.done.stats().items()}))
+metrics.REGISTRY.register(metrics.Gauge(
+    "canteens_status_cache", "Entries, hits, misses and evictions of the status cache", ("stat",),
+    lambda: {(stat,): n for stat, n in db.status_cache.stats().items()}))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    archiver = None
+    if archive_file is not None:
+        archiver = asyncio.create_task(archive_periodically(
+            float(os.environ.get("ARCHIVE_INTERVAL", "3600"))))
+    syncer = None
+    if db.persistence is not None and db.persistence.fsync_interval > 0:
+        syncer = asyncio.create_task(sync_periodically(db.persistence.fsync_interval))
+    yield
+    if syncer is not None:
+        syncer.cancel()
+        try:
+            await syncer
+        except asyncio.CancelledError:
+            pass
+    if archiver is not None:
+        archiver.cancel()
+        try:
+            await archiver
+        except asyncio.CancelledError:
+            pass
+        archive_file.close()
+    if db.persistence is not None:
+        db.persistence.close(db)
+    db.storage.close()
+    logs.shutdown(log_listener)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+# the client a request is made by: the studentId header or, for requests
+# made for a student without it (like POST /reservations), the studentId
+# in the body. requests of nobody in particular go by their address
+async def client_of(request: Request):
+    student_id = request.headers.get("studentId")
+    if student_id is None and request.method == "POST" and request.url.path.startswith("/reservations"):
+        try:
+            body = json.loads(await request.body())
+            if isinstance(body, dict):
+                student_id = body.get("studentId")
+        except ValueError:
+            pass
+    if student_id is not None:
+        return "student:{}".format(student_id)
+    return "address:{}".format(request.client.host if request.client else "")
+
+
+# turns requests over the limits of admitter away with a 429. added before
+# log_requests, so the requests it turns away are logged and measured too
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    if not admitter.enabled():
+        return await call_next(request)
+
+    kind = admission.route_class(request.method, request.url.path)
+    client = await client_of(request) if admitter.clients is not None else None
+    wait = admitter.admit(kind, client)
+    if wait:
+        return JSONResponse(
+            {"detail": "Too many requests"}, status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": admission.retry_after(wait)})
+    try:
+        response = await call_next(request)
+    except BaseException:
+        admitter.done(kind)
+        raise
+    # call_next returns once the headers are ready, while the body (like a
+    # status streamed as ndjson) may still be on its way
+    response.body_iterator = admitted_body(response.body_iterator, kind)
+    return response
+
+
+# the body of a response, ending the admission of its request once it's
+# all sent or the client went away
+async def admitted_body(body, kind: str):
+    try:
+        async for chunk in body:
+            yield chunk
+    finally:
+        admitter.done(kind)
+
+
+# logs how long every request took and adds it to the latency histogram
+# of its route. requests that matched no route are counted under the
+# route "unmatched", so random paths can't add any number of labels
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    metrics.REQUEST_SECONDS.observe(
+        time.perf_counter() - start, request.method,
+        route.path if route is not None else "unmatched", response.status_code)
+    logs.event(log, logging.INFO, "request",
+               method=request.method, path=request.url.path,
+               status=response.status_code, ms=logs.elapsed_ms(start))
+    return response
+
+
+# metrics of this process in the prometheus text format
+@app.get("/metrics", response_class=PlainTextResponse)
+async def handle_metrics():
+    return PlainTextResponse(
+        metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+# true if the If-None-Match header holds 'etag' (or is "*"). If-None-Match
+# compares etags the weak way, so a W/ in front of a tag is ignored
+def is_not_modified(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(headers: dict):
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
 
 
 @app.get("/")
@@ -13,11 +239,43 @@ async def home():
     return {"message": "Haiii"}
 
 
+# awaits 'store()' to store 'item' (a model) and returns the stored item.
+# with an Idempotency-Key, 'store' is only run by the first request with
+# that key (for that route), and its item is what every one of them gets
+async def store_once(route: str, key: str, item, store):
+    if key is None:
+        await store()
+        return item
+
+    async def action():
+        await store()
+        return item.model_dump(mode="json")
+
+    content = await idempotent.run((route, key), item.model_dump(mode="json"), action)
+    return JSONResponse(content, status_code=status.HTTP_201_CREATED)
+
+
 @app.post("/students", response_model=student.Student, status_code=status.HTTP_201_CREATED)
-async def handle_post_students(s: student.Student, response: Response):
-    try:
+async def handle_post_students(s: student.Student, response: Response, idempotency_key: str = Header(default=None)):
+    async def store():
         db.store_student(s)
-        return s
+
+    try:
+        return await store_once("students", idempotency_key, s, store)
+    except ValueError:
+        raise HTTPException(status_code=418, detail="Invalid input")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+# stores a student under the id it got in another shard, see router.py.
+# answers 201 if it was stored, 200 if it already was
+@app.put("/students/{id}", response_model=student.Student, status_code=status.HTTP_201_CREATED)
+async def handle_put_students(id: int, s: student.Student):
+    s.id = id
+    try:
+        created = db.copy_student(s)
+        return JSONResponse(s.model_dump(), status_code=201 if created else 200)
     except ValueError:
         raise HTTPException(status_code=418, detail="Invalid input")
     except Exception:
@@ -35,18 +293,64 @@ async def handle_get_students(id: int):
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@app.get("/students/{id}/reservations", response_model=reservation.ReservationPage, status_code=status.HTTP_200_OK)
+async def handle_get_student_reservations(
+    id: int,
+    status: str = None,
+    fromDate: dt.date = None,
+    toDate: dt.date = None,
+    cursor: str = None,
+    limit: int = 50
+):
+    try:
+        db.retrieve_student(id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    try:
+        rs, next_cursor = db.retrieve_student_reservations(
+            id, status, fromDate, toDate, cursor, limit)
+        return reservation.ReservationPage(reservations=rs, nextCursor=next_cursor)
+    except ValueError:
+        raise HTTPException(status_code=418, detail="Invalid input")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Server error")
+
+
 @app.get("/canteens/status", response_model=list[CanteenCapacities], status_code=status.HTTP_200_OK)
 async def handle_canteens_status(
     startDate: dt.date,
     endDate: dt.date,
     startTime: dt.time,
     endTime: dt.time,
-    duration: int
+    duration: int,
+    accept: str = Header(default=""),
+    if_none_match: str = Header(default=None)
 ):
     try:
+        # clients asking for ndjson get one line per canteen and day, sent as
+        # soon as it's computed, instead of one big list
+        ndjson = "application/x-ndjson" in accept
+        db.validate_status_query(duration)
+        etag = db.all_canteens_status_etag()
+        if ndjson:
+            etag = etag[:-1] + '-n"'
+        headers = {"ETag": etag, "Vary": "Accept"}
+        if is_not_modified(if_none_match, etag):
+            return not_modified(headers)
+
+        if ndjson:
+            lines = db.iter_all_canteens_cap_status(
+                startDate, endDate, startTime, endTime, duration)
+            return StreamingResponse(
+                (json.dumps(line, separators=(",", ":")) + "\n" for line in lines),
+                media_type="application/x-ndjson", headers=headers)
+
         r = db.get_all_canteens_cap_status(
             startDate, endDate, startTime, endTime, duration)
-        return r
+        # the status is already made of plain, serializable values, so skip
+        # validating it against the response model
+        return JSONResponse(r, headers=headers)
     except ValueError:
         raise HTTPException(status_code=418, detail="Invalid input")
     except Exception:
@@ -60,12 +364,37 @@ async def handle_canteens_status(
     endDate: dt.date,
     startTime: dt.time,
     endTime: dt.time,
-    duration: int
+    duration: int,
+    if_none_match: str = Header(default=None)
 ):
     try:
+        db.validate_status_query(duration, id)
+        etag = db.canteen_status_etag(id)
+        if is_not_modified(if_none_match, etag):
+            return not_modified({"ETag": etag})
         r = db.get_canteen_cap_status(
             id, startDate, endDate, startTime, endTime, duration)
-        return r
+        return JSONResponse(r, headers={"ETag": etag})
+    except ValueError:
+        raise HTTPException(status_code=418, detail="Invalid input")
+    except Exception:
+        raise HTTPException(status_code=500, detail="Server error")
+
+
+# the earliest times from 'from' (now by default) at which any canteen can
+# still take a reservation of 'duration' minutes for 'minSeats' people
+@app.get("/availability", response_model=list[FreeSlot], status_code=status.HTTP_200_OK)
+async def handle_availability(
+    duration: int,
+    minSeats: int = 1,
+    limit: int = 10,
+    days: int = 14,
+    start: dt.datetime = Query(default=None, alias="from")
+):
+    try:
+        r = db.find_free_slots(
+            start if start is not None else dt.datetime.now(), minSeats, duration, limit, days)
+        return JSONResponse(r)
     except ValueError:
         raise HTTPException(status_code=418, detail="Invalid input")
     except Exception:
@@ -84,15 +413,21 @@ async def handle_post_canteens(c: Canteen, response: Response, studentId: int =
 
 
 @app.get("/canteens", response_model=list[Canteen], status_code=status.HTTP_200_OK)
-async def handle_get_canteens():
-    return db.retrieve_all_canteens()
+async def handle_get_canteens(if_none_match: str = Header(default=None)):
+    etag = db.canteens_etag()
+    if is_not_modified(if_none_match, etag):
+        return not_modified({"ETag": etag})
+    return Response(db.retrieve_all_canteens_json(), media_type="application/json", headers={"ETag": etag})
 
 
 @app.get("/canteens/{id}", response_model=Canteen, status_code=status.HTTP_200_OK)
-async def handle_get_canteen(id: int):
+async def handle_get_canteen(id: int, if_none_match: str = Header(default=None)):
     try:
-        ct = db.retrieve_canteen(id)
-        return ct
+        body = db.retrieve_canteen_json(id)
+        etag = db.canteen_etag(id)
+        if is_not_modified(if_none_match, etag):
+            return not_modified({"ETag": etag})
+        return Response(body, media_type="application/json", headers={"ETag": etag})
     except ValueError:
         raise HTTPException(status_code=404, detail="Not found")
     except Exception:
@@ -102,7 +437,9 @@ async def handle_get_canteen(id: int):
 @app.put("/canteens/{id}", response_model=Canteen, status_code=status.HTTP_200_OK)
 async def handle_put_canteen(c_put: CanteenPut, id: int, response: Response, studentId: int = Header()):
     try:
-        existing = db.retrieve_canteen(id)
+        # work on a copy, so the stored canteen only changes once
+        # update_canteen has accepted the new version
+        existing = db.retrieve_canteen(id).model_copy(deep=True)
 
         if c_put.name is not None:
             existing.name = c_put.name
@@ -133,16 +470,26 @@ async def handle_delete_canteen(id: int, studentId: int = Header()):
 
 
 @app.post("/reservations", response_model=reservation.Reservation, status_code=status.HTTP_201_CREATED)
-async def handle_post_reservations(r: reservation.Reservation, response: Response):
+async def handle_post_reservations(r: reservation.Reservation, response: Response, idempotency_key: str = Header(default=None)):
     try:
-        db.store_reservation(r)
-        return r
+        return await store_once("reservations", idempotency_key, r, lambda: commits.submit(r))
     except ValueError:
         raise HTTPException(status_code=418, detail="Invalid input")
     except Exception:
         raise HTTPException(status_code=500, detail="Server error")
 
 
+@app.post("/reservations/batch", response_model=list[reservation.Reservation], status_code=status.HTTP_201_CREATED)
+async def handle_post_reservations_batch(rs: list[reservation.Reservation], response: Response):
+    try:
+        db.store_reservations(rs)
+        return rs
+    except ValueError as e:
+        raise HTTPException(status_code=418, detail=str(e))
+    except Exception:
+        raise HTTPException(status_code=500, detail="Server error")
+
+
 @app.delete("/reservations/{id}", response_model=reservation.Reservation, status_code=status.HTTP_200_OK)
 async def handle_delete_reservations(id: int, response: Response, studentId: int = Header()):
     try:
@@ -0,0 +1,188 @@
+import math
+import time
+from models import cache, metrics
+
+
+# admission control: requests over a limit are turned away right away with
+# a 429, instead of queueing up behind the work of whoever sent too many, so
+# one misbehaving client can't slow everybody else down.
+# requests are sorted into route classes, and are limited by
+#   - a token bucket per client (the studentId the request is made for, or
+#     its address) and route class
+#   - a token bucket per route class, shared by all clients
+#   - how many status queries can be running at once
+# every limit is off until it's given a value
+
+ROUTE_CLASSES = ("status", "write", "read")
+
+
+# status queries (including searching for free slots) are the expensive
+# reads, everything that isn't a GET changes something
+def route_class(method: str, path: str):
+    if method != "GET":
+        return "write"
+    if path.endswith("/status") or path == "/availability":
+        return "status"
+    return "read"
+
+
+# parses "status=5:10,write=50" into {"status": (5.0, 10.0), "write":
+# (50.0, 100.0)}: the rate (requests a second) and burst of every route
+# class. the burst is twice the rate if it's left out
+def parse_rates(text: str):
+    rates = {}
+    for part in filter(None, (p.strip() for p in text.split(","))):
+        name, _, value = part.partition("=")
+        name = name.strip()
+        if name not in ROUTE_CLASSES:
+            raise ValueError("Unknown route class {}".format(name))
+        rate, _, burst = value.partition(":")
+        rates[name] = (float(rate), float(burst) if burst else 2 * float(rate))
+    return rates
+
+
+# holds up to 'burst' tokens and gets 'rate' new ones every second. every
+# admitted request takes one
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, burst: float, now: float):
+        if rate <= 0 or burst < 1:
+            raise ValueError("A token bucket needs a positive rate and a burst of at least 1")
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    # takes a token and returns 0, or returns how many seconds it'll take
+    # until there is one
+    def take(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+# a token bucket for every key. the buckets are kept in a cache.LRUCache,
+# so clients making up keys can't fill the memory; a bucket thrown out
+# comes back full
+class KeyedBuckets:
+    name: str
+    rate: float
+    burst: float
+    buckets: cache.LRUCache
+    # requests turned away
+    shed: int
+
+    def __init__(self, name: str, rate: float, burst: float, max_keys: int = 100000):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.buckets = cache.LRUCache(max_keys)
+        self.shed = 0
+
+    def take(self, key, now: float):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, now)
+            self.buckets.put(key, bucket)
+        wait = bucket.take(now)
+        if wait:
+            self.shed += 1
+        return wait
+
+
+# at most 'limit' holders at once. doesn't wait: acquire fails when full
+class ConcurrencyLimit:
+    name: str
+    limit: int
+    active: int
+    # requests turned away
+    shed: int
+
+    def __init__(self, name: str, limit: int):
+        if limit < 1:
+            raise ValueError("A concurrency limit must be at least 1")
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.shed = 0
+
+    def acquire(self):
+        if self.active >= self.limit:
+            self.shed += 1
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+# the Retry-After header for having to wait 'wait' seconds
+def retry_after(wait: float):
+    return str(max(1, math.ceil(wait)))
+
+
+class Admission:
+    # per client and route class, None if off
+    clients: KeyedBuckets
+    # route class -> its bucket shared by all clients
+    classes: dict
+    # route class -> requests turned away by its bucket
+    class_shed: dict
+    # running status queries, None if off
+    status_queries: ConcurrencyLimit
+
+    def __init__(self, client_rate: float = 0, client_burst: float = 0, class_rates: dict = None,
+                 status_concurrency: int = 0, max_keys: int = 100000, clock=time.monotonic):
+        self.clock = clock
+        self.clients = None
+        if client_rate > 0:
+            self.clients = KeyedBuckets("client", client_rate, client_burst or 2 * client_rate, max_keys)
+        self.classes = {}
+        for name, (rate, burst) in (class_rates or {}).items():
+            self.classes[name] = TokenBucket(rate, burst, clock())
+        self.class_shed = {}
+        self.status_queries = None
+        if status_concurrency > 0:
+            self.status_queries = ConcurrencyLimit("status_concurrency", status_concurrency)
+
+    # false if every limit is off, so requests don't even have to be looked at
+    def enabled(self):
+        return self.clients is not None or bool(self.classes) or self.status_queries is not None
+
+    # returns 0 if a request of 'route_class' made by 'client' is let in,
+    # or how many seconds the client should wait before trying again. a
+    # status query that's let in must be ended with done()
+    def admit(self, route_class: str, client):
+        now = self.clock()
+        if self.clients is not None:
+            wait = self.clients.take((route_class, client), now)
+            if wait:
+                metrics.ADMISSION_SHED.inc("client", route_class)
+                return wait
+
+        bucket = self.classes.get(route_class)
+        if bucket is not None:
+            wait = bucket.take(now)
+            if wait:
+                self.class_shed[route_class] = self.class_shed.get(route_class, 0) + 1
+                metrics.ADMISSION_SHED.inc("route_class", route_class)
+                return wait
+
+        if route_class == "status" and self.status_queries is not None:
+            if not self.status_queries.acquire():
+                metrics.ADMISSION_SHED.inc("status_concurrency", route_class)
+                # no telling when one ends, they are short though
+                return 1.0
+        return 0.0
+
+    def done(self, route_class: str):
+        if route_class == "status" and self.status_queries is not None:
+            self.status_queries.release()
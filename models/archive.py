@@ -0,0 +1,78 @@
+import asyncio
+import datetime as dt
+import logging
+import os
+import struct
+import zlib
+from models import logs
+from models.persistence import RECORD_HEADER
+
+
+log = logs.get_logger("archive")
+
+# one archived reservation: id, canteen id, student id, day ordinal, start
+# minute, duration and status code (see records.STATUSES)
+ARCHIVE_ROW = struct.Struct("<IIIIHHB")
+
+
+# append-only file of archived reservations. every append is one record
+# framed like the write-ahead log's (length and crc32, then the packed
+# rows), so a record cut short by a crash is left out when reading.
+# a reservation can be in the file more than once (if it changed after it
+# was written but before it was dropped from memory), the last one is the
+# one that counts
+class ArchiveFile:
+    path: str
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "ab")
+
+    def append(self, rows: list):
+        payload = b"".join(ARCHIVE_ROW.pack(*row) for row in rows)
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+
+# yields every row in the archive at 'path', in the order they were written
+def read_archive(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if end > len(data) or zlib.crc32(data[start:end]) != crc:
+            return
+        yield from ARCHIVE_ROW.iter_unpack(data[start:end])
+        offset = end
+
+
+# moves every reservation that was over before 'today' (a day ordinal, the
+# current day by default) out of db and into 'archive', 'chunk' ids at a
+# time. the rows of a chunk are read on the event loop, written to the file
+# in a thread and then dropped from db, giving way to requests between
+# chunks, so handling them never waits for more than one chunk. a
+# reservation that changed while its chunk was being written is kept and
+# picked up by the next run. returns the number of reservations archived
+async def archive_past_days(db, archive: ArchiveFile, today: int = None, chunk: int = 10000):
+    before = today if today is not None else dt.date.today().toordinal()
+    archived = 0
+    for start in range(1, db.storage.get_next_reservation_id(), chunk):
+        rows = db.storage.ended_reservations(before, start, start + chunk)
+        if rows:
+            await asyncio.to_thread(archive.append, rows)
+            archived += len(db.archive_reservations(rows))
+        await asyncio.sleep(0)
+
+    logs.event(log, logging.INFO, "archived", before=dt.date.fromordinal(before), reservations=archived)
+    return archived
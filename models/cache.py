@@ -0,0 +1,99 @@
+import time
+from collections import OrderedDict
+
+
+# bounded key-value store that, once full, throws out the entry that
+# was used least recently. keeps count of hits, misses and evictions
+class LRUCache:
+    max_size: int
+    entries: OrderedDict
+    hits: int
+    misses: int
+    evictions: int
+
+    def __init__(self, max_size: int):
+        if max_size < 1:
+            raise ValueError("Cache size must be at least 1")
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self.entries.pop(key, default)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "maxSize": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+# LRUCache whose entries are only valid for one version of the data they
+# were computed from. an entry stored for an older version is treated as
+# a miss, so it can never be served after the data changed
+class VersionedLRUCache(LRUCache):
+    def get(self, key, version: int, default=None):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != version:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, version: int, value):
+        super().put(key, (version, value))
+
+
+# LRUCache whose entries expire 'ttl' seconds after they were put, as told
+# by 'clock'. an expired entry is treated as a miss and thrown out
+class TTLCache(LRUCache):
+    ttl: float
+
+    def __init__(self, max_size: int, ttl: float, clock=time.monotonic):
+        if ttl <= 0:
+            raise ValueError("Cache ttl must be positive")
+        super().__init__(max_size)
+        self.ttl = ttl
+        self.clock = clock
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= self.clock():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, value):
+        super().put(key, (self.clock() + self.ttl, value))
@@ -39,3 +39,15 @@ class CapacityResponse(BaseModel):
 class CanteenCapacities(BaseModel):
     canteenId: int
     slots: list[CapacityResponse]
+
+
+# a time a reservation can still be made at, see DB.find_free_slots
+class FreeSlot(BaseModel):
+    canteenId: int
+    date: date
+    startTime: time
+    remainingCapacity: int
+
+    @field_serializer("startTime")
+    def serialize_time(self, value: time):
+        return value.strftime("%H:%M")
@@ -0,0 +1,324 @@
+import array
+import bisect
+import datetime as dt
+
+
+# the day is split into slots of SLOT_MINUTES minutes, so every time-point
+# maps to an index into a per-day array of counters (and a bit of a per-day
+# bitmask). reservations start on a slot boundary and last a whole number
+# of slots
+SLOT_MINUTES = 15
+MINUTES_PER_DAY = 24 * 60
+SLOTS_PER_DAY = MINUTES_PER_DAY // SLOT_MINUTES
+
+
+def minute_of_day(t: dt.time):
+    return t.hour * 60 + t.minute
+
+
+def slot_index(t: dt.time):
+    return minute_of_day(t) // SLOT_MINUTES
+
+
+def slot_time(slot: int):
+    minutes = slot * SLOT_MINUTES
+    return dt.time(minutes // 60, minutes % 60)
+
+
+def is_slot_aligned(t: dt.time):
+    return t.minute % SLOT_MINUTES == 0 and t.second == 0 and t.microsecond == 0
+
+
+# returns a list where element i is the name of the meal a canteen serves at
+# minute i of the day, or "" if the canteen is closed at that time. when meals
+# overlap the one listed first wins, same as DB.getCanteenMealName used to do
+def meal_table(working_hours: list):
+    table = [""] * MINUTES_PER_DAY
+    for m in reversed(working_hours):
+        start = minute_of_day(m.from_)
+        end = minute_of_day(m.to)
+        if end > start:
+            table[start:end] = [m.meal] * (end - start)
+    return table
+
+
+# minutes of the day a reservation lasting 'duration' minutes can start at
+# so that it fits in one of the meals (see DB.isValidMealTime), sorted
+def meal_starts(working_hours: list, duration: int):
+    starts = set()
+    for m in working_hours:
+        first = minute_of_day(m.from_)
+        first += -first % SLOT_MINUTES
+        last = minute_of_day(m.to) - duration
+        starts.update(range(first, last + 1, SLOT_MINUTES))
+    return sorted(starts)
+
+
+# returns the (day_ordinal, slot) pairs a reservation starting at d, t and
+# lasting 'duration' minutes occupies. a reservation that runs past midnight
+# continues in the first slots of the next day
+def reservation_slots(d: dt.date, t: dt.time, duration: int):
+    return span_slots(d.toordinal(), minute_of_day(t), duration)
+
+
+# number of slots a reservation lasting 'duration' minutes takes up
+def slot_count(duration: int):
+    return max(1, -(-duration // SLOT_MINUTES))
+
+
+# same as reservation_slots, for a start given as a day ordinal and the
+# minute of that day
+def span_slots(day: int, minute: int, duration: int):
+    slot = minute // SLOT_MINUTES
+    res = []
+    for _ in range(slot_count(duration)):
+        res.append((day, slot))
+        slot += 1
+        if slot == SLOTS_PER_DAY:
+            day += 1
+            slot = 0
+    return res
+
+
+# bitmask with the bits of the slots from 'first' up to (but without) 'last'
+# set. bit i of a day's mask stands for slot i of that day
+def slot_mask(first: int, last: int):
+    return ((1 << (last - first)) - 1) << first
+
+
+# the slots of reservation_slots as (day_ordinal, mask) pairs, one for every
+# day the reservation touches, so checking a reservation against the slots
+# taken on a day is a single AND whatever its duration
+def reservation_masks(d: dt.date, t: dt.time, duration: int):
+    return span_masks(d.toordinal(), minute_of_day(t), duration)
+
+
+def span_masks(day: int, minute: int, duration: int):
+    first = minute // SLOT_MINUTES
+    last = first + slot_count(duration)
+    res = []
+    while last > SLOTS_PER_DAY:
+        res.append((day, slot_mask(first, SLOTS_PER_DAY)))
+        day += 1
+        first = 0
+        last -= SLOTS_PER_DAY
+    res.append((day, slot_mask(first, last)))
+    return res
+
+
+class CapacityStore:
+    # counters[canteen_id] is a dict where the key is the ordinal of a date
+    # (date.toordinal()) and the value is an array of SLOTS_PER_DAY unsigned
+    # ints. counters[canteen_id][day][slot] is how many people have reserved
+    # a spot in that slot. days nobody reserved anything for have no array
+    counters: dict
+    # the counters are copy-on-write per day: an array handed out before a
+    # freeze() is never changed again, the first change to a day after one
+    # puts a copy in its place. what was replaced is kept in 'undo', so the
+    # views returned by freeze() can still see the counters as they were
+    undo: "CounterUndo"
+
+    def __init__(self):
+        self.counters = {}
+        self.undo = CounterUndo()
+
+    # only the counters go into snapshots, nothing loaded from one is shared
+    def __getstate__(self):
+        return {"counters": self.counters}
+
+    def __setstate__(self, state: dict):
+        self.counters = state["counters"]
+        self.undo = CounterUndo()
+
+    def __contains__(self, ct_id: int):
+        return ct_id in self.counters
+
+    def init_canteen(self, ct_id: int):
+        self.replaceDays(ct_id)
+        self.counters[ct_id] = {}
+
+    def drop_canteen(self, ct_id: int):
+        self.replaceDays(ct_id)
+        self.counters.pop(ct_id, None)
+
+    # returns a FrozenCounters with the counters as they are now. it won't
+    # change anymore, whatever is done to the store afterwards
+    def freeze(self):
+        undo = CounterUndo()
+        self.undo.next = undo
+        self.undo = undo
+        return FrozenCounters(self.counters, undo)
+
+    # returns the counters of a canteen for a single day, or None if
+    # nobody has reserved anything in that canteen on that day
+    def day(self, ct_id: int, day: int):
+        return self.counters[ct_id].get(day)
+
+    # returns the dict of day ordinal -> counters of a canteen
+    def days(self, ct_id: int):
+        return self.counters.get(ct_id, {})
+
+    def get(self, ct_id: int, day: int, slot: int):
+        row = self.counters[ct_id].get(day)
+        if row is None:
+            return 0
+        return row[slot]
+
+    def add(self, ct_id: int, day: int, slot: int):
+        self.writableRow(ct_id, day)[slot] += 1
+
+    def remove(self, ct_id: int, day: int, slot: int):
+        row = self.counters[ct_id].get(day)
+        if row is None or row[slot] == 0:
+            raise ValueError(
+                "There are no reservations in canteen with id {} at {}|{}".format(
+                    ct_id, dt.date.fromordinal(day).isoformat(), slot_time(slot).strftime('%H:%M')))
+        self.writableRow(ct_id, day)[slot] -= 1
+
+    # remembers the day dict of a canteen before it's replaced or dropped,
+    # if it's the first one since the last freeze()
+    def replaceDays(self, ct_id: int):
+        if ct_id not in self.undo.canteens:
+            self.undo.canteens[ct_id] = self.counters.get(ct_id)
+
+    # the counters of a canteen for a day that can be changed, made if
+    # there are none yet. a day dict made since the last freeze() and the
+    # arrays copied since then are only in the store, so they're changed
+    # in place. anything else is remembered first and then copied
+    def writableRow(self, ct_id: int, day: int):
+        days = self.counters[ct_id]
+        row = days.get(day)
+        key = (ct_id, day)
+        if ct_id in self.undo.canteens or key in self.undo.rows:
+            if row is None:
+                row = days[day] = array.array("I", [0]) * SLOTS_PER_DAY
+            return row
+        self.undo.rows[key] = row
+        if row is None:
+            row = array.array("I", [0]) * SLOTS_PER_DAY
+        else:
+            row = array.array("I", row)
+        days[day] = row
+        return row
+
+
+# what the writes made between two freeze() calls of a CapacityStore
+# replaced: 'rows' maps (canteen id, day) to the array a day had before
+# its first change (None if it had none), 'canteens' maps a canteen id to
+# its day dict before it was replaced or dropped. 'next' is the undo of
+# the writes after the next freeze(), None until then
+class CounterUndo:
+    rows: dict
+    canteens: dict
+    next: "CounterUndo"
+
+    def __init__(self):
+        self.rows = {}
+        self.canteens = {}
+        self.next = None
+
+
+# the counters of a CapacityStore as they were at a freeze(). a day is read
+# from the store and then from the undos of every freeze() since, the first
+# one that replaced it holding what it was. the undo is filled in before
+# anything is replaced, so a read racing a write still finds the old value
+class FrozenCounters:
+    counters: dict
+    undo: CounterUndo
+
+    def __init__(self, counters: dict, undo: CounterUndo):
+        self.counters = counters
+        self.undo = undo
+
+    def day(self, ct_id: int, day: int):
+        days = self.counters.get(ct_id)
+        row = None if days is None else days.get(day)
+        undo = self.undo
+        key = (ct_id, day)
+        while undo is not None:
+            if key in undo.rows:
+                return undo.rows[key]
+            if ct_id in undo.canteens:
+                days = undo.canteens[ct_id]
+                return None if days is None else days.get(day)
+            undo = undo.next
+        return row
+
+    # the day ordinal -> counters of a canteen, only with a .get()
+    def days(self, ct_id: int):
+        return FrozenDays(self, ct_id)
+
+
+class FrozenDays:
+    frozen: FrozenCounters
+    ct_id: int
+
+    def __init__(self, frozen: FrozenCounters, ct_id: int):
+        self.frozen = frozen
+        self.ct_id = ct_id
+
+    def get(self, day: int, default=None):
+        row = self.frozen.day(self.ct_id, day)
+        return default if row is None else row
+
+
+# yields the remaining capacity of a canteen for every time-point from
+# startTime to endTime (in 'duration' minute steps), one list of slots per
+# day from startDate to endDate, skipping time-points where no meal is
+# served. the remaining capacity of a time-point is the smallest over the
+# 'duration' minutes from it (up to midnight), i.e. how many people could
+# still reserve that whole stretch. 'cap' is the capacity of the canteen,
+# 'meals' its meal_table and 'days' maps day ordinals to the canteen's
+# counter arrays (days without reservations can be left out). the
+# time-points are the same on every day, so which of them are open and
+# which slots they read is worked out once, and then every day is filled
+# in from its counter array
+def status_days(days, cap: int, meals: list, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
+    start = minute_of_day(startTime)
+    end = minute_of_day(endTime)
+    if endTime.second or endTime.microsecond:
+        end += 1
+    width = slot_count(duration)
+    points = [(m // SLOT_MINUTES, min(SLOTS_PER_DAY, m // SLOT_MINUTES + width),
+               meals[m], "%02d:%02d" % divmod(m, 60))
+              for m in range(start, end, duration) if meals[m]]
+    if not points:
+        return
+
+    for day in range(startDate.toordinal(), endDate.toordinal() + 1):
+        date_str = dt.date.fromordinal(day).isoformat()
+        row = days.get(day)
+        if row is None:
+            yield [{"date": date_str, "meal": meal, "startTime": time_str, "remainingCapacity": cap}
+                   for _, _, meal, time_str in points]
+        else:
+            yield [{"date": date_str, "meal": meal, "startTime": time_str, "remainingCapacity": cap - max(row[first:last])}
+                   for first, last, meal, time_str in points]
+
+
+# same as status_days, but with the slots of all days in one list
+def status(days, cap: int, meals: list, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
+    slots = []
+    for day_slots in status_days(days, cap, meals, startDate, endDate, startTime, endTime, duration):
+        slots.extend(day_slots)
+    return slots
+
+
+# yields (minute, remaining capacity) for every minute of 'starts' (see
+# meal_starts) from 'first_minute' on where a reservation of 'duration'
+# minutes on 'day' still leaves at least 'min_seats' free spots, in order.
+# 'days' and 'cap' are the same as for status_days. only the starts that are
+# asked for are looked at, so taking the first few is cheap
+def free_starts(days, cap: int, starts: list, day: int, first_minute: int, duration: int, min_seats: int):
+    if cap < min_seats:
+        return
+    row = days.get(day)
+    width = slot_count(duration)
+    for minute in starts[bisect.bisect_left(starts, first_minute):]:
+        if row is None:
+            yield minute, cap
+            continue
+        slot = minute // SLOT_MINUTES
+        remaining = cap - max(row[slot:slot + width])
+        if remaining >= min_seats:
+            yield minute, remaining
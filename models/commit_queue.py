@@ -0,0 +1,72 @@
+import asyncio
+import collections
+from models import database, metrics, reservation
+
+
+# the most reservations committed together
+MAX_COMMIT_BATCH = 256
+
+
+# hands the reservations of all requests to a single writer, which commits
+# whatever piled up while it was busy as one group (see
+# DB.commit_reservations): one transaction and one fsync of the write-ahead
+# log for the whole group, and every reservation checked against the ones
+# committed before it without any locking. the more requests come in at
+# once, the bigger the groups get, so a burst costs fewer commits.
+# the writer is a task started by the first submit that finds none running
+# on its event loop, and it stops once nothing is left to commit, so there
+# is nothing to start or stop with the app
+class CommitQueue:
+    db: database.DB
+    max_batch: int
+    # (reservation, future) waiting for the writer
+    pending: collections.deque
+    writer: asyncio.Task
+
+    def __init__(self, db: database.DB, max_batch: int = MAX_COMMIT_BATCH):
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.db = db
+        self.max_batch = max_batch
+        self.pending = collections.deque()
+        self.writer = None
+
+    # stores r once its group is committed, raising the ValueError it was
+    # turned down with. a request given up while waiting doesn't take its
+    # reservation back, it's committed anyway
+    async def submit(self, r: reservation.Reservation):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((r, future))
+        if self.writer is None or self.writer.done() or self.writer.get_loop() is not loop:
+            self.writer = loop.create_task(self.write())
+        await future
+
+    async def write(self):
+        # let the requests that are already running submit too
+        await asyncio.sleep(0)
+        while self.pending:
+            batch = []
+            while self.pending and len(batch) < self.max_batch:
+                batch.append(self.pending.popleft())
+            self.commit(batch)
+            # give way to requests between groups
+            await asyncio.sleep(0)
+
+    def commit(self, batch: list):
+        metrics.COMMIT_BATCH_SIZE.observe(len(batch))
+        try:
+            results = self.db.commit_reservations([r for r, _ in batch])
+        except Exception as e:
+            # commit_reservations returns what every turned down
+            # reservation failed with, so this is the group as a whole
+            # failing (like the log not syncing), and none of them can be
+            # said to be stored
+            results = [e] * len(batch)
+        for (_, future), error in zip(batch, results):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
@@ -1,70 +1,126 @@
+import contextlib
 import datetime as dt
-from models import student, canteen, reservation
+import heapq
+import json
+import logging
+from models import student, canteen, reservation, capacity, cache, persistence, storage, logs, metrics, records
 
 
-class DB:
-    # all created students: key is id: int, value is student class
-    students: dict
-    # all created canteens: key is id: int, value is canteen class
-    canteens: dict
-    # all created reservations: key is id: int, value is reservation class
-    reservations: dict
-    # holds num of reservations for each canteen. the key is the id of the canteen
-    # canteen_capacities[canteen_id] is another dict, where the key is the string
-    # representation of the date and time
-    # canteen_capacities[canteen_id][datetime_str] is how many people have reserved
-    # a spot
-    canteen_capacities: dict
-    # dict of lists. dist key is canteen_id, list elements are
-    # ids of the reservations
-    # used for easier deletion of the reservations once a canteen is deleted
-    canteen_reservations: dict
-    # keeps track of a students reservations. key is student_id
-    # value is another dict which has a key that is a string representation
-    # of the time and date 
-    # so if student_reservations[st_id][datetime_str] exists
-    # then the student has a reservation at that time-point
-    student_reservations: dict
-    # these keep track of ids so ids are unique
-    next_student_id: int
-    next_canteen_id: int
-    next_reservation_id: int
-
-    # keep track of data that needs to be unique
-    emails: set
-    canteen_locations: set
-    canteen_names: set
-
-    def __init__(self):
-        self.students = {}
-        self.canteens = {}
-        self.reservations = {}
-        self.canteen_capacities = {}
-        self.canteen_reservations = {}
-        self.student_reservations = {}
-        self.next_student_id = 1
-        self.next_canteen_id = 1
-        self.next_reservation_id = 1
-        self.emails = set()
-        self.canteen_locations = set()
-        self.canteen_names = set()
+log = logs.get_logger("db")
 
-    def store_student(self, s: student.Student):
-        if s.email in self.emails:
-            raise ValueError(
-                "User with email {} already exists".format(s.email))
 
-        s.id = self.next_student_id
-        self.students[s.id] = s
-        self.emails.add(s.email)
+# the most reservations DB.store_reservations takes at once
+MAX_BATCH_SIZE = 1000
+# the most reservations DB.retrieve_student_reservations returns at once
+MAX_PAGE_SIZE = 100
+# how many days DB.find_free_slots looks ahead at most
+MAX_SEARCH_DAYS = 90
+
+
+# how a reservation is written to the write-ahead log
+def reservation_log_args(r: reservation.Reservation):
+    return (r.id, r.canteenId, r.studentId, r.date.toordinal(),
+            capacity.minute_of_day(r.time), r.duration)
+
+
+def reservation_from_log_args(args: tuple):
+    id, ct_id, student_id, day, minute, duration = args
+    return reservation.Reservation(
+        id=id, canteenId=ct_id, studentId=student_id,
+        date=dt.date.fromordinal(day),
+        time=dt.time(minute // 60, minute % 60), duration=duration)
+
+
+# a canteen the way the api sends it, see DB.retrieve_canteen_json
+def canteen_to_json(ct: canteen.Canteen):
+    return json.dumps(
+        ct.model_dump(mode="json", by_alias=True),
+        ensure_ascii=False, separators=(",", ":")).encode()
+
 
-        self.next_student_id += 1
-        # init dict that keeps track of reservations a student makes
-        self.student_reservations[s.id] = {}
+class DB:
+    # where the students, canteens and reservations are kept, see storage.Storage
+    storage: storage.Storage
+    # caches capacity.meal_table of each canteen. key is the canteen id,
+    # value is (canteen version, meal table)
+    meal_tables: dict
+    # computed results of get_canteen_cap_status. key is (canteen_id, startDate,
+    # endDate, startTime, endTime, duration), entries are tagged with the
+    # version of the canteen they were computed for
+    status_cache: cache.VersionedLRUCache
+    # the json of every canteen, as sent by GET /canteens/{id}. key is the
+    # canteen id, value is (canteens version, bytes). the key None holds
+    # the list of all of them, as sent by GET /canteens
+    canteen_json: dict
+    # write-ahead log and snapshots, None when the db lives only in memory
+    persistence: persistence.Persistence
+
+    def __init__(self, store: storage.Storage = None, status_cache_size: int = 4096):
+        self.storage = store if store is not None else storage.MemoryStorage()
+        self.meal_tables = {}
+        self.status_cache = cache.VersionedLRUCache(status_cache_size)
+        self.canteen_json = {}
+        self.persistence = None
+
+    # writes a mutation to the write-ahead log (if persistence is enabled)
+    # before it is applied. 'args' must be enough for replayMutation to
+    # apply the mutation again without validating it
+    def logMutation(self, op: str, args: tuple):
+        if self.persistence is not None:
+            self.persistence.log(self, op, args)
+
+    # the mutations logged inside share one sync of the write-ahead log
+    def logGroup(self):
+        if self.persistence is not None:
+            return self.persistence.group()
+        return contextlib.nullcontext()
+
+    @metrics.timed("store_student")
+    def store_student(self, s: student.Student):
+        with self.storage.transaction():
+            if self.storage.has_email(s.email):
+                raise ValueError(
+                    "User with email {} already exists".format(s.email))
+
+            s.id = self.storage.get_next_student_id()
+            self.logMutation("store_student", (s.id, s.name, s.email, s.isAdmin))
+            self.applyNewStudent(s)
+
+    # stores a student made in another db under the id it got there, for
+    # the shards of the router (see router.py), which all keep every
+    # student under the same id. returns false if the student was already
+    # stored, so copying it again does nothing
+    @metrics.timed("copy_student")
+    def copy_student(self, s: student.Student):
+        with self.storage.transaction():
+            stored = self.storage.get_student(s.id)
+            if stored is not None:
+                if stored != s:
+                    raise ValueError(
+                        "Student with id {} is another student".format(s.id))
+                return False
+            if s.id != self.storage.get_next_student_id():
+                raise ValueError("Student with id {} is out of order, expected id {}".format(
+                    s.id, self.storage.get_next_student_id()))
+            if self.storage.has_email(s.email):
+                raise ValueError(
+                    "User with email {} already exists".format(s.email))
+
+            self.logMutation("store_student", (s.id, s.name, s.email, s.isAdmin))
+            self.applyNewStudent(s)
+            return True
+
+    # the apply* functions change the state without any validation.
+    # they are what the public functions call once the input has been
+    # validated, and what replayMutation calls when recovering from the log
+    def applyNewStudent(self, s: student.Student):
+        self.storage.add_student(s)
 
+    @metrics.timed("retrieve_student")
     def retrieve_student(self, id: int):
-        if id in self.students:
-            return self.students[id]
+        s = self.storage.get_student(id)
+        if s is not None:
+            return s
         raise ValueError(
             "Student with id {} isn't stored in memory".format(id))
 
@@ -72,191 +128,159 @@ class DB:
         s = self.retrieve_student(id)
         return s.isAdmin
 
-    def init_canteen_capacities(self, ct_id: int):
-        self.canteen_capacities[ct_id] = {}
-
-    def init_canteen_reservations(self, ct_id: int):
-        self.canteen_reservations[ct_id] = []
-
-    def init_student_reservations(self, student_id: int):
-        self.student_reservations[student_id] = {}
-
+    @metrics.timed("store_canteen")
     def store_canteen(self, ct: canteen.Canteen, student_id: int):
-        if not self.isStudentAdmin(student_id):
-            raise ValueError(
-                "Student {} does not have admin priviledges".format(student_id))
+        with self.storage.transaction():
+            if not self.isStudentAdmin(student_id):
+                raise ValueError(
+                    "Student {} does not have admin priviledges".format(student_id))
 
-        if ct.name in self.canteen_names:
-            raise ValueError("Canteen named {} already exists".format(ct.name))
+            if self.storage.has_canteen_name(ct.name):
+                raise ValueError("Canteen named {} already exists".format(ct.name))
 
-        if ct.location in self.canteen_locations:
-            raise ValueError(
-                "There is already a canteen at location {}".format(ct.location))
+            if self.storage.has_canteen_location(ct.location):
+                raise ValueError(
+                    "There is already a canteen at location {}".format(ct.location))
 
-        ct.id = self.next_canteen_id
-        self.canteens[ct.id] = ct
+            ct.id = self.storage.get_next_canteen_id()
+            self.logMutation("store_canteen", (ct.model_dump(by_alias=True),))
+            self.applyNewCanteen(ct)
 
-        self.canteen_names.add(ct.name)
-        self.canteen_locations.add(ct.location)
-        self.next_canteen_id += 1
+    def applyNewCanteen(self, ct: canteen.Canteen):
+        self.storage.add_canteen(ct)
+        self.storage.bump_canteens_version()
 
-        self.init_canteen_reservations(ct.id)
-        self.init_canteen_capacities(ct.id)
+    def getCanteenVersion(self, ct_id: int):
+        return self.storage.canteen_version(ct_id)
 
+    def bumpCanteenVersion(self, ct_id: int):
+        self.storage.bump_canteen_version(ct_id)
+
+    @metrics.timed("retrieve_canteen")
     def retrieve_canteen(self, id: int):
-        if id in self.canteens:
-            return self.canteens[id]
+        ct = self.storage.get_canteen(id)
+        if ct is not None:
+            return ct
         raise ValueError(
             "Canteen with id {} isn't stored in memory".format(id))
 
+    @metrics.timed("retrieve_all_canteens")
     def retrieve_all_canteens(self):
-        return self.canteens.values()
-
+        return self.storage.all_canteens()
+
+    # the same as retrieve_canteen, but already serialized to json. the
+    # bytes are kept until a canteen is added, changed or removed
+    @metrics.timed("retrieve_canteen_json")
+    def retrieve_canteen_json(self, id: int):
+        version = self.storage.canteens_version()
+        entry = self.canteen_json.get(id)
+        if entry is None or entry[0] != version:
+            entry = (version, canteen_to_json(self.retrieve_canteen(id)))
+            self.canteen_json[id] = entry
+        return entry[1]
+
+    # the strong etags of what the api returns, built from the versions of
+    # the data (see storage.Storage.canteen_version), so a client can be
+    # told its copy is still current without anything being computed or
+    # serialized. the version is read before the data it tags, so a change
+    # made in between only makes the client fetch the data again
+
+    # tags GET /canteens
+    def canteens_etag(self):
+        return '"{:x}-c{}"'.format(self.storage.data_epoch(), self.storage.canteens_version())
+
+    # tags GET /canteens/{id}. the id is in it, so the tag of one canteen
+    # never matches another one (or one that doesn't exist)
+    def canteen_etag(self, ct_id: int):
+        return '"{:x}-c{}-{}"'.format(self.storage.data_epoch(), self.storage.canteens_version(), ct_id)
+
+    # tags the status of one canteen, for any dates and times
+    def canteen_status_etag(self, ct_id: int):
+        return '"{:x}-s{}-{}"'.format(self.storage.data_epoch(), ct_id, self.getCanteenVersion(ct_id))
+
+    # tags the status of all canteens, for any dates and times
+    def all_canteens_status_etag(self):
+        return '"{:x}-a{}"'.format(self.storage.data_epoch(), self.storage.all_canteens_version())
+
+    # the same as retrieve_all_canteens, but already serialized to json,
+    # see retrieve_canteen_json
+    @metrics.timed("retrieve_all_canteens_json")
+    def retrieve_all_canteens_json(self):
+        version = self.storage.canteens_version()
+        entry = self.canteen_json.get(None)
+        if entry is None or entry[0] != version:
+            items = []
+            for ct in self.storage.all_canteens():
+                item = self.canteen_json.get(ct.id)
+                if item is None or item[0] != version:
+                    item = (version, canteen_to_json(ct))
+                    self.canteen_json[ct.id] = item
+                items.append(item[1])
+            entry = (version, b"[" + b",".join(items) + b"]")
+            self.canteen_json[None] = entry
+        return entry[1]
+
+    @metrics.timed("update_canteen")
     def update_canteen(self, ct: canteen.Canteen, student_id: int):
-        if not self.isStudentAdmin(student_id):
-            raise ValueError(
-                "Student {} does not have admin priviledges".format(student_id))
-        if not (ct.id in self.canteens):
-            raise ValueError("There is no canteen with id {}".format(ct.id))
-
-        # make sure that if location changes, we stop keeping track of it
-        if ct.location != self.canteens[ct.id].location:
-            self.canteen_locations.remove(self.canteens[ct.id].location)
-            self.canteen_locations.add(ct.location)
-        # same goes for the name
-        if ct.name != self.canteens[ct.id].name:
-            self.canteen_names.remove(self.canteens[ct.id].name)
-            self.canteen_names.add(ct.name)
-
-        self.canteens[ct.id] = ct
-        return self.canteens[ct.id]
-
+        with self.storage.transaction():
+            if not self.isStudentAdmin(student_id):
+                raise ValueError(
+                    "Student {} does not have admin priviledges".format(student_id))
+            old = self.storage.get_canteen(ct.id)
+            if old is None:
+                raise ValueError("There is no canteen with id {}".format(ct.id))
+            if ct.name != old.name and self.storage.has_canteen_name(ct.name):
+                raise ValueError("Canteen named {} already exists".format(ct.name))
+            if ct.location != old.location and self.storage.has_canteen_location(ct.location):
+                raise ValueError(
+                    "There is already a canteen at location {}".format(ct.location))
+
+            self.logMutation("update_canteen", (ct.model_dump(by_alias=True),))
+            return self.applyCanteenUpdate(ct)
+
+    def applyCanteenUpdate(self, ct: canteen.Canteen):
+        self.storage.replace_canteen(ct)
+        self.bumpCanteenVersion(ct.id)
+        self.storage.bump_canteens_version()
+        return ct
+
+    @metrics.timed("delete_canteen")
     def delete_canteen(self, ct_id: int, student_id: int):
-        if not self.isStudentAdmin(student_id):
-            raise ValueError(
-                "Student {} does not have admin priviledges".format(student_id))
-        if not (ct_id in self.canteens):
-            raise ValueError("There is no canteen with id {}".format(ct_id))
+        with self.storage.transaction():
+            if not self.isStudentAdmin(student_id):
+                raise ValueError(
+                    "Student {} does not have admin priviledges".format(student_id))
+            if self.storage.get_canteen(ct_id) is None:
+                raise ValueError("There is no canteen with id {}".format(ct_id))
 
+            self.logMutation("delete_canteen", (ct_id,))
+            self.applyCanteenDelete(ct_id)
+
+        logs.event(log, logging.INFO, "canteen_deleted", id=ct_id, by=student_id)
+
+    def applyCanteenDelete(self, ct_id: int):
         # remember to delete all reservations if we delete the canteen
-        for r_id in self.canteen_reservations[ct_id]:
-            self.delete_reservation(r_id, student_id)
-        self.canteen_locations.remove(self.canteens[ct_id].location)
-        self.canteen_names.remove(self.canteens[ct_id].name)
-        self.canteens.pop(ct_id)
-        self.canteen_capacities.pop(ct_id)
+        self.storage.cancel_canteen_reservations(ct_id)
+        self.storage.remove_canteen(ct_id)
+        self.meal_tables.pop(ct_id, None)
+        self.canteen_json.pop(ct_id, None)
+        self.bumpCanteenVersion(ct_id)
+        self.storage.bump_canteens_version()
 
     def isDateInThePast(self, d: dt.date, t: dt.time):
         dt_reservation = dt.datetime.combine(d, t)
         return dt_reservation < dt.datetime.now()
 
-    # the naming is a bit misleading, here we are just updating
-    # the number of reservations, not linking them with canteens
-    def addReservationToCanteen(self, ct_id: int, key: str):
-        if key in self.canteen_capacities[ct_id]:
-            self.canteen_capacities[ct_id][key] += 1
-        else:
-            self.canteen_capacities[ct_id][key] = 1
-
-    # also a bit misleading
-    def deleteReservationFromCanteen(self, ct_id: int, key: str):
-        if not (ct_id in self.canteen_capacities):
-            raise ValueError(
-                "There are no reservations in canteen with id {}".format(ct_id))
-        if not (key in self.canteen_capacities[ct_id]):
-            raise ValueError(
-                "There are no reservations in canteen with id {} at {}".format(ct_id, key))
-        self.canteen_capacities[ct_id][key] -= 1
-        if self.canteen_capacities[ct_id][key] < 0:
-            self.canteen_capacities[ct_id][key] = 0
-
-    def handleNewCanteenReservation(self, ct_id: int, r: reservation.Reservation):
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        self.addReservationToCanteen(ct_id, key1)
-
-        self.canteen_reservations[ct_id].append(r.id)
-        print(self.canteen_reservations[ct_id])
-
-        # note that the way I've designed this is that we only see
-        # time in increments of 30 minutes. so if a student
-        # will be in the canteen for more than 30 mintes, we have
-        # to update the next time-point as well
-        if r.duration == 60:
-            dt_combined = dt.datetime.combine(r.date, r.time)
-            dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-            key2 = f"{dt_plus_30.date().isoformat()}|{
-                dt_plus_30.time().strftime('%H:%M')}"
-            self.addReservationToCanteen(ct_id, key2)
-
-    def handleDeleteCanteenReservation(self, ct_id: int, r: reservation.Reservation):
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        self.deleteReservationFromCanteen(ct_id, key1)
-
-        self.canteen_reservations[ct_id].remove(r.id)
-        print(self.canteen_reservations[ct_id])
-
-        if r.duration == 60:
-            dt_combined = dt.datetime.combine(r.date, r.time)
-            dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-            key2 = f"{dt_plus_30.date().isoformat()}|{
-                dt_plus_30.time().strftime('%H:%M')}"
-            self.deleteReservationFromCanteen(ct_id, key2)
-
-    # a bit misleading, we aren't linking the reservation to the
-    # student, we are just saying "this student has a reservation
-    # at this date and time"
-    def addReservationToStudent(self, student_id: int, key: str):
-        if not (student_id in self.students):
-            raise ValueError(
-                "Student with id {} isn't stored in the db".format(student_id))
-        self.student_reservations[student_id][key] = True
-
-    def deleteReservationFromStudent(self, student_id: int, key: str):
-        if not (student_id in self.students):
-            raise ValueError(
-                "Student with id {} isn't stored in the db".format(student_id))
-        if not (key in self.student_reservations[student_id]):
-            raise ValueError(
-                "Student with id {} doesn't have a reservation at {}".format(student_id, key))
-        self.student_reservations[student_id].pop(key)
-
-    # same as canteen reservations, we are looking at time in 30 minute increments
-    def handleNewStudentReservation(self, student_id: int, r: reservation.Reservation):
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        self.addReservationToStudent(student_id, key1)
-
-        if r.duration == 60:
-            dt_combined = dt.datetime.combine(r.date, r.time)
-            dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-            key2 = f"{dt_plus_30.date().isoformat()}|{
-                dt_plus_30.time().strftime('%H:%M')}"
-            self.addReservationToStudent(student_id, key2)
-
-    def handleDeleteStudentReservation(self, student_id: int, r: reservation.Reservation):
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        self.deleteReservationFromStudent(student_id, key1)
-
-        if r.duration == 60:
-            dt_combined = dt.datetime.combine(r.date, r.time)
-            dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-            key2 = f"{dt_plus_30.date().isoformat()}|{
-                dt_plus_30.time().strftime('%H:%M')}"
-            self.deleteReservationFromStudent(student_id, key2)
-
     # returns true if the student has another reservation
-    # at the same date and time as the passed reservation
-    def doesReservationOverlap(self, r: reservation.Reservation):
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        if key1 in self.student_reservations[r.studentId]:
-            return True
-
-        if r.duration == 60:
-            dt_combined = dt.datetime.combine(r.date, r.time)
-            dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-            key2 = f"{dt_plus_30.date().isoformat()}|{
-                dt_plus_30.time().strftime('%H:%M')}"
-            return key2 in self.student_reservations[r.studentId]
-
+    # at the same date and time as the passed reservation.
+    # 'pending' maps (student_id, day) to the mask of the slots taken by
+    # reservations that are about to be stored together with this one
+    def doesReservationOverlap(self, r: reservation.Reservation, pending: dict = None):
+        for day, mask in capacity.reservation_masks(r.date, r.time, r.duration):
+            if pending and pending.get((r.studentId, day), 0) & mask:
+                return True
+            if self.storage.is_student_busy(r.studentId, day, mask):
+                return True
         return False
 
     # returns true if specified time and duration fits into
@@ -265,7 +289,7 @@ class DB:
         r_start_dt = dt.datetime.combine(r.date, r.time)
         r_end_dt = r_start_dt + dt.timedelta(minutes=r.duration)
 
-        ct = self.retrieve_canteen(r.canteenId)
+        ct = self.storage.get_canteen(r.canteenId)
         for m in ct.workingHours:
             meal_start_dt = dt.datetime.combine(r.date, m.from_)
             meal_end_dt = dt.datetime.combine(r.date, m.to)
@@ -275,133 +299,435 @@ class DB:
         return False
 
     # returns true if max capacity reached for time-point or
-    # time-points specified in reservation
-    def isCanteenFull(self, r: reservation.Reservation):
-        ct = self.retrieve_canteen(r.canteenId)
-        key1 = f"{r.date.isoformat()}|{r.time.strftime('%H:%M')}"
-        if key1 not in self.canteen_capacities[ct.id]:
-            if r.duration != 60:
-                return False
-        elif self.canteen_capacities[ct.id][key1] >= ct.capacity:
-            return True
-
-        if r.duration != 60:
-            return False
-
-        dt_combined = dt.datetime.combine(r.date, r.time)
-        dt_plus_30 = dt_combined + dt.timedelta(minutes=30)
-        key2 = f"{dt_plus_30.date().isoformat()}|{
-            dt_plus_30.time().strftime('%H:%M')}"
-        if key2 not in self.canteen_capacities[ct.id]:
-            return False
-        return self.canteen_capacities[ct.id][key2] >= ct.capacity
+    # time-points specified in reservation.
+    # 'pending' maps (canteen_id, day, slot) to the number of reservations
+    # that are about to be stored together with this one
+    def isCanteenFull(self, r: reservation.Reservation, pending: dict = None):
+        ct = self.storage.get_canteen(r.canteenId)
+        for day, slot in capacity.reservation_slots(r.date, r.time, r.duration):
+            taken = self.storage.slot_count(ct.id, day, slot)
+            if pending:
+                taken += pending.get((ct.id, day, slot), 0)
+            if taken >= ct.capacity:
+                return True
+        return False
 
-    def store_reservation(self, r: reservation.Reservation):
-        if not (r.studentId in self.students):
-            raise ValueError(
+    # raises ValueError if the reservation can't be stored. see
+    # doesReservationOverlap and isCanteenFull for 'pending_masks'
+    # and 'pending_counts'
+    @metrics.timed("validate_reservation")
+    def validateReservation(self, r: reservation.Reservation, pending_masks: dict = None, pending_counts: dict = None):
+        # the log doesn't keep the status, new reservations are all active
+        if r.status != "Active":
+            self.rejectReservation("bad_status",
+                "New reservations must be Active, not {}".format(r.status))
+        if self.storage.get_student(r.studentId) is None:
+            self.rejectReservation("unknown_student",
                 "Student with id {} isn't stored in memory".format(r.studentId))
-        if not (r.canteenId in self.canteens):
-            raise ValueError(
+        if self.storage.get_canteen(r.canteenId) is None:
+            self.rejectReservation("unknown_canteen",
                 "Canteen with id {} isn't stored in memory".format(r.canteenId))
 
         if self.isDateInThePast(r.date, r.time):
-            raise ValueError(
+            self.rejectReservation("in_the_past",
                 "Cannot make reservations in the past")
-        if self.doesReservationOverlap(r):
-            raise ValueError("User cannot have two reservations that overlap")
+        if not capacity.is_slot_aligned(r.time):
+            self.rejectReservation("not_slot_aligned",
+                "Reservations must start on a {} minute boundary".format(capacity.SLOT_MINUTES))
+        # no meal is longer than a day, and the checks below go through
+        # every slot of the reservation
+        if r.duration <= 0 or r.duration % capacity.SLOT_MINUTES or r.duration > capacity.MINUTES_PER_DAY:
+            self.rejectReservation("bad_duration",
+                "The duration must be a positive multiple of {} minutes, at most a day".format(capacity.SLOT_MINUTES))
         if not self.isValidMealTime(r):
-            raise ValueError(
+            self.rejectReservation("outside_meal_time",
                 "Canteen isn't open at the specified date and time")
-        if self.isCanteenFull(r):
-            raise ValueError(
+        if self.doesReservationOverlap(r, pending_masks):
+            self.rejectReservation("overlap",
+                "User cannot have two reservations that overlap")
+        if self.isCanteenFull(r, pending_counts):
+            self.rejectReservation("canteen_full",
                 "Canteen has no free spots for the specified date and time")
 
-        r.id = self.next_reservation_id
-        self.reservations[r.id] = r
+    # counts the rejection by its reason before turning the reservation down
+    def rejectReservation(self, reason: str, message: str):
+        metrics.RESERVATION_REJECTIONS.inc(reason)
+        raise ValueError(message)
 
-        self.next_reservation_id += 1
+    @metrics.timed("store_reservation")
+    def store_reservation(self, r: reservation.Reservation):
+        with self.storage.transaction():
+            try:
+                self.validateReservation(r)
+            except ValueError as e:
+                logs.event(log, logging.INFO, "reservation_rejected",
+                           studentId=r.studentId, canteenId=r.canteenId, reason=str(e))
+                raise
+
+            r.id = self.storage.get_next_reservation_id()
+            self.logMutation("store_reservation", reservation_log_args(r))
+            self.applyNewReservation(r)
+
+        logs.event(log, logging.INFO, "reservation_created",
+                   id=r.id, studentId=r.studentId, canteenId=r.canteenId,
+                   date=r.date, time=r.time, duration=r.duration)
+
+    # stores all of the reservations or, if any of them can't be stored,
+    # none of them. they are validated together, so two reservations of the
+    # same student in the batch can't overlap and all of the reservations
+    # for a slot together can't go over the capacity of the canteen
+    @metrics.timed("store_reservations")
+    def store_reservations(self, rs: list):
+        if len(rs) > MAX_BATCH_SIZE:
+            raise ValueError(
+                "At most {} reservations can be made at once".format(MAX_BATCH_SIZE))
+
+        with self.storage.transaction():
+            pending_masks = {}
+            pending_counts = {}
+            for i, r in enumerate(rs):
+                try:
+                    self.validateReservation(r, pending_masks, pending_counts)
+                except ValueError as e:
+                    logs.event(log, logging.INFO, "reservation_batch_rejected",
+                               size=len(rs), index=i, studentId=r.studentId,
+                               canteenId=r.canteenId, reason=str(e))
+                    raise ValueError("Reservation {}: {}".format(i, e))
+                for day, mask in capacity.reservation_masks(r.date, r.time, r.duration):
+                    key = (r.studentId, day)
+                    pending_masks[key] = pending_masks.get(key, 0) | mask
+                for day, slot in capacity.reservation_slots(r.date, r.time, r.duration):
+                    key = (r.canteenId, day, slot)
+                    pending_counts[key] = pending_counts.get(key, 0) + 1
+
+            next_id = self.storage.get_next_reservation_id()
+            for i, r in enumerate(rs):
+                r.id = next_id + i
+            # one record for the whole batch, so replaying the log
+            # can't store only a part of it either
+            self.logMutation("store_reservations", (
+                [reservation_log_args(r) for r in rs],))
+            for r in rs:
+                self.applyNewReservation(r)
+
+        logs.event(log, logging.INFO, "reservation_batch_created",
+                   size=len(rs), firstId=rs[0].id if rs else None)
+
+    # stores every reservation of 'rs' that can be stored, as one group:
+    # they are validated and stored in order, in one transaction, so each
+    # one is checked against the ones stored before it, and the write-ahead
+    # log is synced once for all of them. unlike store_reservations, one
+    # reservation being turned down doesn't stop the others. returns, for
+    # every reservation, None if it was stored or the error (a ValueError
+    # if it's invalid) it was turned down with. once a reservation is in
+    # the log it has to be
+    # applied, so anything failing from then on fails the whole group
+    @metrics.timed("commit_reservations")
+    def commit_reservations(self, rs: list):
+        results = []
+        with self.storage.transaction(), self.logGroup():
+            for r in rs:
+                try:
+                    self.validateReservation(r)
+                    r.id = self.storage.get_next_reservation_id()
+                except Exception as e:
+                    logs.event(log, logging.INFO, "reservation_rejected",
+                               studentId=r.studentId, canteenId=r.canteenId, reason=str(e))
+                    results.append(e)
+                    continue
 
-        self.handleNewCanteenReservation(r.canteenId, r)
-        self.handleNewStudentReservation(r.studentId, r)
+                self.logMutation("store_reservation", reservation_log_args(r))
+                self.applyNewReservation(r)
+                results.append(None)
+
+        for r, error in zip(rs, results):
+            if error is None:
+                logs.event(log, logging.INFO, "reservation_created",
+                           id=r.id, studentId=r.studentId, canteenId=r.canteenId,
+                           date=r.date, time=r.time, duration=r.duration)
+        return results
+
+    def applyNewReservation(self, r: reservation.Reservation):
+        self.storage.add_reservation(r)
+        self.bumpCanteenVersion(r.canteenId)
+
+    # returns a page of up to 'limit' reservations of a student, sorted by
+    # when they start, and the cursor of the next page (None if this is the
+    # last one). 'status' and the dates (both included) filter the
+    # reservations, 'cursor' is what the previous page returned
+    @metrics.timed("retrieve_student_reservations")
+    def retrieve_student_reservations(self, student_id: int, status: str = None, fromDate: dt.date = None, toDate: dt.date = None, cursor: str = None, limit: int = 50):
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError(
+                "The limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+        if status is not None and status not in records.STATUSES:
+            raise ValueError("Unknown reservation status {}".format(status))
+        after = None
+        if cursor:
+            if not cursor.isdigit():
+                raise ValueError("Invalid cursor {}".format(cursor))
+            after = int(cursor)
+
+        # one more than asked for, to know if there is a next page
+        rs = self.storage.student_reservations_page(
+            student_id,
+            (status,) if status is not None else records.STATUSES,
+            fromDate.toordinal() if fromDate is not None else None,
+            toDate.toordinal() if toDate is not None else None,
+            after, limit + 1)
+
+        next_cursor = None
+        if len(rs) > limit:
+            rs = rs[:limit]
+            last = rs[-1]
+            next_cursor = str(records.index_key(
+                last.date.toordinal(), capacity.minute_of_day(last.time), last.id))
+        return rs, next_cursor
 
     def retrieve_reservation(self, r_id: int):
-        exists = r_id in self.reservations
-        if exists:
-            valid_status = self.reservations[r_id].status == "Active"
-
-        if exists and valid_status:
-            return self.reservations[r_id]
+        r = self.storage.get_reservation(r_id)
+        if r is not None and r.status == "Active":
+            return r
 
         raise ValueError(
-            "Reservation with id {} isn't stored in memory".format(id))
+            "Reservation with id {} isn't stored in memory".format(r_id))
 
+    @metrics.timed("delete_reservation")
     def delete_reservation(self, r_id: int, student_id: int):
-        r = self.retrieve_reservation(r_id)
-        if r.studentId != student_id and not self.isStudentAdmin(student_id):
-            raise PermissionError(
-                "Students can delete only their own reservations")
+        with self.storage.transaction():
+            r = self.retrieve_reservation(r_id)
+            if r.studentId != student_id and not self.isStudentAdmin(student_id):
+                raise PermissionError(
+                    "Students can delete only their own reservations")
+
+            self.logMutation("delete_reservation", (r.id,))
+            self.applyReservationDelete(r)
+
+        logs.event(log, logging.INFO, "reservation_cancelled",
+                   id=r.id, studentId=r.studentId, canteenId=r.canteenId, by=student_id)
+        return r
 
+    def applyReservationDelete(self, r: reservation.Reservation):
         r.status = "Cancelled"
 
-        self.handleDeleteCanteenReservation(
-            r.canteenId, r)
-        self.handleDeleteStudentReservation(
-            r.studentId, r)
+        self.storage.cancel_reservation(r)
+        self.bumpCanteenVersion(r.canteenId)
 
         return r
 
+    # drops reservations that are over from memory, see archive.py. 'rows'
+    # are what storage.ended_reservations returned. returns the rows that
+    # were dropped
+    def archive_reservations(self, rows: list):
+        with self.storage.transaction():
+            self.logMutation("archive_reservations", (rows,))
+            return self.applyArchive(rows)
+
+    # the counters of the canteens don't change, so neither do statuses
+    def applyArchive(self, rows: list):
+        return self.storage.archive_reservations(rows)
+
+    # returns the canteen's meal_table (the meal served at every minute of
+    # the day), building it the first time it's needed after the canteen's
+    # working hours were set. 'version' is the version 'ct' is from, for
+    # canteens read from a snapshot
+    def getCanteenMealTable(self, ct: canteen.Canteen, version: int = None):
+        if version is None:
+            version = self.getCanteenVersion(ct.id)
+        entry = self.meal_tables.get(ct.id)
+        if entry is None or entry[0] != version:
+            entry = (version, capacity.meal_table(ct.workingHours))
+            self.meal_tables[ct.id] = entry
+        return entry[1]
+
     # return the name of the meal (e.g. 'dorucak') based on the
     # time. so if 'dorucak' lasts from 09:00 to 10:00, the function
     # returns 'dorucak' when you pass in 09:30
     def getCanteenMealName(self, ct_id: int, t: dt.time):
         ct = self.retrieve_canteen(ct_id)
-        for m in ct.workingHours:
-            if (m.from_ <= t) and (m.to > t):
-                return m.meal
-
-        return ""
+        return self.getCanteenMealTable(ct)[capacity.minute_of_day(t)]
 
     # returns remaining capacities for a canteen for the time and date intervals specified
-    # incrementing the time from 'startTime' to 'dateTime' by 'duration' minutes
+    # incrementing the time from 'startTime' to 'dateTime' by 'duration' minutes.
+    # the result has the shape of canteen.CanteenCapacities, but is made of plain
+    # dicts so it can be serialized as is. results are cached until the canteen
+    # changes, so they must not be modified by the caller
+    @metrics.timed("get_canteen_cap_status")
     def get_canteen_cap_status(self, ct_id: int, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
-        if duration != 30 and duration != 60:
-            raise ValueError("The duration must be either 30 or 60 (minutes)")
-        res = canteen.CanteenCapacities(canteenId=ct_id, slots=[])
-
-        current_date = startDate
-        while current_date <= endDate:
-            curr_time = dt.datetime.combine(current_date, startTime)
-            end_datetime = dt.datetime.combine(current_date, endTime)
-
-            while curr_time < end_datetime:
-                t = curr_time.time()
-                d = curr_time.date()
-                meal_name = self.getCanteenMealName(ct_id, t)
-                if meal_name == "":
-                    curr_time += dt.timedelta(minutes=duration)
-                    continue
-
-                ct = self.retrieve_canteen(ct_id)
-                remaining_cap = ct.capacity
-                key = f"{d.isoformat()}|{t.strftime('%H:%M')}"
-                if key in self.canteen_capacities[ct_id]:
-                    remaining_cap = ct.capacity - \
-                        self.canteen_capacities[ct_id][key]
-
-                res.slots.append(canteen.CapacityResponse(
-                    date=d, meal=meal_name, startTime=t, remainingCapacity=remaining_cap))
-
-                curr_time += dt.timedelta(minutes=duration)
+        snapshot = self.storage.read_snapshot()
+        if snapshot.get_canteen(ct_id) is None:
+            raise ValueError(
+                "Canteen with id {} isn't stored in memory".format(ct_id))
+        return self.canteenCapStatus(snapshot, ct_id, startDate, endDate, startTime, endTime, duration)
+
+    # runs the above function for all canteens currently stored in db. with
+    # MemoryStorage the statuses all come from the same snapshot, so a write
+    # made in between can't show up in some of them and not in others. other
+    # storages only promise that for the status of each canteen by itself
+    @metrics.timed("get_all_canteens_cap_status")
+    def get_all_canteens_cap_status(self, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
+        snapshot = self.storage.read_snapshot()
+        res = []
+        for ct_id in snapshot.canteen_ids():
+            res.append(self.canteenCapStatus(
+                snapshot, ct_id, startDate, endDate, startTime, endTime, duration))
 
-            current_date += dt.timedelta(days=1)
+        return res
 
+    # raises ValueError if a status can't be asked for with 'duration', or
+    # for canteen 'ct_id' (None for the status of all canteens). for
+    # checking a request before its ETag is
+    def validate_status_query(self, duration: int, ct_id: int = None):
+        if duration <= 0 or duration % capacity.SLOT_MINUTES or duration > capacity.MINUTES_PER_DAY:
+            raise ValueError(
+                "The duration must be a positive multiple of {} minutes, at most a day".format(capacity.SLOT_MINUTES))
+        if ct_id is not None:
+            self.retrieve_canteen(ct_id)
+
+    # the status of a canteen of 'snapshot' (see Storage.read_snapshot),
+    # cached under the version of the canteen in the snapshot
+    def canteenCapStatus(self, snapshot, ct_id: int, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
+        self.validate_status_query(duration)
+        ct = snapshot.get_canteen(ct_id)
+
+        key = (ct_id, startDate, endDate, startTime, endTime, duration)
+        version = snapshot.canteen_version(ct_id)
+        res = self.status_cache.get(key, version)
+        if res is not None:
+            return res
+
+        days = snapshot.canteen_day_counts(
+            ct_id, startDate.toordinal(), endDate.toordinal())
+        slots = capacity.status(
+            days, ct.capacity, self.getCanteenMealTable(ct, version),
+            startDate, endDate, startTime, endTime, duration)
+        res = {"canteenId": ct_id, "slots": slots}
+        self.status_cache.put(key, version, res)
         return res
 
-    # runs the above function for all canteens currently stored in db
-    def get_all_canteens_cap_status(self, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
-        res = []
-        for ct_id in self.canteens:
-            res.append(self.get_canteen_cap_status(
-                ct_id, startDate, endDate, startTime, endTime, duration))
+    # same as get_all_canteens_cap_status, but instead of building the whole
+    # list up front, returns a generator that computes the status one canteen
+    # and one day at a time. every item has the shape of CanteenCapacities,
+    # holding the slots of a single day. the generator reads the snapshot
+    # taken when it was made (see Storage.read_snapshot), so it can be
+    # consumed on another thread while writes go on. with MemoryStorage it
+    # shows none of them
+    def iter_all_canteens_cap_status(self, startDate: dt.date, endDate: dt.date, startTime: dt.time, endTime: dt.time, duration: int):
+        self.validate_status_query(duration)
+
+        def gen(snapshot):
+            for ct_id in snapshot.canteen_ids():
+                ct = snapshot.get_canteen(ct_id)
+                days = snapshot.canteen_day_counts(
+                    ct_id, startDate.toordinal(), endDate.toordinal())
+                # built here rather than taken from meal_tables, which
+                # isn't to be touched from other threads
+                meals = capacity.meal_table(ct.workingHours)
+                for slots in capacity.status_days(
+                        days, ct.capacity, meals,
+                        startDate, endDate, startTime, endTime, duration):
+                    yield {"canteenId": ct_id, "slots": slots}
+
+        return gen(self.storage.read_snapshot())
+
+    # returns the earliest 'limit' (canteen, date, start time) where a
+    # reservation of 'duration' minutes starting at or after 'start' would
+    # still leave 'minSeats' spots free, looking 'days' days ahead. they
+    # come sorted by date, start time and canteen id, with the shape of
+    # canteen.FreeSlot. the canteens are merged a day at a time and only
+    # the slots that make it into the result are looked at, so no status
+    # grid is built
+    @metrics.timed("find_free_slots")
+    def find_free_slots(self, start: dt.datetime, minSeats: int, duration: int, limit: int = 10, days: int = 14):
+        if duration <= 0 or duration % capacity.SLOT_MINUTES:
+            raise ValueError(
+                "The duration must be a positive multiple of {} minutes".format(capacity.SLOT_MINUTES))
+        if minSeats < 1:
+            raise ValueError("At least one seat has to be asked for")
+        if limit < 1 or limit > MAX_PAGE_SIZE:
+            raise ValueError(
+                "The limit must be between 1 and {}".format(MAX_PAGE_SIZE))
+        if days < 1 or days > MAX_SEARCH_DAYS:
+            raise ValueError(
+                "At most {} days can be searched".format(MAX_SEARCH_DAYS))
+        # reservations are made in the local time of the canteens
+        if start.tzinfo is not None:
+            raise ValueError("The start must be a local time, without a time zone")
+
+        # reservations can't be made in the past
+        start = max(start, dt.datetime.now())
+        first_day = start.toordinal()
+        last_day = first_day + days - 1
+        # the first minute that isn't in the past
+        first_minute = capacity.minute_of_day(start.time())
+        if start.second or start.microsecond:
+            first_minute += 1
+
+        snapshot = self.storage.read_snapshot()
+        canteens = []
+        for ct in snapshot.all_canteens():
+            starts = capacity.meal_starts(ct.workingHours, duration)
+            if starts and ct.capacity >= minSeats:
+                canteens.append((ct, starts, snapshot.canteen_day_counts(ct.id, first_day, last_day)))
 
+        res = []
+        for day in range(first_day, last_day + 1):
+            date_str = dt.date.fromordinal(day).isoformat()
+            day_start = first_minute if day == first_day else 0
+            found = heapq.merge(*(
+                self.freeStartsOf(ct, starts, counts, day, day_start, duration, minSeats)
+                for ct, starts, counts in canteens))
+            for minute, ct_id, remaining in found:
+                res.append({
+                    "canteenId": ct_id,
+                    "date": date_str,
+                    "startTime": "%02d:%02d" % divmod(minute, 60),
+                    "remainingCapacity": remaining,
+                })
+                if len(res) == limit:
+                    return res
         return res
+
+    # capacity.free_starts of one canteen as (minute, canteen id, remaining
+    # capacity), the order find_free_slots merges them in
+    def freeStartsOf(self, ct: canteen.Canteen, starts: list, counts, day: int, first_minute: int, duration: int, minSeats: int):
+        for minute, remaining in capacity.free_starts(counts, ct.capacity, starts, day, first_minute, duration, minSeats):
+            yield minute, ct.id, remaining
+
+    # applies a mutation read back from the write-ahead log.
+    # see logMutation for what 'args' hold for every op
+    def replayMutation(self, op: str, args: tuple):
+        # a transaction of its own, so the storage publishes what it did
+        with self.storage.transaction():
+            if op == "store_student":
+                id, name, email, isAdmin = args
+                self.applyNewStudent(student.Student(
+                    id=id, name=name, email=email, isAdmin=isAdmin))
+            elif op == "store_canteen":
+                self.applyNewCanteen(canteen.Canteen.model_validate(args[0]))
+            elif op == "update_canteen":
+                self.applyCanteenUpdate(canteen.Canteen.model_validate(args[0]))
+            elif op == "delete_canteen":
+                self.applyCanteenDelete(args[0])
+            elif op == "store_reservation":
+                self.applyNewReservation(reservation_from_log_args(args))
+            elif op == "store_reservations":
+                for r_args in args[0]:
+                    self.applyNewReservation(reservation_from_log_args(r_args))
+            elif op == "delete_reservation":
+                self.applyReservationDelete(self.retrieve_reservation(args[0]))
+            elif op == "archive_reservations":
+                self.applyArchive(args[0])
+            else:
+                raise ValueError("Unknown operation {} in the log".format(op))
+
+    # the stored data, as opposed to things like caches that are
+    # rebuilt on demand. this is what goes into a snapshot
+    def get_state(self):
+        return self.storage.get_state()
+
+    def load_state(self, state: dict):
+        self.storage.load_state(state)
+        self.meal_tables = {}
+        self.status_cache.clear()
+        self.canteen_json = {}
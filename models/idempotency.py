@@ -0,0 +1,64 @@
+import asyncio
+from models import cache
+
+
+# keys are kept for a day by default
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_KEYS = 100000
+
+
+# remembers the response of every request sent with an Idempotency-Key
+# header, so a client retrying it (because the response got lost on the
+# way) gets the same response back instead of the request being run again.
+# only requests that succeeded are remembered, a failed one changed nothing
+# and can just be run again. a retry arriving while the first request is
+# still running waits for it, and fails the same way if it fails.
+# keys are kept in a cache.TTLCache, so at most 'max_keys' of them, for
+# 'ttl' seconds
+class IdempotencyStore:
+    # key -> (fingerprint, response content)
+    done: cache.TTLCache
+    # key -> (fingerprint, future of the response content) of the
+    # requests that are still running
+    running: dict
+
+    def __init__(self, max_keys: int = DEFAULT_MAX_KEYS, ttl: float = DEFAULT_TTL):
+        self.done = cache.TTLCache(max_keys, ttl)
+        self.running = {}
+
+    # returns what 'action' (an async function) returns, running it only if
+    # no request with the same key ran it before. 'fingerprint' tells the
+    # requests apart: reusing a key for a different request is a ValueError
+    async def run(self, key, fingerprint, action):
+        entry = self.done.get(key)
+        if entry is None:
+            entry = self.running.get(key)
+        if entry is not None:
+            if entry[0] != fingerprint:
+                raise ValueError("The idempotency key was used for a different request")
+            if isinstance(entry[1], asyncio.Future):
+                return await asyncio.shield(entry[1])
+            return entry[1]
+
+        future = asyncio.get_running_loop().create_future()
+        self.running[key] = (fingerprint, future)
+        try:
+            content = await action()
+        except Exception as e:
+            future.set_exception(e)
+            # nobody might be waiting for it
+            future.exception()
+            raise
+        except BaseException:
+            future.cancel()
+            raise
+        else:
+            future.set_result(content)
+            self.done.put(key, (fingerprint, content))
+            return content
+        finally:
+            del self.running[key]
+
+    def clear(self):
+        self.done.clear()
+        self.running.clear()
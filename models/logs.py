@@ -0,0 +1,112 @@
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+
+
+# every logger of the app lives under this one, so setup only has to
+# configure it
+ROOT_LOGGER = "canteens"
+
+
+def get_logger(name: str):
+    return logging.getLogger("{}.{}".format(ROOT_LOGGER, name))
+
+
+# logs the event 'name' with 'fields' as its structured data. the fields are
+# only put together into a record if the logger would let it through, so a
+# disabled level costs a single check
+def event(logger: logging.Logger, level: int, name: str, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, name, extra={"fields": fields})
+
+
+# writes every record as one line of json: the time, level, logger and
+# event name, followed by the event's fields
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord):
+        entry = {
+            "time": round(record.created, 6),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, separators=(",", ":"))
+
+
+# lets through only about 'rate' (between 0 and 1) of the records below
+# WARNING, so the busiest events can be logged without logging all of them.
+# warnings and errors always get through
+class SamplingFilter(logging.Filter):
+    rate: float
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        if rate < 0 or rate > 1:
+            raise ValueError("The sample rate must be between 0 and 1")
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord):
+        if record.levelno >= logging.WARNING or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+# hands records to a queue instead of writing them, so logging never waits
+# on the console or a file. once the queue holds 'max_queue' records, new
+# ones are dropped (and counted) rather than blocking the caller
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    dropped: int
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# sets up logging for the app: records of 'level' and above that pass a
+# SamplingFilter(sample_rate) are put on a queue by the logging code and
+# written as json lines to 'stream' (stderr by default) by a background
+# thread. returns the logging.handlers.QueueListener running that thread,
+# pass it to shutdown to write out what's left in the queue and stop it
+def setup(level: str = "INFO", sample_rate: float = 1.0, stream=None, max_queue: int = 10000):
+    output = logging.StreamHandler(stream if stream is not None else sys.stderr)
+    output.setFormatter(JSONFormatter())
+
+    q = queue.Queue(max_queue)
+    handler = DroppingQueueHandler(q)
+    # sampling before the queue, so dropped records never get that far
+    handler.addFilter(SamplingFilter(sample_rate))
+
+    logger = logging.getLogger(ROOT_LOGGER)
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(handler)
+    logger.setLevel(level.upper())
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(q, output)
+    listener.start()
+    return listener
+
+
+def shutdown(listener: logging.handlers.QueueListener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+
+
+# milliseconds since 'start', a time.perf_counter() reading
+def elapsed_ms(start: float):
+    return round((time.perf_counter() - start) * 1000, 3)
@@ -0,0 +1,173 @@
+import bisect
+import time
+from functools import wraps
+
+
+# counters, gauges and histograms kept in plain dicts and written out in the
+# prometheus text format by render. updating one is a dict lookup and an
+# addition, so they can stay on in production. every process keeps its own,
+# so with several workers each scrape sees the worker that answered it
+
+# upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(names: tuple, values: tuple, extra: str = ""):
+    parts = ['{}="{}"'.format(n, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def format_value(value: float):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    name: str
+    help: str
+    label_names: tuple
+    # label values -> count
+    values: dict
+
+    def __init__(self, name: str, help: str, label_names: tuple = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} counter".format(self.name)]
+        for labels, value in sorted(self.values.items()):
+            lines.append("{}{} {}".format(
+                self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+# a gauge whose values are read only when the metrics are rendered, by
+# calling 'collect', which returns a dict of label values -> value
+class Gauge:
+    name: str
+    help: str
+    label_names: tuple
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), collect=None):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.collect = collect
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} gauge".format(self.name)]
+        values = self.collect() if self.collect is not None else {}
+        for labels, value in sorted(values.items()):
+            lines.append("{}{} {}".format(
+                self.name, format_labels(self.label_names, labels), format_value(value)))
+        return lines
+
+
+class Histogram:
+    name: str
+    help: str
+    label_names: tuple
+    buckets: tuple
+    # label values -> [count of every bucket (not cumulative), count above
+    # the last bucket, sum]
+    values: dict
+
+    def __init__(self, name: str, help: str, label_names: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value: float, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = [[0] * (len(self.buckets) + 1), 0.0]
+            self.values[labels] = entry
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def count(self, *labels):
+        entry = self.values.get(labels)
+        return 0 if entry is None else sum(entry[0])
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} histogram".format(self.name)]
+        for labels, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(
+                    self.name,
+                    format_labels(self.label_names, labels, 'le="{}"'.format(format_value(bound))),
+                    cumulative))
+            label_text = format_labels(self.label_names, labels)
+            lines.append("{}_sum{} {}".format(self.name, label_text, repr(total)))
+            lines.append("{}_count{} {}".format(self.name, label_text, cumulative))
+        return lines
+
+
+class Registry:
+    metrics: list
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def unregister(self, name: str):
+        self.metrics = [m for m in self.metrics if m.name != name]
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "canteens_request_seconds", "Time taken to answer a request, by route",
+    ("method", "route", "status")))
+DB_OPERATION_SECONDS = REGISTRY.register(Histogram(
+    "canteens_db_operation_seconds", "Time taken by a db operation, by operation",
+    ("operation",)))
+COMMIT_BATCH_SIZE = REGISTRY.register(Histogram(
+    "canteens_commit_batch_size", "Reservations committed together by the commit queue",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512)))
+ADMISSION_SHED = REGISTRY.register(Counter(
+    "canteens_admission_shed_total", "Requests turned away by admission control, by limiter and route class",
+    ("limiter", "route_class")))
+RESERVATION_REJECTIONS = REGISTRY.register(Counter(
+    "canteens_reservation_rejections_total", "Reservations turned down, by reason",
+    ("reason",)))
+
+
+# records how long every call of the decorated function takes (errors
+# included) in DB_OPERATION_SECONDS, as 'operation'
+def timed(operation: str):
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                DB_OPERATION_SECONDS.observe(time.perf_counter() - start, operation)
+        return wrapper
+    return decorator
@@ -0,0 +1,221 @@
+import contextlib
+import os
+import pickle
+import struct
+import time
+import zlib
+
+
+# every record in the log is a header holding the length and the crc32 of
+# the payload, followed by the payload itself: a pickled (seq, op, args)
+# tuple. the crc lets us tell a record that was only partly written
+# (because the process died in the middle of writing it) from a good one
+RECORD_HEADER = struct.Struct("<II")
+
+
+# yields (seq, op, args, end) for every record in the log at 'path', where
+# 'end' is the offset right after the record. stops at the first record
+# that is cut short or doesn't match its crc
+def read_log(path: str):
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        data = f.read()
+
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+        end = start + length
+        if end > len(data):
+            return
+        payload = data[start:end]
+        if zlib.crc32(payload) != crc:
+            return
+        seq, op, args = pickle.loads(payload)
+        yield seq, op, args, end
+        offset = end
+
+
+# append-only file of mutations. every record is handed to the os as soon
+# as it's appended, so it survives the process crashing, but it's only
+# fsync-ed (so it survives the machine crashing) once 'fsync_every' records
+# have piled up or 'fsync_interval' seconds have passed since the last
+# fsync, whichever comes first. this lets many records share one fsync.
+# both are only checked when a record is appended, so with 'fsync_interval'
+# the owner has to call sync() every so often too (handlers does), or the
+# last records before a quiet spell aren't synced until the next one
+class WriteAheadLog:
+    path: str
+    fsync_every: int
+    fsync_interval: float
+    unsynced: int
+    last_sync: float
+    # how many hold()s are open
+    held: int
+
+    def __init__(self, path: str, fsync_every: int = 1, fsync_interval: float = 0.0):
+        if fsync_every < 1:
+            raise ValueError("fsync_every must be at least 1")
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+        self.held = 0
+        self.file = open(path, "ab")
+
+    def append(self, seq: int, op: str, args: tuple):
+        payload = pickle.dumps((seq, op, args), protocol=pickle.HIGHEST_PROTOCOL)
+        self.file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+        self.file.write(payload)
+        self.file.flush()
+
+        self.unsynced += 1
+        if not self.held:
+            self.maybeSync()
+
+    def maybeSync(self):
+        if self.unsynced >= self.fsync_every:
+            self.sync()
+        elif self.fsync_interval and time.monotonic() - self.last_sync >= self.fsync_interval:
+            self.sync()
+
+    # the records appended inside are only fsync-ed (if they are due)
+    # once the outermost hold is left, so all of them share one fsync
+    @contextlib.contextmanager
+    def hold(self):
+        self.held += 1
+        try:
+            yield
+        finally:
+            self.held -= 1
+            if not self.held:
+                self.maybeSync()
+
+    def sync(self):
+        if self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    # throws away every record, used once they are all in a snapshot
+    def truncate(self):
+        self.file.truncate(0)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def close(self):
+        self.sync()
+        self.file.close()
+
+
+# keeps a DB on disk in 'data_dir' as a snapshot of its whole state plus a
+# write-ahead log of every mutation made since that snapshot. every
+# 'snapshot_every' logged mutations, a new snapshot is written and the log
+# is emptied, so recovering only has to load the snapshot and replay the
+# few records after it
+class Persistence:
+    log_path: str
+    snapshot_path: str
+    fsync_every: int
+    fsync_interval: float
+    snapshot_every: int
+    # seq of the last record written to the log (or included in the snapshot)
+    seq: int
+    # number of records in the log since the last snapshot
+    since_snapshot: int
+    wal: WriteAheadLog
+
+    def __init__(self, data_dir: str, fsync_every: int = 1, fsync_interval: float = 0.0, snapshot_every: int = 100000):
+        if snapshot_every < 1:
+            raise ValueError("snapshot_every must be at least 1")
+        os.makedirs(data_dir, exist_ok=True)
+        self.data_dir = data_dir
+        self.log_path = os.path.join(data_dir, "db.wal")
+        self.snapshot_path = os.path.join(data_dir, "db.snapshot")
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.snapshot_every = snapshot_every
+        self.seq = 0
+        self.since_snapshot = 0
+        self.wal = None
+
+    # loads the latest snapshot and the log after it into db, and from then
+    # on logs every mutation of db
+    def recover(self, db):
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as f:
+                self.seq, state = pickle.load(f)
+            db.load_state(state)
+
+        valid_end = 0
+        for seq, op, args, end in read_log(self.log_path):
+            valid_end = end
+            # records the snapshot already holds, left over when we crashed
+            # between writing the snapshot and emptying the log
+            if seq <= self.seq:
+                continue
+            db.replayMutation(op, args)
+            self.seq = seq
+            self.since_snapshot += 1
+
+        # cut off whatever is left of a record that was being written
+        # when we crashed, so new records don't end up behind it
+        if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > valid_end:
+            os.truncate(self.log_path, valid_end)
+
+        self.wal = WriteAheadLog(self.log_path, self.fsync_every, self.fsync_interval)
+        db.persistence = self
+
+    # called by the db before it applies a mutation
+    def log(self, db, op: str, args: tuple):
+        # the mutation isn't applied yet, so this is the right moment
+        # to save the state holding everything logged so far
+        if self.since_snapshot >= self.snapshot_every:
+            self.snapshot(db)
+
+        self.seq += 1
+        self.wal.append(self.seq, op, args)
+        self.since_snapshot += 1
+
+    # writes the whole state of db to a new snapshot and empties the log.
+    # the snapshot is written to a temporary file first, so a crash midway
+    # leaves the previous snapshot in place
+    def snapshot(self, db):
+        self.wal.sync()
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((self.seq, db.get_state()), f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        self.syncDataDir()
+
+        self.wal.truncate()
+        self.since_snapshot = 0
+
+    # makes the rename of the snapshot durable
+    def syncDataDir(self):
+        if not hasattr(os, "O_DIRECTORY"):
+            return
+        fd = os.open(self.data_dir, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def flush(self):
+        self.wal.sync()
+
+    # see WriteAheadLog.hold
+    def group(self):
+        return self.wal.hold()
+
+    # snapshots the db, so the next start doesn't have to replay anything
+    def close(self, db):
+        if self.since_snapshot:
+            self.snapshot(db)
+        self.wal.close()
+        db.persistence = None
@@ -0,0 +1,172 @@
+import array
+import datetime as dt
+from models import student, reservation, capacity
+
+
+# students and reservations kept as columns (one array or list per field)
+# instead of one pydantic model each. a model costs several hundred bytes,
+# a reservation here takes 17. models are only built, without validation,
+# when a single student or reservation is read.
+# ids are handed out in order, so the row of an item is its id - 1 (minus
+# the reservations dropped from the front, see ReservationColumns.compact)
+# and no id -> row index is needed. items must be appended in the order of
+# their ids
+
+# reservation.status values, stored as their index
+STATUSES = ("Active", "Cancelled")
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES)}
+# status code of a reservation that was moved to the archive (see
+# archive.py). it's no longer in memory, only its row is still taking space
+ARCHIVED = 255
+
+
+# sort key of a reservation in a student's index (and the cursor of the
+# pages of a student's reservations): when it starts, then its id, packed
+# into one int
+def index_key(day: int, minute: int, id: int):
+    return ((day * capacity.MINUTES_PER_DAY + minute) << 32) | id
+
+
+def key_id(key: int):
+    return key & 0xFFFFFFFF
+
+
+class StudentColumns:
+    names: list
+    emails: list
+    admins: bytearray
+
+    def __init__(self):
+        self.names = []
+        self.emails = []
+        self.admins = bytearray()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, id: int):
+        return 0 < id <= len(self.names)
+
+    def append(self, s: student.Student):
+        if s.id != len(self.names) + 1:
+            raise ValueError(
+                "Student with id {} stored out of order, expected id {}".format(s.id, len(self.names) + 1))
+        self.names.append(s.name)
+        self.emails.append(s.email)
+        self.admins.append(s.isAdmin)
+
+    def get(self, id: int):
+        if id not in self:
+            return None
+        row = id - 1
+        return student.Student.model_construct(
+            id=id, name=self.names[row], email=self.emails[row], isAdmin=bool(self.admins[row]))
+
+    def ids(self):
+        return range(1, len(self.names) + 1)
+
+
+class ReservationColumns:
+    canteen_ids: array.array
+    student_ids: array.array
+    # ordinal of the date
+    days: array.array
+    # minute of the day the reservation starts at
+    minutes: array.array
+    durations: array.array
+    # index into STATUSES, or ARCHIVED
+    statuses: bytearray
+    # number of reservations dropped from the front of the columns once
+    # they were archived, so the row of an id is id - offset - 1
+    offset: int
+
+    def __init__(self):
+        self.canteen_ids = array.array("I")
+        self.student_ids = array.array("I")
+        self.days = array.array("I")
+        self.minutes = array.array("H")
+        self.durations = array.array("H")
+        self.statuses = bytearray()
+        self.offset = 0
+
+    # number of reservations held, archived ones waiting to be dropped included
+    def __len__(self):
+        return len(self.statuses)
+
+    def __contains__(self, id: int):
+        row = id - self.offset - 1
+        return 0 <= row < len(self.statuses) and self.statuses[row] != ARCHIVED
+
+    def append(self, r: reservation.Reservation):
+        expected = self.offset + len(self.statuses) + 1
+        if r.id != expected:
+            raise ValueError(
+                "Reservation with id {} stored out of order, expected id {}".format(r.id, expected))
+        if r.status not in STATUS_CODES:
+            raise ValueError("Unknown reservation status {}".format(r.status))
+        self.canteen_ids.append(r.canteenId)
+        self.student_ids.append(r.studentId)
+        self.days.append(r.date.toordinal())
+        self.minutes.append(capacity.minute_of_day(r.time))
+        self.durations.append(r.duration)
+        self.statuses.append(STATUS_CODES[r.status])
+
+    def get(self, id: int):
+        if id not in self:
+            return None
+        row = id - self.offset - 1
+        minute = self.minutes[row]
+        return reservation.Reservation.model_construct(
+            id=id, canteenId=self.canteen_ids[row], studentId=self.student_ids[row],
+            date=dt.date.fromordinal(self.days[row]), time=dt.time(minute // 60, minute % 60),
+            duration=self.durations[row], status=STATUSES[self.statuses[row]])
+
+    def set_status(self, id: int, status: str):
+        self.statuses[id - self.offset - 1] = STATUS_CODES[status]
+
+    # (student id, day ordinal, start minute, duration) of a reservation,
+    # without building its model
+    def span(self, id: int):
+        row = id - self.offset - 1
+        return self.student_ids[row], self.days[row], self.minutes[row], self.durations[row]
+
+    # the whole row of a reservation: (id, canteen id, student id, day
+    # ordinal, start minute, duration, status code)
+    def row(self, id: int):
+        row = id - self.offset - 1
+        return (id, self.canteen_ids[row], self.student_ids[row], self.days[row],
+                self.minutes[row], self.durations[row], self.statuses[row])
+
+    # ids from start_id up to (but without) end_id of the reservations that
+    # are over before day 'before' (a day ordinal) and not archived yet
+    def ended_before(self, before: int, start_id: int, end_id: int):
+        first = max(0, start_id - self.offset - 1)
+        last = min(len(self.statuses), end_id - self.offset - 1)
+        ids = []
+        for row in range(first, last):
+            if self.statuses[row] == ARCHIVED:
+                continue
+            end = self.minutes[row] + self.durations[row] - 1
+            if self.days[row] + end // capacity.MINUTES_PER_DAY < before:
+                ids.append(row + self.offset + 1)
+        return ids
+
+    def archive(self, id: int):
+        self.statuses[id - self.offset - 1] = ARCHIVED
+
+    # drops the archived reservations at the front of the columns. ids go
+    # up with time, so reservations mostly get archived in the order of
+    # their ids and the front is where the archived ones pile up
+    def compact(self):
+        count = 0
+        while count < len(self.statuses) and self.statuses[count] == ARCHIVED:
+            count += 1
+        if count:
+            for column in (self.canteen_ids, self.student_ids, self.days,
+                           self.minutes, self.durations, self.statuses):
+                del column[:count]
+            self.offset += count
+        return count
+
+    def last_id(self):
+        return self.offset + len(self.statuses)
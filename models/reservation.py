@@ -1,4 +1,5 @@
 from pydantic import BaseModel, field_serializer
+from typing import Optional
 import datetime as dt
 
 
@@ -14,3 +15,9 @@ class Reservation(BaseModel):
     @field_serializer("time")
     def serialize_time(self, value: dt.time):
         return value.strftime("%H:%M")
+
+
+class ReservationPage(BaseModel):
+    reservations: list[Reservation]
+    # pass as 'cursor' to get the next page, None on the last page
+    nextCursor: Optional[str] = None
@@ -0,0 +1,147 @@
+import datetime as dt
+from models import capacity, records
+
+
+# the pieces of the sharded deployment (see router.py) that don't talk to
+# the shards: the ids the router hands out, and the slots it knows
+# students to be busy in.
+#
+# every shard is an unchanged app with its own db, numbering its canteens
+# and reservations from 1. the router makes the ids unique by interleaving
+# them: local id l of shard s (of n) is the global id (l - 1) * n + s + 1,
+# so the shard of an id is (id - 1) % n and nothing has to be looked up.
+# students are stored in every shard, under the same ids
+
+
+class ShardMap:
+    count: int
+
+    def __init__(self, count: int):
+        if count < 1:
+            raise ValueError("There has to be at least one shard")
+        self.count = count
+
+    def shard_of(self, id: int):
+        return (id - 1) % self.count
+
+    def to_local(self, id: int):
+        return (id - 1) // self.count + 1
+
+    def to_global(self, local_id: int, shard: int):
+        return (local_id - 1) * self.count + shard + 1
+
+    # the cursor (a records.index_key) to pass to 'shard' to get the
+    # reservations after global cursor 'key': the same start, with the
+    # highest local id whose global id isn't above the one in 'key'
+    def local_key(self, key: int, shard: int):
+        local_id = (records.key_id(key) - shard - 1) // self.count + 1
+        return ((key >> 32) << 32) | local_id
+
+    # the functions below turn what 'shard' returned into what the router
+    # returns, in place
+
+    def canteen_out(self, ct: dict, shard: int):
+        ct["id"] = self.to_global(ct["id"], shard)
+        return ct
+
+    def reservation_out(self, r: dict, shard: int):
+        r["id"] = self.to_global(r["id"], shard)
+        r["canteenId"] = self.to_global(r["canteenId"], shard)
+        return r
+
+    # status lines and free slots, which only point to their canteen
+    def canteen_ref_out(self, item: dict, shard: int):
+        item["canteenId"] = self.to_global(item["canteenId"], shard)
+        return item
+
+
+# the records.index_key of a reservation as the api returns it
+def reservation_key(r: dict):
+    return records.index_key(
+        dt.date.fromisoformat(r["date"]).toordinal(),
+        capacity.minute_of_day(dt.time.fromisoformat(r["time"])), r["id"])
+
+
+# capacity.reservation_masks of a reservation as the api takes or returns it
+def reservation_masks(r: dict):
+    return capacity.reservation_masks(
+        dt.date.fromisoformat(r["date"]), dt.time.fromisoformat(r["time"]), int(r["duration"]))
+
+
+# ors 'masks' into the day -> mask of the student in 'slots'
+def add_masks(slots: dict, student_id: int, masks: list):
+    days = slots.setdefault(student_id, {})
+    for day, mask in masks:
+        days[day] = days.get(day, 0) | mask
+
+
+# clears 'masks' from the day -> mask of the student in 'slots'
+def remove_masks(slots: dict, student_id: int, masks: list):
+    days = slots.get(student_id)
+    if days is None:
+        return
+    for day, mask in masks:
+        left = days.get(day, 0) & ~mask
+        if left:
+            days[day] = left
+        else:
+            days.pop(day, None)
+    if not days:
+        del slots[student_id]
+
+
+# the slots every student is busy in, over all shards, so the router can
+# turn down overlapping reservations at canteens of different shards. it
+# holds day -> slot mask (see capacity.reservation_masks) for
+#   - 'busy': the active reservations of the student. a student's are
+#     loaded from the shards the first time they're needed, and then kept
+#     up to date by the router
+#   - 'pending': the reservations sent to a shard that hasn't answered yet
+# two active reservations of a student never overlap, so every slot of a
+# mask belongs to one reservation, and adding and removing one is or-ing
+# and clearing its bits
+class StudentSlots:
+    busy: dict
+    pending: dict
+    # students whose reservations were loaded into 'busy'
+    loaded: set
+
+    def __init__(self):
+        self.busy = {}
+        self.pending = {}
+        self.loaded = set()
+
+    def is_loaded(self, student_id: int):
+        return student_id in self.loaded
+
+    def load(self, student_id: int, masks: list):
+        add_masks(self.busy, student_id, masks)
+        self.loaded.add(student_id)
+
+    def overlaps(self, student_id: int, masks: list):
+        busy = self.busy.get(student_id, {})
+        pending = self.pending.get(student_id, {})
+        return any((busy.get(day, 0) | pending.get(day, 0)) & mask for day, mask in masks)
+
+    def hold(self, student_id: int, masks: list):
+        add_masks(self.pending, student_id, masks)
+
+    # the shard turned the reservation down
+    def release(self, student_id: int, masks: list):
+        remove_masks(self.pending, student_id, masks)
+
+    # the shard stored the reservation
+    def commit(self, student_id: int, masks: list):
+        remove_masks(self.pending, student_id, masks)
+        add_masks(self.busy, student_id, masks)
+
+    def cancel(self, student_id: int, masks: list):
+        remove_masks(self.busy, student_id, masks)
+
+    # forgets every loaded reservation, so they're loaded again when next
+    # needed. for when the shards cancelled reservations by themselves
+    # (like when a canteen is deleted). the pending ones are kept, they
+    # are still on their way
+    def forget(self):
+        self.busy = {}
+        self.loaded = set()
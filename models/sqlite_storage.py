@@ -0,0 +1,351 @@
+import array
+import contextlib
+import datetime as dt
+import json
+import sqlite3
+import threading
+from models import student, canteen, reservation, capacity, cache
+from models.storage import Storage
+
+
+# reservations are kept as the ordinal of their date, the minute of that day
+# they start at and their duration, rather than as slots, so the file stays
+# valid if capacity.SLOT_MINUTES ever changes. the indexes on (canteenId,
+# date, startMinute) and (studentId, date, startMinute) let the capacity and
+# overlap checks read only the reservations of a day or two
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS students (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL UNIQUE,
+    isAdmin INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS canteens (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    location TEXT NOT NULL UNIQUE,
+    capacity INTEGER NOT NULL,
+    workingHours TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS reservations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    canteenId INTEGER NOT NULL,
+    studentId INTEGER NOT NULL,
+    date INTEGER NOT NULL,
+    startMinute INTEGER NOT NULL,
+    duration INTEGER NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reservations_by_canteen
+    ON reservations (canteenId, date, startMinute);
+CREATE INDEX IF NOT EXISTS reservations_by_student
+    ON reservations (studentId, date, startMinute);
+CREATE TABLE IF NOT EXISTS canteen_versions (
+    canteenId INTEGER PRIMARY KEY,
+    version INTEGER NOT NULL
+);
+"""
+
+# every query is one of these constants with ? placeholders, so sqlite3
+# prepares each of them once and reuses it from its statement cache
+
+INSERT_STUDENT = "INSERT INTO students (id, name, email, isAdmin) VALUES (?, ?, ?, ?)"
+SELECT_STUDENT = "SELECT id, name, email, isAdmin FROM students WHERE id = ?"
+SELECT_EMAIL = "SELECT 1 FROM students WHERE email = ?"
+
+INSERT_CANTEEN = "INSERT INTO canteens (id, name, location, capacity, workingHours) VALUES (?, ?, ?, ?, ?)"
+SELECT_CANTEEN = "SELECT id, name, location, capacity, workingHours FROM canteens WHERE id = ?"
+SELECT_ALL_CANTEENS = "SELECT id, name, location, capacity, workingHours FROM canteens ORDER BY id"
+SELECT_CANTEEN_IDS = "SELECT id FROM canteens ORDER BY id"
+UPDATE_CANTEEN = "UPDATE canteens SET name = ?, location = ?, capacity = ?, workingHours = ? WHERE id = ?"
+DELETE_CANTEEN = "DELETE FROM canteens WHERE id = ?"
+SELECT_CANTEEN_NAME = "SELECT 1 FROM canteens WHERE name = ?"
+SELECT_CANTEEN_LOCATION = "SELECT 1 FROM canteens WHERE location = ?"
+
+INSERT_RESERVATION = """INSERT INTO reservations
+    (id, canteenId, studentId, date, startMinute, duration, status) VALUES (?, ?, ?, ?, ?, ?, ?)"""
+SELECT_RESERVATION = """SELECT id, canteenId, studentId, date, startMinute, duration, status
+    FROM reservations WHERE id = ?"""
+UPDATE_RESERVATION_STATUS = "UPDATE reservations SET status = ? WHERE id = ?"
+CANCEL_CANTEEN_RESERVATIONS = """UPDATE reservations SET status = 'Cancelled'
+    WHERE canteenId = ? AND status = 'Active'"""
+
+# reservations of a canteen (or a student) that cover the minutes from ?
+# to ? of day ?. a reservation can run past midnight, so the one day
+# before is searched as well
+SELECT_CANTEEN_SLOT_COUNT = """SELECT COUNT(*) FROM reservations
+    WHERE canteenId = ? AND status = 'Active' AND date BETWEEN ? - 1 AND ?
+    AND (date - ?) * 1440 + startMinute < ? AND (date - ?) * 1440 + startMinute + duration > ?"""
+SELECT_STUDENT_BUSY = """SELECT 1 FROM reservations
+    WHERE studentId = ? AND status = 'Active' AND date BETWEEN ? - 1 AND ?
+    AND (date - ?) * 1440 + startMinute < ? AND (date - ?) * 1440 + startMinute + duration > ?
+    LIMIT 1"""
+SELECT_CANTEEN_DAYS = """SELECT date, startMinute, duration FROM reservations
+    WHERE canteenId = ? AND status = 'Active' AND date BETWEEN ? - 1 AND ?"""
+
+SELECT_SIZES = """SELECT
+    (SELECT COUNT(*) FROM students),
+    (SELECT COUNT(*) FROM canteens),
+    (SELECT COUNT(*) FROM reservations),
+    (SELECT COUNT(*) FROM reservations WHERE status = 'Active'),
+    (SELECT COUNT(*) FROM (SELECT DISTINCT canteenId, date FROM reservations WHERE status = 'Active'))"""
+# the counts go through whole tables, so they are kept for this many
+# seconds instead of being counted again on every metrics scrape
+SIZES_TTL = 10.0
+
+# a page of a student's reservations, see Storage.student_reservations_page.
+# the cursor is compared the way records.index_key builds it
+SELECT_STUDENT_RESERVATIONS = """SELECT id, canteenId, studentId, date, startMinute, duration, status
+    FROM reservations WHERE studentId = ? AND status IN (?, ?) AND date BETWEEN ? AND ?
+    AND ((date * 1440 + startMinute) << 32 | id) > ?
+    ORDER BY date, startMinute, id LIMIT ?"""
+# sqlite integers are signed 64-bit ones, a cursor past that can't be
+# bound to the query
+MAX_INTEGER = (1 << 63) - 1
+
+SELECT_NEXT_ID = "SELECT seq FROM sqlite_sequence WHERE name = ?"
+# the version of the canteens themselves is kept as the one of canteen 0,
+# and Storage.data_epoch as the one of canteen -1, ids no canteen ever has
+CANTEENS_VERSION_ID = 0
+EPOCH_ID = -1
+INSERT_EPOCH = "INSERT OR IGNORE INTO canteen_versions (canteenId, version) VALUES (?, abs(random() % 4294967296))"
+SELECT_ALL_CANTEENS_VERSION = "SELECT COALESCE(SUM(version), 0) FROM canteen_versions WHERE canteenId >= 0"
+SELECT_CANTEEN_VERSION = "SELECT version FROM canteen_versions WHERE canteenId = ?"
+BUMP_CANTEEN_VERSION = """INSERT INTO canteen_versions (canteenId, version) VALUES (?, 1)
+    ON CONFLICT (canteenId) DO UPDATE SET version = version + 1"""
+
+
+# keeps everything in an sqlite database file, in WAL journal mode so
+# readers don't wait for writers. only the rows a request needs are ever
+# loaded into python objects.
+# several processes (e.g. uvicorn workers) can use the same file at once:
+# every check and the change it allows happen in one BEGIN IMMEDIATE
+# transaction, ids come from the file and emails, canteen names and
+# locations are UNIQUE in it, so no process can overbook a slot or store a
+# duplicate because of what another process did in the meantime. a
+# process that finds the file locked waits up to 'timeout' seconds
+class SQLiteStorage(Storage):
+    path: str
+    conn: sqlite3.Connection
+    # the connection is shared by the event loop and the threads
+    # streaming responses are produced in
+    lock: threading.RLock
+    # how many transaction() blocks we're currently in
+    depth: int
+    # the last result of sizes(), see SIZES_TTL
+    sizes_cache: cache.TTLCache
+
+    def __init__(self, path: str, timeout: float = 5.0, sizes_ttl: float = SIZES_TTL):
+        self.path = path
+        # the timeout has to be set when connecting, since workers
+        # starting at the same time all switch the journal mode and
+        # create the schema at once
+        self.conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None,
+            check_same_thread=False, cached_statements=256)
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.sizes_cache = cache.TTLCache(1, sizes_ttl)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.execute(INSERT_EPOCH, (EPOCH_ID,))
+
+    # BEGIN IMMEDIATE takes the write lock of the database right away, so
+    # the checks made inside the transaction still hold when it commits,
+    # even if other connections write to the same file
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            if self.depth > 0:
+                self.depth += 1
+                try:
+                    yield
+                finally:
+                    self.depth -= 1
+                return
+
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.depth = 1
+            try:
+                yield
+            except BaseException:
+                self.depth = 0
+                self.conn.execute("ROLLBACK")
+                raise
+            self.depth = 0
+            self.conn.execute("COMMIT")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def query_one(self, sql: str, params: tuple):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def query_all(self, sql: str, params: tuple):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params: tuple):
+        with self.lock:
+            try:
+                self.conn.execute(sql, params)
+            except sqlite3.IntegrityError as e:
+                raise ValueError(str(e))
+
+    def next_id(self, table: str):
+        row = self.query_one(SELECT_NEXT_ID, (table,))
+        return 1 if row is None else row[0] + 1
+
+    def get_next_student_id(self):
+        return self.next_id("students")
+
+    def add_student(self, s: student.Student):
+        self.execute(INSERT_STUDENT, (s.id, s.name, s.email, int(s.isAdmin)))
+
+    def get_student(self, id: int):
+        row = self.query_one(SELECT_STUDENT, (id,))
+        if row is None:
+            return None
+        return student.Student(id=row[0], name=row[1], email=row[2], isAdmin=bool(row[3]))
+
+    def has_email(self, email: str):
+        return self.query_one(SELECT_EMAIL, (email,)) is not None
+
+    def canteen_from_row(self, row: tuple):
+        return canteen.Canteen(
+            id=row[0], name=row[1], location=row[2], capacity=row[3],
+            workingHours=json.loads(row[4]))
+
+    def working_hours_json(self, ct: canteen.Canteen):
+        return json.dumps([m.model_dump(by_alias=True) for m in ct.workingHours])
+
+    def get_next_canteen_id(self):
+        return self.next_id("canteens")
+
+    def add_canteen(self, ct: canteen.Canteen):
+        self.execute(INSERT_CANTEEN, (
+            ct.id, ct.name, ct.location, ct.capacity, self.working_hours_json(ct)))
+
+    def get_canteen(self, id: int):
+        row = self.query_one(SELECT_CANTEEN, (id,))
+        if row is None:
+            return None
+        return self.canteen_from_row(row)
+
+    def all_canteens(self):
+        return [self.canteen_from_row(row) for row in self.query_all(SELECT_ALL_CANTEENS, ())]
+
+    def canteen_ids(self):
+        return [row[0] for row in self.query_all(SELECT_CANTEEN_IDS, ())]
+
+    def replace_canteen(self, ct: canteen.Canteen):
+        self.execute(UPDATE_CANTEEN, (
+            ct.name, ct.location, ct.capacity, self.working_hours_json(ct), ct.id))
+
+    def remove_canteen(self, ct_id: int):
+        self.execute(DELETE_CANTEEN, (ct_id,))
+
+    def has_canteen_name(self, name: str):
+        return self.query_one(SELECT_CANTEEN_NAME, (name,)) is not None
+
+    def has_canteen_location(self, location: str):
+        return self.query_one(SELECT_CANTEEN_LOCATION, (location,)) is not None
+
+    def get_next_reservation_id(self):
+        return self.next_id("reservations")
+
+    def add_reservation(self, r: reservation.Reservation):
+        self.execute(INSERT_RESERVATION, (
+            r.id, r.canteenId, r.studentId, r.date.toordinal(),
+            capacity.minute_of_day(r.time), r.duration, r.status))
+
+    def get_reservation(self, id: int):
+        row = self.query_one(SELECT_RESERVATION, (id,))
+        if row is None:
+            return None
+        return self.reservation_from_row(row)
+
+    def reservation_from_row(self, row: tuple):
+        return reservation.Reservation(
+            id=row[0], canteenId=row[1], studentId=row[2],
+            date=dt.date.fromordinal(row[3]),
+            time=dt.time(row[4] // 60, row[4] % 60),
+            duration=row[5], status=row[6])
+
+    def cancel_reservation(self, r: reservation.Reservation):
+        self.execute(UPDATE_RESERVATION_STATUS, (r.status, r.id))
+
+    def cancel_canteen_reservations(self, ct_id: int):
+        self.execute(CANCEL_CANTEEN_RESERVATIONS, (ct_id,))
+
+    def student_reservations_page(self, student_id: int, statuses: tuple, first_day: int, last_day: int, after: int, limit: int):
+        # the query takes two statuses, one is repeated if only one is asked for
+        statuses = (tuple(statuses) * 2)[:2]
+        if after is not None and after > MAX_INTEGER:
+            raise ValueError("Invalid cursor {}".format(after))
+        rows = self.query_all(SELECT_STUDENT_RESERVATIONS, (
+            student_id, statuses[0], statuses[1],
+            first_day if first_day is not None else 0,
+            last_day if last_day is not None else dt.date.max.toordinal(),
+            after if after is not None else -1, limit))
+        return [self.reservation_from_row(row) for row in rows]
+
+    def slot_count(self, ct_id: int, day: int, slot: int):
+        start = slot * capacity.SLOT_MINUTES
+        end = start + capacity.SLOT_MINUTES
+        return self.query_one(SELECT_CANTEEN_SLOT_COUNT, (ct_id, day, day, day, end, day, start))[0]
+
+    def canteen_day_counts(self, ct_id: int, first_day: int, last_day: int):
+        days = {}
+        for date, start, duration in self.query_all(SELECT_CANTEEN_DAYS, (ct_id, first_day, last_day)):
+            for day, slot in capacity.span_slots(date, start, duration):
+                if day < first_day or day > last_day:
+                    continue
+                row = days.get(day)
+                if row is None:
+                    row = array.array("I", [0]) * capacity.SLOTS_PER_DAY
+                    days[day] = row
+                row[slot] += 1
+        return days
+
+    # the mask of a reservation is one run of slots, so looking for
+    # reservations between its first and last slot is the same as
+    # checking every bit
+    def is_student_busy(self, student_id: int, day: int, mask: int):
+        start = ((mask & -mask).bit_length() - 1) * capacity.SLOT_MINUTES
+        end = mask.bit_length() * capacity.SLOT_MINUTES
+        return self.query_one(SELECT_STUDENT_BUSY, (student_id, day, day, day, end, day, start)) is not None
+
+    def canteen_version(self, ct_id: int):
+        row = self.query_one(SELECT_CANTEEN_VERSION, (ct_id,))
+        return 0 if row is None else row[0]
+
+    def bump_canteen_version(self, ct_id: int):
+        self.execute(BUMP_CANTEEN_VERSION, (ct_id,))
+
+    def canteens_version(self):
+        return self.canteen_version(CANTEENS_VERSION_ID)
+
+    def bump_canteens_version(self):
+        self.bump_canteen_version(CANTEENS_VERSION_ID)
+
+    # every bump adds one to the sum of the versions
+    def all_canteens_version(self):
+        return self.query_one(SELECT_ALL_CANTEENS_VERSION, ())[0]
+
+    def data_epoch(self):
+        return self.canteen_version(EPOCH_ID)
+
+    # other processes write to the file too, so the counts can't be kept
+    # up to date here, they are counted again once SIZES_TTL is over
+    def sizes(self):
+        res = self.sizes_cache.get("sizes")
+        if res is None:
+            row = self.query_one(SELECT_SIZES, ())
+            res = dict(zip(
+                ("students", "canteens", "reservations", "active_reservations", "canteen_capacity_days"), row))
+            self.sizes_cache.put("sizes", res)
+        return dict(res)
@@ -0,0 +1,655 @@
+import bisect
+import contextlib
+import heapq
+import random
+from abc import ABC, abstractmethod
+from models import student, canteen, reservation, capacity, records
+
+
+# where the db keeps its data. DB does all the validation and only asks
+# the storage to save, load and count things, so the data can live in
+# memory (MemoryStorage) or somewhere else (see sqlite_storage) without
+# DB knowing the difference
+class Storage(ABC):
+    # everything that changes the storage inside DB happens in a
+    # transaction, together with the checks that allowed it. storages that
+    # can be changed by someone else at the same time (e.g. another
+    # process) have to make sure nobody else changes them in the meantime
+    def transaction(self):
+        return contextlib.nullcontext()
+
+    # what status queries read: an object with the get_canteen,
+    # all_canteens, canteen_ids, canteen_version and canteen_day_counts
+    # methods of a storage. MemoryStorage returns a ReadSnapshot, so a
+    # query sees every write of a transaction or none of it, over all the
+    # canteens it reads. by default the storage itself is read, which is
+    # enough for storages whose every read is consistent by itself (see
+    # sqlite_storage), but then only each read is: writes can land between
+    # the canteens of one query
+    def read_snapshot(self):
+        return self
+
+    # the state of the storage for a snapshot, see persistence.Persistence.
+    # only needed for storages that don't keep the data on disk themselves
+    def get_state(self):
+        raise NotImplementedError(
+            "{} can't be snapshotted".format(type(self).__name__))
+
+    def load_state(self, state: dict):
+        raise NotImplementedError(
+            "{} can't be loaded from a snapshot".format(type(self).__name__))
+
+    def close(self):
+        pass
+
+    # archiving (see archive.py) is only supported by storages keeping
+    # everything in memory.
+    # returns the rows (see records.ReservationColumns.row) of the
+    # reservations with ids from start_id up to end_id that were over
+    # before day 'before'
+    def ended_reservations(self, before: int, start_id: int, end_id: int) -> list:
+        raise NotImplementedError(
+            "{} can't archive reservations".format(type(self).__name__))
+
+    # drops the reservations of 'rows' that haven't changed since the rows
+    # were read, keeping only the number of active ones per canteen and day
+    # and the slots they took up in their canteens. returns the rows that
+    # were dropped
+    def archive_reservations(self, rows: list) -> list:
+        raise NotImplementedError(
+            "{} can't archive reservations".format(type(self).__name__))
+
+    # the get_next_*_id functions return the id the next stored item of that
+    # kind will get. storing an item doesn't assign the id, it has to be
+    # set on the item before it's passed to add_*
+
+    @abstractmethod
+    def get_next_student_id(self) -> int: ...
+
+    @abstractmethod
+    def add_student(self, s: student.Student): ...
+
+    # returns None if there is no such student
+    @abstractmethod
+    def get_student(self, id: int) -> student.Student: ...
+
+    @abstractmethod
+    def has_email(self, email: str) -> bool: ...
+
+    @abstractmethod
+    def get_next_canteen_id(self) -> int: ...
+
+    @abstractmethod
+    def add_canteen(self, ct: canteen.Canteen): ...
+
+    # returns None if there is no such canteen
+    @abstractmethod
+    def get_canteen(self, id: int) -> canteen.Canteen: ...
+
+    @abstractmethod
+    def all_canteens(self) -> list: ...
+
+    @abstractmethod
+    def canteen_ids(self) -> list: ...
+
+    # replaces the stored canteen with the same id as ct
+    @abstractmethod
+    def replace_canteen(self, ct: canteen.Canteen): ...
+
+    @abstractmethod
+    def remove_canteen(self, ct_id: int): ...
+
+    @abstractmethod
+    def has_canteen_name(self, name: str) -> bool: ...
+
+    @abstractmethod
+    def has_canteen_location(self, location: str) -> bool: ...
+
+    @abstractmethod
+    def get_next_reservation_id(self) -> int: ...
+
+    @abstractmethod
+    def add_reservation(self, r: reservation.Reservation): ...
+
+    # returns the reservation whatever its status, None if there is no such reservation
+    @abstractmethod
+    def get_reservation(self, id: int) -> reservation.Reservation: ...
+
+    # saves that r (which is already marked as cancelled) no longer takes up a spot
+    @abstractmethod
+    def cancel_reservation(self, r: reservation.Reservation): ...
+
+    # cancels every active reservation in a canteen at once, freeing the
+    # slots they took up for both the canteen and the students
+    @abstractmethod
+    def cancel_canteen_reservations(self, ct_id: int): ...
+
+    # returns up to 'limit' reservations of a student whose status is one
+    # of 'statuses', from first_day to last_day (day ordinals, None for no
+    # bound), sorted by records.index_key and starting after the key
+    # 'after' (None to start from the first one)
+    @abstractmethod
+    def student_reservations_page(self, student_id: int, statuses: tuple, first_day: int, last_day: int, after: int, limit: int) -> list: ...
+
+    # how many active reservations a canteen has in a slot
+    @abstractmethod
+    def slot_count(self, ct_id: int, day: int, slot: int) -> int: ...
+
+    # returns a mapping of day ordinal -> counter array (see
+    # capacity.CapacityStore) of a canteen for the days from first_day
+    # to last_day. days without reservations may be left out
+    @abstractmethod
+    def canteen_day_counts(self, ct_id: int, first_day: int, last_day: int): ...
+
+    # returns true if the student has an active reservation in any of the
+    # slots of a day set in 'mask' (see capacity.reservation_masks)
+    @abstractmethod
+    def is_student_busy(self, student_id: int, day: int, mask: int) -> bool: ...
+
+    # version of the data of a canteen, bumped whenever the canteen or its
+    # reservations change, so anything computed from an older version is
+    # known to be stale
+    @abstractmethod
+    def canteen_version(self, ct_id: int) -> int: ...
+
+    @abstractmethod
+    def bump_canteen_version(self, ct_id: int): ...
+
+    # version of the canteens themselves (not their reservations), bumped
+    # whenever a canteen is added, changed or removed
+    @abstractmethod
+    def canteens_version(self) -> int: ...
+
+    @abstractmethod
+    def bump_canteens_version(self): ...
+
+    # goes up whenever the version of any canteen, or of the canteens
+    # themselves, goes up
+    @abstractmethod
+    def all_canteens_version(self) -> int: ...
+
+    # a number picked at random when the data was created. the versions
+    # only mean something together with it, so that versions of data that
+    # was lost or replaced since can't be mistaken for the current ones
+    @abstractmethod
+    def data_epoch(self) -> int: ...
+
+    # how much is stored, for the metrics: a dict with the number of
+    # "students", "canteens", "reservations" (cancelled ones included),
+    # "active_reservations" and "canteen_capacity_days" (days of a canteen
+    # that somebody has a reservation on)
+    @abstractmethod
+    def sizes(self) -> dict: ...
+
+
+# attributes of MemoryStorage that are saved in snapshots
+PERSISTENT_FIELDS = (
+    "students", "canteens", "reservations", "canteen_capacities",
+    "canteen_reservations", "student_reservations", "canteen_versions",
+    "next_student_id", "next_canteen_id", "next_reservation_id",
+    "emails", "canteen_locations", "canteen_names", "archived_counts",
+    "student_index",
+)
+
+
+# the canteens, their versions and their counters as they were at the end
+# of a transaction. it never changes, so status queries can read it from
+# any thread for as long as they like while writes go on, without locks
+class ReadSnapshot:
+    canteens: dict
+    # Storage.canteens_version it was taken at
+    canteens_version: int
+    versions: dict
+    # see capacity.CapacityStore.freeze
+    counters: capacity.FrozenCounters
+    # Storage.all_canteens_version it was taken at
+    version: int
+
+    def __init__(self, canteens: dict, canteens_version: int, versions: dict, counters: capacity.FrozenCounters, version: int):
+        self.canteens = canteens
+        self.canteens_version = canteens_version
+        self.versions = versions
+        self.counters = counters
+        self.version = version
+
+    def get_canteen(self, id: int):
+        return self.canteens.get(id)
+
+    def all_canteens(self):
+        return list(self.canteens.values())
+
+    def canteen_ids(self):
+        return list(self.canteens)
+
+    def canteen_version(self, ct_id: int):
+        return self.versions.get(ct_id, 0)
+
+    def canteen_day_counts(self, ct_id: int, first_day: int, last_day: int):
+        return self.counters.days(ct_id)
+
+
+# keeps everything in dicts in memory
+class MemoryStorage(Storage):
+    # all created students, see records.StudentColumns
+    students: records.StudentColumns
+    # all created canteens: key is id: int, value is canteen class
+    canteens: dict
+    # all created reservations (cancelled ones included), see
+    # records.ReservationColumns
+    reservations: records.ReservationColumns
+    # holds num of reservations for each canteen, addressed by the id of the
+    # canteen, the ordinal of the date and the index of the slot
+    # canteen_capacities.get(canteen_id, day, slot) is how many people have
+    # reserved a spot
+    canteen_capacities: capacity.CapacityStore
+    # dict of dicts. key is canteen_id, value is a dict whose keys are the
+    # ids of the canteen's active reservations (and values are None). a dict
+    # rather than a list, so a single reservation can be removed in O(1)
+    # used for easier deletion of the reservations once a canteen is deleted
+    canteen_reservations: dict
+    # keeps track of a students reservations. key is student_id, value is
+    # a dict of day_ordinal -> bitmask of the slots of that day the student
+    # has a reservation in (bit i is slot i). days without reservations
+    # have no entry
+    student_reservations: dict
+    # a student's reservations sorted by when they start. key is student_id,
+    # value is a dict of status -> sorted list of the records.index_key of
+    # the student's reservations with that status. students without
+    # reservations have no entry
+    student_index: dict
+    # see Storage.canteen_version. key is the canteen id
+    canteen_versions: dict
+    # see Storage.canteens_version
+    canteen_list_version: int
+    # see Storage.all_canteens_version and Storage.data_epoch. neither is
+    # kept in snapshots, loading one picks a new epoch instead
+    versions_total: int
+    epoch: int
+    # see Storage.read_snapshot. published again when a transaction that
+    # changed a canteen ends, or when a snapshot is loaded. not kept in
+    # snapshots either
+    snapshot: ReadSnapshot
+    # how many transaction() blocks we're currently in
+    depth: int
+    # what's left of archived reservations. key is (canteen_id, day_ordinal),
+    # value is the number of active reservations archived for that day
+    archived_counts: dict
+    # these keep track of ids so ids are unique
+    next_student_id: int
+    next_canteen_id: int
+    next_reservation_id: int
+
+    # keep track of data that needs to be unique
+    emails: set
+    canteen_locations: set
+    canteen_names: set
+
+    def __init__(self):
+        self.students = records.StudentColumns()
+        self.canteens = {}
+        self.reservations = records.ReservationColumns()
+        self.canteen_capacities = capacity.CapacityStore()
+        self.canteen_reservations = {}
+        self.student_reservations = {}
+        self.student_index = {}
+        self.canteen_versions = {}
+        self.canteen_list_version = 0
+        self.versions_total = 0
+        self.epoch = random.getrandbits(32)
+        self.archived_counts = {}
+        self.next_student_id = 1
+        self.next_canteen_id = 1
+        self.next_reservation_id = 1
+        self.emails = set()
+        self.canteen_locations = set()
+        self.canteen_names = set()
+        self.depth = 0
+        self.snapshot = None
+        self.publish()
+
+    # canteens are replaced rather than changed, so the dict of them is
+    # only copied again when one was added, replaced or removed
+    def publish(self):
+        old = self.snapshot
+        if old is not None and old.canteens_version == self.canteen_list_version:
+            canteens = old.canteens
+        else:
+            canteens = dict(self.canteens)
+        self.snapshot = ReadSnapshot(
+            canteens, self.canteen_list_version, dict(self.canteen_versions),
+            self.canteen_capacities.freeze(), self.versions_total)
+
+    @contextlib.contextmanager
+    def transaction(self):
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            if self.depth == 0 and self.snapshot.version != self.versions_total:
+                self.publish()
+
+    def read_snapshot(self):
+        return self.snapshot
+
+    def get_state(self):
+        state = {name: getattr(self, name) for name in PERSISTENT_FIELDS}
+        state["slot_minutes"] = capacity.SLOT_MINUTES
+        return state
+
+    # snapshots made with another slot size (or before the size was saved)
+    # have counters and student slots that don't fit the current ones, so
+    # those are worked out again from the reservations
+    def load_state(self, state: dict):
+        for name in PERSISTENT_FIELDS:
+            # fields added later are missing from older snapshots
+            if name in state:
+                setattr(self, name, state[name])
+        # snapshots from before the students and reservations were kept
+        # as columns hold dicts of id -> model
+        if isinstance(self.students, dict):
+            self.students = self.columnsFromModels(records.StudentColumns(), self.students)
+        if isinstance(self.reservations, dict):
+            self.reservations = self.columnsFromModels(records.ReservationColumns(), self.reservations)
+        if state.get("slot_minutes") != capacity.SLOT_MINUTES:
+            self.rebuildSlots()
+        if "student_index" not in state:
+            self.rebuildStudentIndex()
+        self.epoch = random.getrandbits(32)
+        self.snapshot = None
+        self.publish()
+
+    def columnsFromModels(self, columns, models: dict):
+        for id in sorted(models):
+            columns.append(models[id])
+        return columns
+
+    def rebuildSlots(self):
+        self.canteen_capacities = capacity.CapacityStore()
+        for ct_id in self.canteens:
+            self.canteen_capacities.init_canteen(ct_id)
+        self.student_reservations = {st_id: {} for st_id in self.students.ids()}
+        for ct_id, r_ids in self.canteen_reservations.items():
+            for r_id in r_ids:
+                student_id, day, minute, duration = self.reservations.span(r_id)
+                for slot_day, slot in capacity.span_slots(day, minute, duration):
+                    self.addReservationToCanteen(ct_id, slot_day, slot)
+                for mask_day, mask in capacity.span_masks(day, minute, duration):
+                    self.addReservationToStudent(student_id, mask_day, mask)
+
+    def rebuildStudentIndex(self):
+        self.student_index = {}
+        for id in range(self.reservations.offset + 1, self.reservations.last_id() + 1):
+            if id in self.reservations:
+                _, _, student_id, day, minute, _, status = self.reservations.row(id)
+                self.indexReservation(student_id, records.STATUSES[status], records.index_key(day, minute, id))
+
+    def indexReservation(self, student_id: int, status: str, key: int):
+        keys = self.student_index.setdefault(student_id, {}).setdefault(status, [])
+        # mostly reservations are made for later than the ones before them
+        if not keys or keys[-1] < key:
+            keys.append(key)
+        else:
+            bisect.insort(keys, key)
+
+    def unindexReservation(self, student_id: int, status: str, key: int):
+        keys = self.student_index[student_id][status]
+        i = bisect.bisect_left(keys, key)
+        if i == len(keys) or keys[i] != key:
+            raise ValueError(
+                "Reservation with id {} isn't in the index of student {}".format(records.key_id(key), student_id))
+        del keys[i]
+
+    # moves a reservation in its student's index from one status to another
+    def reindexReservation(self, id: int, old: str, new: str):
+        _, _, student_id, day, minute, _, _ = self.reservations.row(id)
+        key = records.index_key(day, minute, id)
+        self.unindexReservation(student_id, old, key)
+        self.indexReservation(student_id, new, key)
+
+    def get_next_student_id(self):
+        return self.next_student_id
+
+    def add_student(self, s: student.Student):
+        self.students.append(s)
+        self.emails.add(s.email)
+
+        self.next_student_id = max(self.next_student_id, s.id + 1)
+        # init set that keeps track of reservations a student makes
+        self.student_reservations[s.id] = {}
+
+    def get_student(self, id: int):
+        return self.students.get(id)
+
+    def has_email(self, email: str):
+        return email in self.emails
+
+    def get_next_canteen_id(self):
+        return self.next_canteen_id
+
+    def add_canteen(self, ct: canteen.Canteen):
+        self.canteens[ct.id] = ct
+
+        self.canteen_names.add(ct.name)
+        self.canteen_locations.add(ct.location)
+        self.next_canteen_id = max(self.next_canteen_id, ct.id + 1)
+
+        self.canteen_reservations[ct.id] = {}
+        self.canteen_capacities.init_canteen(ct.id)
+
+    def get_canteen(self, id: int):
+        return self.canteens.get(id)
+
+    def all_canteens(self):
+        return list(self.canteens.values())
+
+    def canteen_ids(self):
+        return list(self.canteens)
+
+    def replace_canteen(self, ct: canteen.Canteen):
+        old = self.canteens[ct.id]
+        # make sure that if location changes, we stop keeping track of it
+        if ct.location != old.location:
+            self.canteen_locations.remove(old.location)
+            self.canteen_locations.add(ct.location)
+        # same goes for the name
+        if ct.name != old.name:
+            self.canteen_names.remove(old.name)
+            self.canteen_names.add(ct.name)
+
+        self.canteens[ct.id] = ct
+
+    def remove_canteen(self, ct_id: int):
+        self.canteen_locations.remove(self.canteens[ct_id].location)
+        self.canteen_names.remove(self.canteens[ct_id].name)
+        self.canteens.pop(ct_id)
+        self.canteen_capacities.drop_canteen(ct_id)
+        self.canteen_reservations.pop(ct_id, None)
+
+    def has_canteen_name(self, name: str):
+        return name in self.canteen_names
+
+    def has_canteen_location(self, location: str):
+        return location in self.canteen_locations
+
+    def get_next_reservation_id(self):
+        return self.next_reservation_id
+
+    def add_reservation(self, r: reservation.Reservation):
+        self.reservations.append(r)
+
+        self.next_reservation_id = max(self.next_reservation_id, r.id + 1)
+
+        self.handleNewCanteenReservation(r.canteenId, r)
+        self.handleNewStudentReservation(r.studentId, r)
+        self.indexReservation(r.studentId, r.status, records.index_key(
+            r.date.toordinal(), capacity.minute_of_day(r.time), r.id))
+
+    def get_reservation(self, id: int):
+        return self.reservations.get(id)
+
+    def cancel_reservation(self, r: reservation.Reservation):
+        self.reindexReservation(r.id, "Active", r.status)
+        self.reservations.set_status(r.id, r.status)
+        self.handleDeleteCanteenReservation(r.canteenId, r)
+        self.handleDeleteStudentReservation(r.studentId, r)
+
+    def cancel_canteen_reservations(self, ct_id: int):
+        r_ids = self.canteen_reservations[ct_id]
+        self.canteen_reservations[ct_id] = {}
+        for r_id in r_ids:
+            self.reindexReservation(r_id, "Active", "Cancelled")
+            self.reservations.set_status(r_id, "Cancelled")
+            student_id, day, minute, duration = self.reservations.span(r_id)
+            for mask_day, mask in capacity.span_masks(day, minute, duration):
+                self.deleteReservationFromStudent(student_id, mask_day, mask)
+        # every reservation of the canteen is gone, so instead of counting
+        # each of them down, start over with no counters at all
+        self.canteen_capacities.init_canteen(ct_id)
+
+    def ended_reservations(self, before: int, start_id: int, end_id: int):
+        return [self.reservations.row(id)
+                for id in self.reservations.ended_before(before, start_id, end_id)]
+
+    # the counters of the canteens are left as they are, so the status of
+    # an archived day stays the same. a day's counters are a fixed size
+    # however many reservations it had, and nothing can change them anymore
+    def archive_reservations(self, rows: list):
+        archived = []
+        for row in rows:
+            id, ct_id, student_id, day, minute, duration, status = row
+            if id not in self.reservations or self.reservations.row(id) != row:
+                continue
+            if status == records.STATUS_CODES["Active"]:
+                del self.canteen_reservations[ct_id][id]
+                for mask_day, mask in capacity.span_masks(day, minute, duration):
+                    self.deleteReservationFromStudent(student_id, mask_day, mask)
+                key = (ct_id, day)
+                self.archived_counts[key] = self.archived_counts.get(key, 0) + 1
+            self.unindexReservation(student_id, records.STATUSES[status], records.index_key(day, minute, id))
+            self.reservations.archive(id)
+            archived.append(row)
+
+        self.reservations.compact()
+        return archived
+
+    # each status has its own sorted list, so a page is the merge of at
+    # most 'limit' keys from each list, whatever the number of reservations
+    def student_reservations_page(self, student_id: int, statuses: tuple, first_day: int, last_day: int, after: int, limit: int):
+        index = self.student_index.get(student_id, {})
+        low = records.index_key(first_day, 0, 0) if first_day is not None else 0
+        if after is not None:
+            low = max(low, after + 1)
+        high = records.index_key(last_day + 1, 0, 0) if last_day is not None else None
+
+        parts = []
+        for status in statuses:
+            keys = index.get(status, [])
+            start = bisect.bisect_left(keys, low)
+            end = bisect.bisect_left(keys, high) if high is not None else len(keys)
+            parts.append(keys[start:min(end, start + limit)])
+        keys = list(heapq.merge(*parts))[:limit]
+        return [self.reservations.get(records.key_id(key)) for key in keys]
+
+    def slot_count(self, ct_id: int, day: int, slot: int):
+        return self.canteen_capacities.get(ct_id, day, slot)
+
+    def canteen_day_counts(self, ct_id: int, first_day: int, last_day: int):
+        return self.canteen_capacities.days(ct_id)
+
+    def is_student_busy(self, student_id: int, day: int, mask: int):
+        return (self.student_reservations[student_id].get(day, 0) & mask) != 0
+
+    def canteen_version(self, ct_id: int):
+        return self.canteen_versions.get(ct_id, 0)
+
+    def bump_canteen_version(self, ct_id: int):
+        self.canteen_versions[ct_id] = self.canteen_version(ct_id) + 1
+        self.versions_total += 1
+
+    def canteens_version(self):
+        return self.canteen_list_version
+
+    def bump_canteens_version(self):
+        self.canteen_list_version += 1
+        self.versions_total += 1
+
+    def all_canteens_version(self):
+        return self.versions_total
+
+    def data_epoch(self):
+        return self.epoch
+
+    def sizes(self):
+        return {
+            "students": len(self.students),
+            "canteens": len(self.canteens),
+            "reservations": len(self.reservations),
+            "active_reservations": sum(len(ids) for ids in self.canteen_reservations.values()),
+            "canteen_capacity_days": sum(
+                len(days) for days in self.canteen_capacities.counters.values()),
+            "archived_canteen_days": len(self.archived_counts),
+        }
+
+    # the naming is a bit misleading, here we are just updating
+    # the number of reservations, not linking them with canteens
+    def addReservationToCanteen(self, ct_id: int, day: int, slot: int):
+        self.canteen_capacities.add(ct_id, day, slot)
+
+    # also a bit misleading
+    def deleteReservationFromCanteen(self, ct_id: int, day: int, slot: int):
+        if not (ct_id in self.canteen_capacities):
+            raise ValueError(
+                "There are no reservations in canteen with id {}".format(ct_id))
+        self.canteen_capacities.remove(ct_id, day, slot)
+
+    # note that the way I've designed this is that we only see
+    # time in increments of capacity.SLOT_MINUTES. so if a student
+    # will be in the canteen for longer than that, we have
+    # to update the next slots as well
+    def handleNewCanteenReservation(self, ct_id: int, r: reservation.Reservation):
+        for day, slot in capacity.reservation_slots(r.date, r.time, r.duration):
+            self.addReservationToCanteen(ct_id, day, slot)
+
+        self.canteen_reservations[ct_id][r.id] = None
+
+    def handleDeleteCanteenReservation(self, ct_id: int, r: reservation.Reservation):
+        for day, slot in capacity.reservation_slots(r.date, r.time, r.duration):
+            self.deleteReservationFromCanteen(ct_id, day, slot)
+
+        del self.canteen_reservations[ct_id][r.id]
+
+    # a bit misleading, we aren't linking the reservation to the
+    # student, we are just saying "this student has a reservation
+    # at this date and time"
+    def addReservationToStudent(self, student_id: int, day: int, mask: int):
+        if not (student_id in self.students):
+            raise ValueError(
+                "Student with id {} isn't stored in the db".format(student_id))
+        days = self.student_reservations[student_id]
+        days[day] = days.get(day, 0) | mask
+
+    def deleteReservationFromStudent(self, student_id: int, day: int, mask: int):
+        if not (student_id in self.students):
+            raise ValueError(
+                "Student with id {} isn't stored in the db".format(student_id))
+        days = self.student_reservations[student_id]
+        taken = days.get(day, 0)
+        if (taken & mask) != mask:
+            raise ValueError(
+                "Student with id {} doesn't have a reservation at {}|{:b}".format(
+                    student_id, day, mask))
+        taken &= ~mask
+        if taken:
+            days[day] = taken
+        else:
+            del days[day]
+
+    # a reservation takes up one mask per day it touches, whatever its duration
+    def handleNewStudentReservation(self, student_id: int, r: reservation.Reservation):
+        for day, mask in capacity.reservation_masks(r.date, r.time, r.duration):
+            self.addReservationToStudent(student_id, day, mask)
+
+    def handleDeleteStudentReservation(self, student_id: int, r: reservation.Reservation):
+        for day, mask in capacity.reservation_masks(r.date, r.time, r.duration):
+            self.deleteReservationFromStudent(student_id, day, mask)
@@ -0,0 +1,195 @@
+import argparse
+import datetime as dt
+import json
+import random
+import sys
+import time
+from models import database, sqlite_storage
+from perf import dataset
+
+
+# times the db operations the api is built on, straight on models.database.DB,
+# for data sets of growing size. every run starts from BASE and multiplies
+# one of its sizes at a time (students, canteens, reservations or days) by
+# each of the factors, so the cost of every operation can be read as a
+# function of each size on its own.
+#
+#   python -m perf.bench                         # every size, factors 1 2 4 8
+#   python -m perf.bench --axis reservations --factors 1,10,100
+#   python -m perf.bench --backend sqlite --json results.json
+
+BASE = {"students": 1000, "canteens": 10, "reservations": 10000, "days": 7}
+
+# how many times each operation is timed at most
+CALLS = {
+    "doesReservationOverlap": 2000,
+    "isCanteenFull": 2000,
+    "get_canteen_cap_status": 200,
+    "get_all_canteens_cap_status": 20,
+    "store_reservation": 2000,
+    "delete_canteen": 50,
+}
+
+
+def make_db(backend: str):
+    if backend == "sqlite":
+        return database.DB(sqlite_storage.SQLiteStorage(":memory:"))
+    return database.DB()
+
+
+# every benchmark returns the calls to time, given the filled db, what
+# dataset.generate returned and a seeded rng. the calls are timed in the
+# order of BENCHMARKS, which puts the ones changing the db last
+
+def bench_overlap(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    cts = [db.retrieve_canteen(id) for id in canteens]
+    probes = [dataset.random_reservation(students, cts, size["days"], rng)
+              for _ in range(CALLS["doesReservationOverlap"])]
+    return [lambda r=r: db.doesReservationOverlap(r) for r in probes]
+
+
+def bench_full(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    cts = [db.retrieve_canteen(id) for id in canteens]
+    probes = [dataset.random_reservation(students, cts, size["days"], rng)
+              for _ in range(CALLS["isCanteenFull"])]
+    return [lambda r=r: db.isCanteenFull(r) for r in probes]
+
+
+# the status cache is emptied before every call, so the status is
+# computed every time
+def bench_cap_status(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    def call(ct_id: int, day: dt.date):
+        db.status_cache.clear()
+        db.get_canteen_cap_status(ct_id, day, day, dt.time(6, 0), dt.time(22, 0), 30)
+
+    calls = []
+    for _ in range(CALLS["get_canteen_cap_status"]):
+        day = dataset.FIRST_DAY + dt.timedelta(days=rng.randrange(size["days"]))
+        calls.append(lambda ct_id=rng.choice(canteens), day=day: call(ct_id, day))
+    return calls
+
+
+def bench_all_cap_status(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    last_day = dataset.FIRST_DAY + dt.timedelta(days=size["days"] - 1)
+
+    def call():
+        db.status_cache.clear()
+        db.get_all_canteens_cap_status(
+            dataset.FIRST_DAY, last_day, dt.time(6, 0), dt.time(22, 0), 30)
+
+    return [call] * CALLS["get_all_canteens_cap_status"]
+
+
+# the reservations are picked like the generated ones, so some of them
+# are turned down, just like in the generator
+def bench_store(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    cts = [db.retrieve_canteen(id) for id in canteens]
+
+    def call(r):
+        try:
+            db.store_reservation(r)
+        except ValueError:
+            pass
+
+    probes = [dataset.random_reservation(students, cts, size["days"], rng)
+              for _ in range(CALLS["store_reservation"])]
+    return [lambda r=r: call(r) for r in probes]
+
+
+def bench_delete_canteen(db: database.DB, students: list, canteens: list, size: dict, rng: random.Random):
+    admin_id = students[0]
+    return [lambda ct_id=ct_id: db.delete_canteen(ct_id, admin_id)
+            for ct_id in canteens[:CALLS["delete_canteen"]]]
+
+
+BENCHMARKS = {
+    "doesReservationOverlap": bench_overlap,
+    "isCanteenFull": bench_full,
+    "get_canteen_cap_status": bench_cap_status,
+    "get_all_canteens_cap_status": bench_all_cap_status,
+    "store_reservation": bench_store,
+    "delete_canteen": bench_delete_canteen,
+}
+
+
+# times every call in 'calls', in microseconds
+def time_calls(calls: list):
+    timings = []
+    for call in calls:
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+# fills a new db with a data set of 'size' and times every benchmark on it.
+# returns one row per benchmark
+def run_size(size: dict, backend: str = "memory", seed: int = 0):
+    db = make_db(backend)
+    start = time.perf_counter()
+    students, canteens, stored = dataset.generate(
+        db, size["students"], size["canteens"], size["reservations"], size["days"], seed)
+    generated_in = time.perf_counter() - start
+
+    rng = random.Random(seed + 1)
+    rows = []
+    for name, bench in BENCHMARKS.items():
+        timings = sorted(time_calls(bench(db, students, canteens, size, rng)))
+        rows.append({
+            "operation": name,
+            "calls": len(timings),
+            "mean_us": round(sum(timings) / len(timings), 2) if timings else 0.0,
+            "p50_us": round(timings[len(timings) // 2], 2) if timings else 0.0,
+            "max_us": round(timings[-1], 2) if timings else 0.0,
+            "stored": stored,
+            "generated_s": round(generated_in, 3),
+            **size,
+        })
+    db.storage.close()
+    return rows
+
+
+def run(axes: list, factors: list, base: dict = BASE, backend: str = "memory", seed: int = 0):
+    rows = []
+    for axis in axes:
+        for factor in factors:
+            size = dict(base)
+            size[axis] = base[axis] * factor
+            for row in run_size(size, backend, seed):
+                rows.append({"axis": axis, "factor": factor, **row})
+    return rows
+
+
+def print_rows(rows: list):
+    print("{:<13} {:>6} {:>8} {:>8} {:>8} {:>5}  {:<28} {:>6} {:>11} {:>11} {:>11}".format(
+        "axis", "factor", "students", "canteens", "stored", "days",
+        "operation", "calls", "mean us", "p50 us", "max us"))
+    for row in rows:
+        print("{:<13} {:>6} {:>8} {:>8} {:>8} {:>5}  {:<28} {:>6} {:>11} {:>11} {:>11}".format(
+            row["axis"], row["factor"], row["students"], row["canteens"], row["stored"],
+            row["days"], row["operation"], row["calls"], row["mean_us"], row["p50_us"], row["max_us"]))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the canteen db")
+    parser.add_argument("--axis", choices=["all"] + list(BASE), default="all")
+    parser.add_argument("--factors", default="1,2,4,8",
+                        help="comma separated multiples of the base size")
+    parser.add_argument("--backend", choices=["memory", "sqlite"], default="memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    axes = list(BASE) if args.axis == "all" else [args.axis]
+    factors = [int(f) for f in args.factors.split(",")]
+    rows = run(axes, factors, BASE, args.backend, args.seed)
+    print_rows(rows)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
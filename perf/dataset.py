@@ -0,0 +1,88 @@
+import datetime as dt
+import random
+from models import database, student, canteen, reservation
+
+
+# far enough in the future that no reservation is ever in the past
+FIRST_DAY = dt.date(2099, 12, 1)
+
+# the working hours canteens get picked from. most serve all three meals,
+# some skip breakfast or dinner, and their hours differ a bit
+WORKING_HOURS = [
+    [("breakfast", "07:00", "10:00"), ("lunch", "11:00", "15:00"), ("dinner", "17:00", "20:00")],
+    [("breakfast", "07:30", "09:30"), ("lunch", "11:30", "14:30"), ("dinner", "18:00", "21:00")],
+    [("breakfast", "06:30", "10:00"), ("lunch", "12:00", "16:00"), ("dinner", "17:00", "19:30")],
+    [("lunch", "11:00", "15:00"), ("dinner", "17:00", "21:00")],
+    [("breakfast", "07:00", "10:00"), ("lunch", "11:00", "16:00")],
+]
+
+# about how many of the reservations go to each meal
+MEAL_WEIGHTS = {"breakfast": 2, "lunch": 5, "dinner": 3}
+
+
+def make_canteen(i: int, rng: random.Random):
+    hours = rng.choice(WORKING_HOURS)
+    return canteen.Canteen(
+        name="Canteen {}".format(i),
+        location="Location {}".format(i),
+        capacity=rng.randrange(50, 301),
+        workingHours=[canteen.Meal(meal=m, **{"from": f, "to": t}) for m, f, t in hours])
+
+
+# a reservation for a random student at a random canteen, day and time that
+# fits in one of the canteen's meals. the time is picked the way people
+# pick it: a meal first, then a slot inside it
+def random_reservation(student_ids: list, cts: list, days: int, rng: random.Random, first_day: dt.date = FIRST_DAY):
+    ct = rng.choice(cts)
+    meals = ct.workingHours
+    meal = rng.choices(meals, [MEAL_WEIGHTS.get(m.meal, 1) for m in meals])[0]
+    duration = rng.choice((30, 60))
+
+    start = meal.from_.hour * 60 + meal.from_.minute
+    end = meal.to.hour * 60 + meal.to.minute - duration
+    # start on a 30 minute boundary
+    start += -start % 30
+    minute = start + 30 * rng.randrange((end - start) // 30 + 1)
+
+    return reservation.Reservation(
+        canteenId=ct.id,
+        studentId=rng.choice(student_ids),
+        date=first_day + dt.timedelta(days=rng.randrange(days)),
+        time=dt.time(minute // 60, minute % 60),
+        duration=duration)
+
+
+# fills db with 'students' students (the first one an admin), 'canteens'
+# canteens and up to 'reservations' reservations spread over 'days' days
+# from FIRST_DAY, all picked by a random.Random(seed), so the same
+# arguments always give the same data. reservations the db turns down
+# (overlapping or over capacity) are tried again with a different pick,
+# at most 'reservations' more times in total.
+# returns (student ids, canteen ids, number of reservations stored)
+def generate(db: database.DB, students: int, canteens: int, reservations: int, days: int, seed: int = 0):
+    rng = random.Random(seed)
+
+    student_ids = []
+    for i in range(students):
+        s = student.Student(
+            name="Student {}".format(i), email="student{}@bench.com".format(i), isAdmin=i == 0)
+        db.store_student(s)
+        student_ids.append(s.id)
+
+    cts = []
+    for i in range(canteens):
+        ct = make_canteen(i, rng)
+        db.store_canteen(ct, student_ids[0])
+        cts.append(ct)
+
+    stored = 0
+    attempts = 0
+    while stored < reservations and attempts < 2 * reservations:
+        attempts += 1
+        try:
+            db.store_reservation(random_reservation(student_ids, cts, days, rng))
+            stored += 1
+        except ValueError:
+            pass
+
+    return student_ids, [ct.id for ct in cts], stored
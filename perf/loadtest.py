@@ -0,0 +1,312 @@
+import argparse
+import asyncio
+import datetime as dt
+import json
+import os
+import random
+import sys
+import time
+
+# logging every request would measure the log queue as much as the app
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import httpx
+import handlers
+
+
+# drives handlers.app in this process through httpx's ASGI transport (so no
+# server or network is involved) with a few realistic scenarios, and
+# reports the throughput and latency percentiles of every route.
+#
+#   python -m perf.loadtest                       # run and compare to the baselines
+#   python -m perf.loadtest lunch_rush --scale 2  # one scenario, twice the load
+#   python -m perf.loadtest --update-baselines    # store this run as the baselines
+#
+# exits with 1 if any route got slower than its baseline by more than
+# --tolerance, or answered with a 500
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# far enough in the future that no reservation is ever in the past
+FIRST_DAY = dt.date(2099, 12, 1)
+
+WORKING_HOURS = [
+    {"meal": "breakfast", "from": "07:00", "to": "10:00"},
+    {"meal": "lunch", "from": "11:00", "to": "15:00"},
+    {"meal": "dinner", "from": "17:00", "to": "20:00"},
+]
+LUNCH_TIMES = ["11:00", "11:30", "12:00", "12:30", "13:00", "13:30", "14:00"]
+DINNER_TIMES = ["17:00", "17:30", "18:00", "18:30", "19:00"]
+
+
+# value below which 'p' percent of 'values' (sorted) fall, nearest rank
+def percentile(values: list, p: float):
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, int(round(p / 100 * len(values) + 0.5)) - 1))
+    return values[rank]
+
+
+# collects how long each request took and what it answered, per route.
+# 'route' is the route's template (e.g. "DELETE /reservations/{id}"), so
+# requests to different ids end up together
+class Recorder:
+    latencies: dict
+    statuses: dict
+    started: float
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.started = time.perf_counter()
+
+    # called once the scenario is set up, so setting it up isn't measured
+    def start(self):
+        self.latencies.clear()
+        self.statuses.clear()
+        self.started = time.perf_counter()
+
+    async def request(self, client: httpx.AsyncClient, route: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies.setdefault(route, []).append(time.perf_counter() - start)
+        counts = self.statuses.setdefault(route, {})
+        counts[response.status_code] = counts.get(response.status_code, 0) + 1
+        return response
+
+    # throughput in requests per second, latencies in milliseconds
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            routes[route] = {
+                "requests": len(latencies),
+                "throughput": round(len(latencies) / elapsed, 1),
+                "p50": round(percentile(latencies, 50) * 1000, 3),
+                "p95": round(percentile(latencies, 95) * 1000, 3),
+                "p99": round(percentile(latencies, 99) * 1000, 3),
+                "statuses": {str(s): n for s, n in sorted(self.statuses[route].items())},
+            }
+        return {"seconds": round(elapsed, 3), "routes": routes}
+
+
+# runs 'count' calls of 'job' (an async function taking the call's number)
+# with at most 'concurrency' of them in flight at once
+async def run_jobs(job, count: int, concurrency: int):
+    numbers = iter(range(count))
+
+    async def worker():
+        for i in numbers:
+            await job(i)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def create_students(client: httpx.AsyncClient, count: int, admin: bool = False):
+    ids = []
+    for i in range(count):
+        response = await client.post("/students", json={
+            "name": "Student {}".format(i),
+            "email": "{}{}@loadtest.com".format("admin" if admin else "student", i),
+            "isAdmin": admin,
+        })
+        ids.append(response.json()["id"])
+    return ids
+
+
+async def create_canteens(client: httpx.AsyncClient, admin_id: int, count: int, capacity: int):
+    ids = []
+    for i in range(count):
+        response = await client.post("/canteens", headers={"studentId": str(admin_id)}, json={
+            "name": "Canteen {}".format(i),
+            "location": "Location {}".format(i),
+            "capacity": capacity,
+            "workingHours": WORKING_HOURS,
+        })
+        ids.append(response.json()["id"])
+    return ids
+
+
+def reservation_json(student_id: int, ct_id: int, day: dt.date, time: str, duration: int):
+    return {
+        "studentId": student_id,
+        "canteenId": ct_id,
+        "date": day.isoformat(),
+        "time": time,
+        "duration": duration,
+    }
+
+
+# every student tries to get a lunch spot at the same canteen on the same
+# day. the canteen runs out of room long before they're done, so most of
+# the later requests are turned down
+async def lunch_rush(client: httpx.AsyncClient, rec: Recorder, rng: random.Random, scale: float, concurrency: int):
+    [admin_id] = await create_students(client, 1, admin=True)
+    [ct_id] = await create_canteens(client, admin_id, 1, capacity=max(1, int(150 * scale)))
+    students = await create_students(client, max(1, int(2000 * scale)))
+    rec.start()
+
+    async def job(i: int):
+        await rec.request(client, "POST /reservations", "POST", "/reservations", json=reservation_json(
+            students[i], ct_id, FIRST_DAY, rng.choice(LUNCH_TIMES), rng.choice((30, 60))))
+
+    await run_jobs(job, len(students), concurrency)
+
+
+# students across several canteens and days keep booking and cancelling,
+# roughly three bookings for every two cancellations
+async def churn(client: httpx.AsyncClient, rec: Recorder, rng: random.Random, scale: float, concurrency: int):
+    [admin_id] = await create_students(client, 1, admin=True)
+    canteens = await create_canteens(client, admin_id, 10, capacity=50)
+    students = await create_students(client, max(1, int(1000 * scale)))
+    booked = {s: [] for s in students}
+    rec.start()
+
+    async def job(i: int):
+        s = rng.choice(students)
+        if booked[s] and rng.random() < 0.4:
+            r_id = booked[s].pop(rng.randrange(len(booked[s])))
+            await rec.request(client, "DELETE /reservations/{id}", "DELETE",
+                              "/reservations/{}".format(r_id), headers={"studentId": str(s)})
+            return
+
+        day = FIRST_DAY + dt.timedelta(days=rng.randrange(5))
+        response = await rec.request(client, "POST /reservations", "POST", "/reservations", json=reservation_json(
+            s, rng.choice(canteens), day, rng.choice(LUNCH_TIMES + DINNER_TIMES), rng.choice((30, 60))))
+        if response.status_code == 201:
+            booked[s].append(response.json()["id"])
+
+    await run_jobs(job, max(1, int(4000 * scale)), concurrency)
+
+
+# clients asking for the free spots of every canteen over a week, and of
+# single canteens over a day, for weeks that partly overlap. a few bookings
+# land in between, so cached statuses keep getting invalidated
+async def status_scan(client: httpx.AsyncClient, rec: Recorder, rng: random.Random, scale: float, concurrency: int):
+    [admin_id] = await create_students(client, 1, admin=True)
+    canteens = await create_canteens(client, admin_id, 20, capacity=30)
+    students = await create_students(client, 300)
+    for s in students:
+        day = FIRST_DAY + dt.timedelta(days=rng.randrange(14))
+        await client.post("/reservations", json=reservation_json(
+            s, rng.choice(canteens), day, rng.choice(LUNCH_TIMES), 30))
+    rec.start()
+
+    async def job(i: int):
+        start = FIRST_DAY + dt.timedelta(days=rng.randrange(14))
+        if i % 10 == 0:
+            await rec.request(client, "POST /reservations", "POST", "/reservations", json=reservation_json(
+                rng.choice(students), rng.choice(canteens), start, rng.choice(DINNER_TIMES), 30))
+        elif i % 3 == 0:
+            await rec.request(
+                client, "GET /canteens/{id}/status", "GET",
+                "/canteens/{}/status".format(rng.choice(canteens)), params={
+                    "startDate": start.isoformat(), "endDate": start.isoformat(),
+                    "startTime": "07:00", "endTime": "20:00", "duration": 30})
+        else:
+            await rec.request(client, "GET /canteens/status", "GET", "/canteens/status", params={
+                "startDate": start.isoformat(),
+                "endDate": (start + dt.timedelta(days=6)).isoformat(),
+                "startTime": "07:00", "endTime": "20:00", "duration": 30})
+
+    await run_jobs(job, max(1, int(300 * scale)), concurrency)
+
+
+SCENARIOS = {
+    "lunch_rush": lunch_rush,
+    "churn": churn,
+    "status_scan": status_scan,
+}
+
+
+async def run_scenario(name: str, scale: float = 1.0, concurrency: int = 32, seed: int = 0):
+    handlers.db.__init__()
+    rec = Recorder()
+    transport = httpx.ASGITransport(app=handlers.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://loadtest") as client:
+        await SCENARIOS[name](client, rec, random.Random(seed), scale, concurrency)
+        return rec.report()
+
+
+def run(names: list, scale: float = 1.0, concurrency: int = 32, seed: int = 0):
+    return {name: asyncio.run(run_scenario(name, scale, concurrency, seed)) for name in names}
+
+
+# returns a description of every way 'results' is worse than 'baselines':
+# a route answering with a 500, a latency percentile above its baseline by
+# more than 'tolerance' (0.5 meaning 50%) or a throughput below it by as much
+def compare(results: dict, baselines: dict, tolerance: float):
+    regressions = []
+    for name, result in results.items():
+        for route, stats in result["routes"].items():
+            if "500" in stats["statuses"]:
+                regressions.append("{} {}: {} requests failed with a 500".format(
+                    name, route, stats["statuses"]["500"]))
+
+            base = baselines.get(name, {}).get("routes", {}).get(route)
+            if base is None:
+                continue
+            for p in ("p50", "p95", "p99"):
+                if stats[p] > base[p] * (1 + tolerance):
+                    regressions.append("{} {}: {} is {}ms, the baseline is {}ms".format(
+                        name, route, p, stats[p], base[p]))
+            if stats["throughput"] * (1 + tolerance) < base["throughput"]:
+                regressions.append("{} {}: throughput is {}/s, the baseline is {}/s".format(
+                    name, route, stats["throughput"], base["throughput"]))
+    return regressions
+
+
+def print_results(results: dict):
+    print("{:<12} {:<28} {:>8} {:>10} {:>9} {:>9} {:>9}  {}".format(
+        "scenario", "route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "statuses"))
+    for name, result in results.items():
+        for route, stats in result["routes"].items():
+            print("{:<12} {:<28} {:>8} {:>10} {:>9} {:>9} {:>9}  {}".format(
+                name, route, stats["requests"], stats["throughput"],
+                stats["p50"], stats["p95"], stats["p99"], stats["statuses"]))
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="In-process load test of the canteen API")
+    parser.add_argument("scenarios", nargs="*", metavar="scenario",
+                        help="any of {} (all of them by default)".format(", ".join(SCENARIOS)))
+    parser.add_argument("--scale", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.5)
+    parser.add_argument("--baselines", default=BASELINES_PATH)
+    parser.add_argument("--update-baselines", action="store_true")
+    args = parser.parse_args(argv)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario {}".format(name))
+
+    results = run(args.scenarios or list(SCENARIOS), args.scale, args.concurrency, args.seed)
+    print_results(results)
+
+    if args.update_baselines:
+        baselines = {}
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as f:
+                baselines = json.load(f)
+        baselines.update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print("Baselines written to {}".format(args.baselines))
+        return 0
+
+    if not os.path.exists(args.baselines):
+        print("No baselines at {}, nothing to compare to".format(args.baselines))
+        return 0
+    with open(args.baselines) as f:
+        baselines = json.load(f)
+    regressions = compare(results, baselines, args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,581 @@
+from fastapi import FastAPI, Request, Response, status
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import argparse
+import asyncio
+import datetime as dt
+import heapq
+import json
+import logging
+import os
+import subprocess
+import sys
+import httpx
+import uvicorn
+from models import sharding, idempotency, logs, metrics
+
+
+# sharded mode: the canteens (with their capacity and reservations) are
+# split over several shards, every one of them a worker process running
+# the usual app (handlers.py) with its own memory. this app is the router
+# in front of them: requests about one canteen or reservation go to the
+# shard that owns it, and lists and statuses are asked of every shard and
+# merged. see models/sharding.py for how ids are split and kept apart.
+#
+# what has to hold over all shards is kept right by the router:
+#   - students are stored in every shard, one student at a time: shard 0
+#     checks the email and picks the id, the others store them under it
+#   - canteen names and locations are checked against every shard
+#   - a student's reservations at canteens of different shards can't
+#     overlap: the router keeps the slots every student is busy in
+#   - a reservation batch must stay in one shard, to be all or nothing
+#
+#   python -m router --shards 4 --port 8000    # starts the shards too
+#   SHARD_URLS=http://127.0.0.1:8101,http://127.0.0.1:8102 uvicorn router:app
+
+# see handlers.py
+log_listener = logs.setup(
+    os.environ.get("LOG_LEVEL", "INFO"),
+    float(os.environ.get("LOG_SAMPLE_RATE", "1")))
+log = logs.get_logger("router")
+
+# headers that are about one connection, not the request
+HOP_HEADERS = {"host", "content-length", "connection", "keep-alive", "transfer-encoding", "accept-encoding"}
+# headers of a shard's response that are passed on
+PASSED_HEADERS = ("content-type", "etag", "retry-after", "vary")
+
+INVALID = {"detail": "Invalid input"}
+NOT_FOUND = {"detail": "Not found"}
+
+
+class Router:
+    shards: list
+    map: sharding.ShardMap
+    slots: sharding.StudentSlots
+    # student id -> task loading the student's reservations into slots
+    loading: dict
+    # retried POSTs are answered by the router, so a retried reservation
+    # isn't turned down as overlapping itself
+    idempotent: idempotency.IdempotencyStore
+
+    def __init__(self, shards: list):
+        self.shards = shards
+        self.map = sharding.ShardMap(len(shards))
+        self.slots = sharding.StudentSlots()
+        self.loading = {}
+        self.idempotent = idempotency.IdempotencyStore()
+        # students are stored, and canteens named, one at a time
+        self.students_lock = asyncio.Lock()
+        self.canteens_lock = asyncio.Lock()
+
+    async def close(self):
+        for shard in self.shards:
+            await shard.aclose()
+
+    # sends 'request' on to 'shard', with another path, query or body if
+    # given. with 'stream' the body of the response is left to be read
+    # (and the response to be closed) by the caller
+    async def forward(self, shard: int, request: Request, path: str = None, params=None, body: bytes = None,
+                      stream: bool = False):
+        headers = [(k, v) for k, v in request.headers.items() if k not in HOP_HEADERS]
+        client = self.shards[shard]
+        return await client.send(client.build_request(
+            request.method, path if path is not None else request.url.path,
+            params=params if params is not None else request.query_params,
+            headers=headers, content=body if body is not None else await request.body()), stream=stream)
+
+    # sends 'request' on to every shard at once
+    async def forward_all(self, request: Request, **kwargs):
+        return await asyncio.gather(*(
+            self.forward(shard, request, **kwargs) for shard in range(len(self.shards))))
+
+    # copies student 'item' (as shard 0 returned it) to 'shard', copying
+    # the students before it first if the shard missed them (like when it
+    # couldn't be reached). returns whether the shard has it now
+    async def copy_student(self, shard: int, item: dict):
+        client = self.shards[shard]
+        try:
+            missing = [item]
+            # the students are copied in order, so the shard has every
+            # student up to the last one it has
+            id = item["id"] - 1
+            while id > 0 and (await client.get("/students/{}".format(id))).status_code != status.HTTP_200_OK:
+                r = await self.shards[0].get("/students/{}".format(id))
+                if r.status_code != status.HTTP_200_OK:
+                    return False
+                missing.append(r.json())
+                id -= 1
+
+            for s in reversed(missing):
+                r = await client.put("/students/{}".format(s["id"]), json=s)
+                if r.status_code not in (status.HTTP_200_OK, status.HTTP_201_CREATED):
+                    return False
+        except httpx.HTTPError:
+            return False
+        return True
+
+    # every canteen of every shard, with global ids, sorted by id
+    async def all_canteens(self):
+        responses = await asyncio.gather(*(s.get("/canteens") for s in self.shards))
+        return sorted(
+            (self.map.canteen_out(ct, shard) for shard, r in enumerate(responses) for ct in r.json()),
+            key=lambda ct: ct["id"])
+
+    # loads the reservations of a student from every shard into slots, the
+    # first time they're needed. the ones that are over can't overlap new
+    # ones, so only those from yesterday (which could last past midnight)
+    # on are loaded
+    async def load_student(self, student_id: int):
+        if self.slots.is_loaded(student_id):
+            return
+        task = self.loading.get(student_id)
+        if task is None:
+            task = asyncio.ensure_future(self.fetch_student(student_id))
+            self.loading[student_id] = task
+            task.add_done_callback(lambda _: self.loading.pop(student_id, None))
+        await asyncio.shield(task)
+
+    async def fetch_student(self, student_id: int):
+        since = (dt.date.today() - dt.timedelta(days=1)).isoformat()
+        masks = []
+
+        async def fetch(shard):
+            params = {"status": "Active", "fromDate": since, "limit": 100}
+            while True:
+                r = await shard.get("/students/{}/reservations".format(student_id), params=params)
+                if r.status_code != status.HTTP_200_OK:
+                    return
+                page = r.json()
+                for item in page["reservations"]:
+                    masks.extend(sharding.reservation_masks(item))
+                if page["nextCursor"] is None:
+                    return
+                params["cursor"] = page["nextCursor"]
+
+        await asyncio.gather(*(fetch(shard) for shard in self.shards))
+        self.slots.load(student_id, masks)
+
+
+# a shard's response as the router's. 'out' turns its json into the
+# router's (see sharding.ShardMap), for the successful responses
+def relay(r: httpx.Response, out=None):
+    headers = {k: r.headers[k] for k in PASSED_HEADERS if k in r.headers}
+    if out is not None and r.status_code < 300:
+        headers.pop("content-type", None)
+        return JSONResponse(out(r.json()), status_code=r.status_code, headers=headers)
+    return Response(r.content, status_code=r.status_code, headers=headers)
+
+
+# the first of 'responses' that isn't a 200, None if they all are
+def first_failure(responses: list):
+    return next((r for r in responses if r.status_code != status.HTTP_200_OK), None)
+
+
+# heapq.merge of async iterators: the items of 'sources', each sorted by
+# 'key', in order, reading the next item of a source only once its last
+# one was yielded
+async def merge_sorted(sources: list, key):
+    heap = []
+    for i, source in enumerate(sources):
+        item = await anext(source, None)
+        if item is not None:
+            heap.append((key(item), i, item))
+    heapq.heapify(heap)
+    while heap:
+        _, i, item = heap[0]
+        yield item
+        item = await anext(sources[i], None)
+        if item is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(item), i, item))
+
+
+def parse_id(text: str):
+    return int(text) if text.isdigit() and int(text) > 0 else None
+
+
+def create_app(shards: list):
+    router = Router(shards)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        yield
+        await router.close()
+        logs.shutdown(log_listener)
+
+    app = FastAPI(lifespan=lifespan)
+    app.state.router = router
+    shard_map = router.map
+
+    @app.exception_handler(httpx.HTTPError)
+    async def handle_shard_error(request: Request, e: httpx.HTTPError):
+        log.warning("A shard couldn't be reached: %s", e)
+        return JSONResponse({"detail": "Shard unavailable"}, status_code=status.HTTP_502_BAD_GATEWAY)
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def handle_metrics():
+        return PlainTextResponse(
+            metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+    @app.get("/")
+    async def home(request: Request):
+        return relay(await router.forward(0, request))
+
+    # stored in shard 0, which decides whether the email is taken and picks
+    # the id, then copied to the others under that id. a shard that can't
+    # take it is caught up with the next student, so the student is stored
+    # once shard 0 has it
+    @app.post("/students")
+    async def handle_post_students(request: Request):
+        async def store():
+            async with router.students_lock:
+                first = await router.forward(0, request)
+                if first.status_code != status.HTTP_201_CREATED or len(shards) == 1:
+                    return first
+                copied = await asyncio.gather(*(
+                    router.copy_student(shard, first.json()) for shard in range(1, len(shards))))
+                if not all(copied):
+                    logs.event(log, logging.ERROR, "student_replication_failed", id=first.json()["id"],
+                               shards=[shard for shard, ok in enumerate(copied, 1) if not ok])
+                return first
+
+        return await idempotent_post(request, "students", store)
+
+    # answers a POST by running 'store' (which returns a shard's response),
+    # once per Idempotency-Key if the request has one
+    async def idempotent_post(request: Request, route: str, store):
+        key = request.headers.get("idempotency-key")
+        if key is None:
+            return relay(await store())
+
+        async def action():
+            r = await store()
+            if r.status_code >= 300:
+                # not remembered, see idempotency.IdempotencyStore
+                raise ShardRejected(r)
+            return r.status_code, r.json()
+
+        try:
+            code, content = await router.idempotent.run((route, key), await request.body(), action)
+        except ShardRejected as e:
+            return relay(e.response)
+        except ValueError:
+            return JSONResponse(INVALID, status_code=418)
+        return JSONResponse(content, status_code=code)
+
+    @app.get("/students/{id}")
+    async def handle_get_students(request: Request):
+        return relay(await router.forward(0, request))
+
+    # every shard's page after the cursor, merged and cut down to 'limit'
+    @app.get("/students/{id}/reservations")
+    async def handle_get_student_reservations(request: Request, id: str):
+        params = dict(request.query_params)
+        cursor = params.pop("cursor", None)
+        limit = params.get("limit", "50")
+        if (cursor is not None and not cursor.isdigit()) or not limit.isdigit():
+            return JSONResponse(INVALID, status_code=418)
+
+        def shard_params(shard):
+            if cursor is None:
+                return params
+            return {**params, "cursor": str(shard_map.local_key(int(cursor), shard))}
+
+        responses = await asyncio.gather(*(
+            router.forward(shard, request, params=shard_params(shard)) for shard in range(len(shards))))
+        failure = first_failure(responses)
+        if failure is not None:
+            return relay(failure)
+
+        pages = [r.json() for r in responses]
+        merged = list(heapq.merge(
+            *([shard_map.reservation_out(item, shard) for item in page["reservations"]]
+              for shard, page in enumerate(pages)),
+            key=sharding.reservation_key))
+        page = merged[:int(limit)]
+        more = len(merged) > len(page) or any(p["nextCursor"] is not None for p in pages)
+        next_cursor = str(sharding.reservation_key(page[-1])) if more and page else None
+        return JSONResponse({"reservations": page, "nextCursor": next_cursor})
+
+    # every shard's statuses are sorted by canteen, and so by global id too
+    @app.get("/canteens/status")
+    async def handle_canteens_status(request: Request):
+        if "application/x-ndjson" in request.headers.get("accept", ""):
+            return await stream_canteens_status(request)
+
+        responses = await router.forward_all(request)
+        failure = first_failure(responses)
+        if failure is not None:
+            return relay(failure)
+        return JSONResponse(list(heapq.merge(
+            *([shard_map.canteen_ref_out(item, shard) for item in r.json()]
+              for shard, r in enumerate(responses)),
+            key=lambda item: item["canteenId"])))
+
+    # the lines of every shard merged as they come in, so the router holds
+    # no more than a line of each shard at a time
+    async def stream_canteens_status(request: Request):
+        opened = await asyncio.gather(*(
+            router.forward(shard, request, stream=True) for shard in range(len(shards))),
+            return_exceptions=True)
+        responses = [r for r in opened if isinstance(r, httpx.Response)]
+        error = next((e for e in opened if isinstance(e, BaseException)), None)
+        failure = first_failure(responses) if error is None else None
+        if error is not None or failure is not None:
+            if failure is not None:
+                await failure.aread()
+            for r in responses:
+                await r.aclose()
+            if error is not None:
+                raise error
+            return relay(failure)
+
+        async def shard_lines(shard: int, r: httpx.Response):
+            async for line in r.aiter_lines():
+                if line:
+                    yield shard_map.canteen_ref_out(json.loads(line), shard)
+
+        async def body():
+            try:
+                async for item in merge_sorted(
+                        [shard_lines(shard, r) for shard, r in enumerate(responses)],
+                        key=lambda item: item["canteenId"]):
+                    yield json.dumps(item, separators=(",", ":")) + "\n"
+            finally:
+                for r in responses:
+                    await r.aclose()
+
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+
+    @app.get("/availability")
+    async def handle_availability(request: Request):
+        limit = request.query_params.get("limit", "10")
+        if not limit.isdigit():
+            return JSONResponse(INVALID, status_code=418)
+        responses = await router.forward_all(request)
+        failure = first_failure(responses)
+        if failure is not None:
+            return relay(failure)
+        merged = heapq.merge(
+            *([shard_map.canteen_ref_out(item, shard) for item in r.json()]
+              for shard, r in enumerate(responses)),
+            key=lambda item: (item["date"], item["startTime"], item["canteenId"]))
+        return JSONResponse([item for _, item in zip(range(int(limit)), merged)])
+
+    # goes to the shard with the fewest canteens, once no shard has one
+    # with the same name or location
+    @app.post("/canteens")
+    async def handle_post_canteens(request: Request):
+        try:
+            body = json.loads(await request.body())
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            return relay(await router.forward(0, request))
+
+        async with router.canteens_lock:
+            canteens = await router.all_canteens()
+            if any(ct["name"] == body.get("name") or ct["location"] == body.get("location")
+                   for ct in canteens):
+                return JSONResponse(INVALID, status_code=418)
+            counts = [0] * len(shards)
+            for ct in canteens:
+                counts[shard_map.shard_of(ct["id"])] += 1
+            shard = counts.index(min(counts))
+            r = await router.forward(shard, request)
+        return relay(r, lambda ct: shard_map.canteen_out(ct, shard))
+
+    @app.get("/canteens")
+    async def handle_get_canteens():
+        return JSONResponse(await router.all_canteens())
+
+    @app.get("/canteens/{id}")
+    async def handle_get_canteen(request: Request, id: str):
+        ct_id = parse_id(id)
+        if ct_id is None:
+            return JSONResponse(NOT_FOUND, status_code=404)
+        shard = shard_map.shard_of(ct_id)
+        r = await router.forward(shard, request, path="/canteens/{}".format(shard_map.to_local(ct_id)))
+        return relay(r, lambda ct: shard_map.canteen_out(ct, shard))
+
+    @app.get("/canteens/{id}/status")
+    async def handle_canteen_status(request: Request, id: str):
+        ct_id = parse_id(id)
+        if ct_id is None:
+            return JSONResponse(INVALID, status_code=418)
+        shard = shard_map.shard_of(ct_id)
+        r = await router.forward(shard, request, path="/canteens/{}/status".format(shard_map.to_local(ct_id)))
+        return relay(r, lambda item: shard_map.canteen_ref_out(item, shard))
+
+    @app.put("/canteens/{id}")
+    async def handle_put_canteen(request: Request, id: str):
+        ct_id = parse_id(id)
+        if ct_id is None:
+            return JSONResponse(NOT_FOUND, status_code=404)
+        try:
+            body = json.loads(await request.body())
+        except ValueError:
+            body = None
+        shard = shard_map.shard_of(ct_id)
+        path = "/canteens/{}".format(shard_map.to_local(ct_id))
+
+        async with router.canteens_lock:
+            if isinstance(body, dict) and ("name" in body or "location" in body):
+                for ct in await router.all_canteens():
+                    if ct["id"] != ct_id and (ct["name"] == body.get("name") or ct["location"] == body.get("location")):
+                        return JSONResponse(INVALID, status_code=418)
+            r = await router.forward(shard, request, path=path)
+        return relay(r, lambda ct: shard_map.canteen_out(ct, shard))
+
+    # the shard cancels the canteen's reservations by itself
+    @app.delete("/canteens/{id}")
+    async def handle_delete_canteen(request: Request, id: str):
+        ct_id = parse_id(id)
+        if ct_id is None:
+            return JSONResponse(INVALID, status_code=418)
+        r = await router.forward(
+            shard_map.shard_of(ct_id), request, path="/canteens/{}".format(shard_map.to_local(ct_id)))
+        if r.status_code < 300:
+            router.slots.forget()
+        return relay(r)
+
+    # checked against the slots the student is busy in at every shard
+    # before it's sent to the shard of its canteen
+    @app.post("/reservations")
+    async def handle_post_reservations(request: Request):
+        try:
+            body = json.loads(await request.body())
+            ct_id = int(body["canteenId"])
+            student_id = int(body["studentId"])
+            masks = sharding.reservation_masks(body)
+        except (ValueError, KeyError, TypeError):
+            # the shard tells what's wrong with it
+            return relay(await router.forward(0, request))
+        if ct_id < 1:
+            return JSONResponse(INVALID, status_code=418)
+        shard = shard_map.shard_of(ct_id)
+        body["canteenId"] = shard_map.to_local(ct_id)
+
+        async def store():
+            return await reserve(request, shard, [(student_id, masks)], json.dumps(body).encode(), "/reservations")
+
+        r = await idempotent_post(request, "reservations", store)
+        if r.status_code < 300:
+            content = shard_map.reservation_out(json.loads(r.body), shard)
+            return JSONResponse(content, status_code=r.status_code)
+        return r
+
+    # sends reservations (as 'body') to 'shard', holding the slots of the
+    # students ('spans' of (student id, masks)) until it answers
+    async def reserve(request: Request, shard: int, spans: list, body: bytes, path: str):
+        for student_id in {student_id for student_id, _ in spans}:
+            await router.load_student(student_id)
+        held = []
+        try:
+            for student_id, masks in spans:
+                if router.slots.overlaps(student_id, masks):
+                    metrics.RESERVATION_REJECTIONS.inc("overlap")
+                    return httpx.Response(418, json=INVALID)
+                router.slots.hold(student_id, masks)
+                held.append((student_id, masks))
+            r = await router.forward(shard, request, path=path, body=body)
+        except BaseException:
+            for student_id, masks in held:
+                router.slots.release(student_id, masks)
+            raise
+
+        for student_id, masks in held:
+            if r.status_code < 300:
+                router.slots.commit(student_id, masks)
+            else:
+                router.slots.release(student_id, masks)
+        return r
+
+    @app.post("/reservations/batch")
+    async def handle_post_reservations_batch(request: Request):
+        try:
+            body = json.loads(await request.body())
+            spans = [(int(r["studentId"]), sharding.reservation_masks(r)) for r in body]
+            ct_ids = {int(r["canteenId"]) for r in body}
+        except (ValueError, KeyError, TypeError):
+            return relay(await router.forward(0, request))
+        if not body:
+            return relay(await router.forward(0, request))
+        if min(ct_ids) < 1 or len({shard_map.shard_of(ct_id) for ct_id in ct_ids}) > 1:
+            return JSONResponse({"detail": "A batch can only hold canteens of one shard"}, status_code=418)
+
+        shard = shard_map.shard_of(int(body[0]["canteenId"]))
+        for r in body:
+            r["canteenId"] = shard_map.to_local(int(r["canteenId"]))
+        r = await reserve(request, shard, spans, json.dumps(body).encode(), "/reservations/batch")
+        return relay(r, lambda rs: [shard_map.reservation_out(item, shard) for item in rs])
+
+    @app.delete("/reservations/{id}")
+    async def handle_delete_reservations(request: Request, id: str):
+        r_id = parse_id(id)
+        if r_id is None:
+            return JSONResponse(INVALID, status_code=418)
+        shard = shard_map.shard_of(r_id)
+        r = await router.forward(shard, request, path="/reservations/{}".format(shard_map.to_local(r_id)))
+        if r.status_code < 300:
+            cancelled = r.json()
+            router.slots.cancel(cancelled["studentId"], sharding.reservation_masks(cancelled))
+        return relay(r, lambda item: shard_map.reservation_out(item, shard))
+
+    return app
+
+
+# a shard turned the request down, see idempotent_post
+class ShardRejected(Exception):
+    def __init__(self, response: httpx.Response):
+        super().__init__(response.status_code)
+        self.response = response
+
+
+def shard_clients(urls: list):
+    return [httpx.AsyncClient(base_url=url, timeout=30.0) for url in urls]
+
+
+app = create_app(shard_clients(
+    [url.strip() for url in os.environ.get("SHARD_URLS", "http://127.0.0.1:8101").split(",") if url.strip()]))
+
+
+# starts 'shards' shard processes on the ports from 'first_port' on, and
+# the router in front of them. with a data dir, every shard keeps its data
+# in a directory of its own in it (see handlers.py, DB_DATA_DIR)
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Runs the canteens api sharded by canteen")
+    parser.add_argument("--shards", type=int, default=2)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--first-port", type=int, default=8101)
+    parser.add_argument("--data-dir", help="keep the data of the shards in this directory")
+    args = parser.parse_args(argv)
+    if args.shards < 1:
+        parser.error("--shards must be at least 1")
+
+    processes = []
+    urls = []
+    for shard in range(args.shards):
+        port = args.first_port + shard
+        env = dict(os.environ, DB_BACKEND="memory", WEB_CONCURRENCY="1")
+        if args.data_dir:
+            env["DB_DATA_DIR"] = os.path.join(args.data_dir, "shard{}".format(shard))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "handlers:app", "--host", "127.0.0.1", "--port", str(port)],
+            env=env))
+        urls.append("http://127.0.0.1:{}".format(port))
+
+    try:
+        uvicorn.run(create_app(shard_clients(urls)), host=args.host, port=args.port)
+    finally:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.wait()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
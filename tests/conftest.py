@@ -1,23 +1,13 @@
 import pytest
 from fastapi.testclient import TestClient
-from handlers import app, db
+from handlers import app, db, idempotent
 
 
 @pytest.fixture(autouse=True)
 def reset_db():
     """Reset the database before each test"""
-    db.students = {}
-    db.canteens = {}
-    db.reservations = {}
-    db.canteen_capacities = {}
-    db.canteen_reservations = {}
-    db.student_reservations = {}
-    db.next_student_id = 1
-    db.next_canteen_id = 1
-    db.next_reservation_id = 1
-    db.emails = set()
-    db.canteen_locations = set()
-    db.canteen_names = set()
+    db.__init__()
+    idempotent.clear()
     yield
 
 
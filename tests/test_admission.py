@@ -0,0 +1,115 @@
+import asyncio
+import httpx
+import handlers
+from models import admission, metrics
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket_refills():
+    """Test that a bucket lets a burst through, then one request per token"""
+    bucket = admission.TokenBucket(rate=2, burst=3, now=0.0)
+    assert [bucket.take(0.0) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take(0.0) == 0.5
+    assert bucket.take(0.5) == 0.0
+    # never more than the burst
+    assert [bucket.take(100.0) for _ in range(4)][-1] > 0
+
+
+def test_misbehaving_student_is_shed(client, regular_student, sample_canteen, monkeypatch):
+    """Test that a student over their rate gets 429s while others are let in"""
+    clock = Clock()
+    monkeypatch.setattr(handlers, "admitter", admission.Admission(client_rate=1, client_burst=2, clock=clock))
+    shed = metrics.ADMISSION_SHED.get("client", "write")
+
+    def reserve(student_id, t):
+        return client.post("/reservations", json={
+            "studentId": student_id,
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": t,
+            "duration": 15
+        })
+
+    assert reserve(regular_student["id"], "12:00").status_code == 201
+    assert reserve(regular_student["id"], "12:15").status_code == 201
+    response = reserve(regular_student["id"], "12:30")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    assert metrics.ADMISSION_SHED.get("client", "write") == shed + 1
+
+    # other students and other route classes have buckets of their own
+    assert reserve(sample_canteen["id"] + 100, "12:30").status_code == 418
+    assert client.get("/canteens").status_code == 200
+
+    clock.now += 1
+    assert reserve(regular_student["id"], "12:30").status_code == 201
+
+
+def test_status_queries_are_capped():
+    """Test that status queries over the concurrency limit are turned away"""
+    limits = admission.Admission(status_concurrency=1)
+    assert limits.admit("status", None) == 0
+    assert limits.admit("read", None) == 0
+    assert limits.admit("status", None) == 1.0
+    assert limits.status_queries.shed == 1
+    limits.done("status")
+    assert limits.admit("status", None) == 0
+
+
+STATUS_QUERY = "startDate=2099-12-15&endDate=2099-12-15&startTime=12:00&endTime=13:00&duration=30"
+
+
+def test_status_stream_holds_its_slot(client, sample_canteen, monkeypatch):
+    """Test that a status query keeps its slot until its whole body is sent"""
+    monkeypatch.setattr(handlers, "admitter", admission.Admission(status_concurrency=1))
+
+    async def main():
+        sending = asyncio.Event()
+        resume = asyncio.Event()
+        requested = []
+
+        async def receive():
+            if not requested:
+                requested.append(True)
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await asyncio.Event().wait()
+
+        # stops the stream at its first line until 'resume' is set
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body") and not sending.is_set():
+                sending.set()
+                await resume.wait()
+
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+            "method": "GET", "scheme": "http", "path": "/canteens/status",
+            "raw_path": b"/canteens/status", "query_string": STATUS_QUERY.encode(),
+            "root_path": "", "headers": [(b"host", b"test"), (b"accept", b"application/x-ndjson")],
+            "client": ("127.0.0.1", 1), "server": ("test", 80),
+        }
+        stream = asyncio.create_task(handlers.app(scope, receive, send))
+        await sending.wait()
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=handlers.app), base_url="http://test") as other:
+            response = await other.get("/canteens/status?" + STATUS_QUERY)
+            assert response.status_code == 429
+            resume.set()
+            await stream
+            response = await other.get("/canteens/status?" + STATUS_QUERY)
+            assert response.status_code == 200
+
+    asyncio.run(main())
+    assert handlers.admitter.status_queries.active == 0
+
+
+def test_parse_rates():
+    """Test reading the route class rates"""
+    assert admission.parse_rates("status=5:10, write=50") == {"status": (5.0, 10.0), "write": (50.0, 100.0)}
+    assert admission.parse_rates("") == {}
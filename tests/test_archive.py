@@ -0,0 +1,59 @@
+import asyncio
+import datetime as dt
+from models import database, persistence, archive, capacity, reservation
+from tests.test_persistence import fill_db
+
+
+DAY = dt.date(2099, 12, 15)
+
+
+def test_archive_past_days(tmp_path):
+    """Test that reservations over before a day are moved to the archive"""
+    db = database.DB()
+    persistence.Persistence(str(tmp_path / "data")).recover(db)
+    # reservation 1 is cancelled, 2 is active, both on DAY
+    fill_db(db)
+    db.store_reservation(reservation.Reservation(
+        canteenId=1, studentId=2, date=DAY + dt.timedelta(days=3), time=dt.time(12, 0), duration=30))
+
+    status = db.get_canteen_cap_status(1, DAY, DAY, dt.time(12), dt.time(14), 30)
+    archive_file = archive.ArchiveFile(str(tmp_path / "archive"))
+    archived = asyncio.run(archive.archive_past_days(
+        db, archive_file, today=(DAY + dt.timedelta(days=1)).toordinal(), chunk=2))
+    archive_file.close()
+
+    assert archived == 2
+    assert db.storage.get_reservation(1) is None
+    assert db.storage.get_reservation(2) is None
+    assert db.retrieve_reservation(3).date == DAY + dt.timedelta(days=3)
+    assert db.storage.archived_counts == {(1, DAY.toordinal()): 1}
+    # the status of the archived day doesn't change
+    db.status_cache.clear()
+    assert db.get_canteen_cap_status(1, DAY, DAY, dt.time(12), dt.time(14), 30) == status
+    assert db.storage.student_reservations[2] == {
+        (DAY + dt.timedelta(days=3)).toordinal(): capacity.slot_mask(48, 50)}
+    assert [row[0] for row in archive.read_archive(str(tmp_path / "archive"))] == [1, 2]
+    # the archived reservations are dropped from the front of the columns
+    assert db.storage.reservations.offset == 2
+    assert db.storage.get_next_reservation_id() == 4
+
+    # archiving is replayed from the log as well
+    db.persistence.flush()
+    recovered = database.DB()
+    persistence.Persistence(str(tmp_path / "data")).recover(recovered)
+    assert recovered.storage.get_reservation(2) is None
+    assert recovered.retrieve_reservation(3).studentId == 2
+    assert recovered.storage.archived_counts == {(1, DAY.toordinal()): 1}
+    assert recovered.get_canteen_cap_status(1, DAY, DAY, dt.time(12), dt.time(14), 30) == status
+
+
+def test_archive_skips_changed_reservations(tmp_path):
+    """Test that a reservation changed after its row was read stays in memory"""
+    db = database.DB()
+    fill_db(db)
+    rows = db.storage.ended_reservations((DAY + dt.timedelta(days=1)).toordinal(), 1, 10)
+    db.delete_reservation(2, 2)
+
+    archived = db.archive_reservations(rows)
+    assert [row[0] for row in archived] == [1]
+    assert db.storage.get_reservation(2).status == "Cancelled"
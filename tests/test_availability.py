@@ -0,0 +1,68 @@
+def make_canteen(client, admin_student, name, capacity, hours):
+    response = client.post(
+        "/canteens",
+        headers={"studentId": str(admin_student["id"])},
+        json={
+            "name": name,
+            "location": name + " Location",
+            "capacity": capacity,
+            "workingHours": [
+                {"meal": meal, "from": f, "to": t} for meal, f, t in hours
+            ]
+        }
+    )
+    assert response.status_code == 201
+    return response.json()
+
+
+def test_availability_earliest_first(client, admin_student):
+    """Test that the earliest free slots of all canteens come first"""
+    late = make_canteen(client, admin_student, "Late", 5, [("lunch", "12:00", "14:00")])
+    early = make_canteen(client, admin_student, "Early", 5, [("lunch", "11:00", "14:00")])
+
+    response = client.get("/availability", params={
+        "from": "2099-12-15T11:30:00", "duration": 60, "limit": 4})
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"canteenId": early["id"], "date": "2099-12-15", "startTime": "11:30", "remainingCapacity": 5},
+        {"canteenId": early["id"], "date": "2099-12-15", "startTime": "11:45", "remainingCapacity": 5},
+        {"canteenId": late["id"], "date": "2099-12-15", "startTime": "12:00", "remainingCapacity": 5},
+        {"canteenId": early["id"], "date": "2099-12-15", "startTime": "12:00", "remainingCapacity": 5},
+    ]
+
+
+def test_availability_skips_full_slots(client, admin_student, regular_student):
+    """Test that slots without enough free spots are left out"""
+    canteen = make_canteen(client, admin_student, "Tiny", 2, [("lunch", "12:00", "13:30")])
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 60
+        }
+    )
+    assert response.status_code == 201
+
+    response = client.get("/availability", params={
+        "from": "2099-12-15T00:00:00", "duration": 30, "minSeats": 2, "limit": 3})
+
+    assert response.status_code == 200
+    assert response.json() == [
+        {"canteenId": canteen["id"], "date": "2099-12-15", "startTime": "13:00", "remainingCapacity": 2},
+        {"canteenId": canteen["id"], "date": "2099-12-16", "startTime": "12:00", "remainingCapacity": 2},
+        {"canteenId": canteen["id"], "date": "2099-12-16", "startTime": "12:15", "remainingCapacity": 2},
+    ]
+
+
+def test_availability_invalid(client, sample_canteen):
+    """Test that invalid search parameters are rejected"""
+    for params in ({"duration": 20}, {"duration": 30, "minSeats": 0},
+                   {"duration": 30, "limit": 0}, {"duration": 30, "days": 1000},
+                   {"duration": 30, "from": "2099-12-15T12:00:00Z"},
+                   {"duration": 30, "from": "2099-12-15T12:00:00+02:00"}):
+        response = client.get("/availability", params=params)
+        assert response.status_code == 418
@@ -0,0 +1,26 @@
+from models import database
+from perf import bench, dataset
+
+
+def test_dataset_is_seeded():
+    """Test that the same seed always generates the same data"""
+    first, second = database.DB(), database.DB()
+    students, canteens, stored = dataset.generate(first, 50, 3, 200, 2, seed=7)
+    assert dataset.generate(second, 50, 3, 200, 2, seed=7) == (students, canteens, stored)
+
+    assert len(students) == 50
+    assert len(canteens) == 3
+    assert 0 < stored <= 200
+    for id in range(1, stored + 1):
+        assert first.retrieve_reservation(id) == second.retrieve_reservation(id)
+
+
+def test_benchmarks_run():
+    """Test that every benchmark runs on a small data set"""
+    size = {"students": 20, "canteens": 2, "reservations": 50, "days": 2}
+    rows = bench.run(["students"], [1], size)
+
+    assert [row["operation"] for row in rows] == list(bench.BENCHMARKS)
+    for row in rows:
+        assert row["calls"] > 0
+        assert row["mean_us"] > 0
@@ -1,3 +1,7 @@
+import json
+from handlers import db
+
+
 def test_create_canteen_as_admin(client, admin_student):
     """Test creating a canteen as an admin"""
     response = client.post(
@@ -69,3 +73,334 @@ def test_delete_canteen_as_admin(client, admin_student, sample_canteen):
     )
     
     assert response.status_code == 204
+
+
+def test_canteen_status_after_reservation(client, regular_student, sample_canteen):
+    """Test that the status of a canteen reflects reservations"""
+    client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 60
+        }
+    )
+
+    response = client.get(
+        f"/canteens/{sample_canteen['id']}/status",
+        params={
+            "startDate": "2099-12-15",
+            "endDate": "2099-12-16",
+            "startTime": "11:00",
+            "endTime": "14:00",
+            "duration": 30
+        }
+    )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["canteenId"] == sample_canteen["id"]
+    assert len(data["slots"]) == 12
+    remaining = {(s["date"], s["startTime"]): s["remainingCapacity"] for s in data["slots"]}
+    assert remaining[("2099-12-15", "11:30")] == 10
+    assert remaining[("2099-12-15", "12:00")] == 9
+    assert remaining[("2099-12-15", "12:30")] == 9
+    assert remaining[("2099-12-15", "13:00")] == 10
+    assert remaining[("2099-12-16", "12:00")] == 10
+    assert data["slots"][0]["meal"] == "lunch"
+
+
+def test_all_canteens_status(client, admin_student, sample_canteen):
+    """Test getting the status of every canteen"""
+    client.post(
+        "/canteens",
+        headers={"studentId": str(admin_student["id"])},
+        json={
+            "name": "Second Canteen",
+            "location": "Test Location 2",
+            "capacity": 5,
+            "workingHours": [
+                {"meal": "breakfast", "from": "08:00", "to": "09:00"}
+            ]
+        }
+    )
+
+    response = client.get(
+        "/canteens/status",
+        params={
+            "startDate": "2099-12-15",
+            "endDate": "2099-12-15",
+            "startTime": "08:00",
+            "endTime": "12:00",
+            "duration": 60
+        }
+    )
+
+    assert response.status_code == 200
+    data = response.json()
+    assert [c["canteenId"] for c in data] == [1, 2]
+    assert [s["startTime"] for s in data[0]["slots"]] == ["08:00", "09:00", "11:00"]
+    assert data[1]["slots"] == [
+        {"date": "2099-12-15", "meal": "breakfast", "startTime": "08:00", "remainingCapacity": 5}
+    ]
+
+
+def test_all_canteens_status_ndjson(client, sample_canteen):
+    """Test streaming the status of every canteen as ndjson"""
+    response = client.get(
+        "/canteens/status",
+        headers={"Accept": "application/x-ndjson"},
+        params={
+            "startDate": "2099-12-15",
+            "endDate": "2099-12-17",
+            "startTime": "11:00",
+            "endTime": "12:00",
+            "duration": 30
+        }
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 3
+    assert all(line["canteenId"] == sample_canteen["id"] for line in lines)
+    assert [line["slots"][0]["date"] for line in lines] == ["2099-12-15", "2099-12-16", "2099-12-17"]
+    assert [s["startTime"] for s in lines[0]["slots"]] == ["11:00", "11:30"]
+
+
+def test_all_canteens_status_ndjson_invalid_duration(client, sample_canteen):
+    """Test that an invalid duration is rejected before streaming starts"""
+    response = client.get(
+        "/canteens/status",
+        headers={"Accept": "application/x-ndjson"},
+        params={
+            "startDate": "2099-12-15",
+            "endDate": "2099-12-17",
+            "startTime": "11:00",
+            "endTime": "12:00",
+            "duration": 20
+        }
+    )
+
+    assert response.status_code == 418
+
+
+def test_canteen_status_with_any_slot_multiple(client, regular_student, sample_canteen):
+    """Test that a status can be asked for with any duration a reservation can have"""
+    client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 45
+        }
+    )
+
+    params = {
+        "startDate": "2099-12-15",
+        "endDate": "2099-12-15",
+        "startTime": "11:00",
+        "endTime": "13:00",
+        "duration": 45
+    }
+    response = client.get(f"/canteens/{sample_canteen['id']}/status", params=params)
+    assert response.status_code == 200
+    slots = response.json()["slots"]
+    assert [(s["startTime"], s["remainingCapacity"]) for s in slots] == [("11:00", 10), ("11:45", 9), ("12:30", 9)]
+
+    response = client.get("/canteens/status", params={**params, "duration": 1440})
+    assert response.status_code == 200
+    response = client.get("/canteens/status", params={**params, "duration": 1455})
+    assert response.status_code == 418
+
+
+def test_canteen_status_cache_invalidation(client, admin_student, regular_student, sample_canteen):
+    """Test that cached statuses are recomputed once the canteen changes"""
+    url = f"/canteens/{sample_canteen['id']}/status"
+    params = {
+        "startDate": "2099-12-15",
+        "endDate": "2099-12-15",
+        "startTime": "12:00",
+        "endTime": "12:30",
+        "duration": 30
+    }
+
+    first = client.get(url, params=params).json()
+    second = client.get(url, params=params).json()
+    assert first == second
+    assert db.status_cache.stats()["hits"] == 1
+
+    client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 30
+        }
+    )
+    data = client.get(url, params=params).json()
+    assert data["slots"][0]["remainingCapacity"] == 9
+
+    client.put(
+        url.removesuffix("/status"),
+        headers={"studentId": str(admin_student["id"])},
+        json={"capacity": 20}
+    )
+    data = client.get(url, params=params).json()
+    assert data["slots"][0]["remainingCapacity"] == 19
+    assert db.status_cache.stats()["misses"] == 3
+
+
+def test_delete_canteen_cancels_reservations(client, admin_student, sample_canteen):
+    """Test that deleting a canteen cancels every reservation in it"""
+    students = [
+        client.post(
+            "/students",
+            json={"name": "Student", "email": f"student{i}@test.com", "isAdmin": False}
+        ).json()
+        for i in range(5)
+    ]
+    reservations = [
+        client.post(
+            "/reservations",
+            json={
+                "studentId": s["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 60
+            }
+        ).json()
+        for s in students
+    ]
+    # an already cancelled reservation in the same canteen
+    client.delete(
+        f"/reservations/{reservations[0]['id']}",
+        headers={"studentId": str(students[0]["id"])}
+    )
+
+    response = client.delete(
+        f"/canteens/{sample_canteen['id']}",
+        headers={"studentId": str(admin_student["id"])}
+    )
+    assert response.status_code == 204
+
+    for s, r in zip(students, reservations):
+        response = client.delete(
+            f"/reservations/{r['id']}",
+            headers={"studentId": str(s["id"])}
+        )
+        assert response.status_code == 404
+
+    other = client.post(
+        "/canteens",
+        headers={"studentId": str(admin_student["id"])},
+        json={
+            "name": "Other Canteen",
+            "location": "Other Location",
+            "capacity": 10,
+            "workingHours": [{"meal": "lunch", "from": "11:00", "to": "15:00"}]
+        }
+    ).json()
+    # the students' slots were freed, so they can book the same time elsewhere
+    for s in students:
+        response = client.post(
+            "/reservations",
+            json={
+                "studentId": s["id"],
+                "canteenId": other["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 60
+            }
+        )
+        assert response.status_code == 201
+
+
+def test_canteen_status_etag(client, regular_student, sample_canteen):
+    """Test that an unchanged status is answered with 304 until a reservation changes it"""
+    url = f"/canteens/{sample_canteen['id']}/status"
+    params = {
+        "startDate": "2099-12-15",
+        "endDate": "2099-12-15",
+        "startTime": "12:00",
+        "endTime": "12:30",
+        "duration": 30
+    }
+
+    for path in (url, "/canteens/status"):
+        response = client.get(path, params=params)
+        etag = response.headers["ETag"]
+        response = client.get(path, params=params, headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+        assert response.content == b""
+
+    etags = {path: client.get(path, params=params).headers["ETag"]
+             for path in (url, "/canteens/status", "/canteens")}
+    client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 30
+        }
+    )
+    for path in (url, "/canteens/status"):
+        response = client.get(path, params=params, headers={"If-None-Match": etags[path]})
+        assert response.status_code == 200
+    # the canteens themselves didn't change
+    response = client.get("/canteens", headers={"If-None-Match": etags["/canteens"]})
+    assert response.status_code == 304
+
+
+def test_invalid_status_query_with_etag(client, sample_canteen):
+    """Test that a status query is validated before its ETag is compared"""
+    params = {
+        "startDate": "2099-12-15",
+        "endDate": "2099-12-15",
+        "startTime": "12:00",
+        "endTime": "12:30",
+        "duration": 30
+    }
+    url = f"/canteens/{sample_canteen['id']}/status"
+    etag = client.get(url, params=params).headers["ETag"]
+    all_etag = client.get("/canteens/status", params=params).headers["ETag"]
+    etag_999 = db.canteen_status_etag(999)
+
+    response = client.get("/canteens/999/status", params=params, headers={"If-None-Match": etag_999})
+    assert response.status_code == 418
+    response = client.get(url, params={**params, "duration": 20}, headers={"If-None-Match": etag})
+    assert response.status_code == 418
+    response = client.get("/canteens/status", params={**params, "duration": 20}, headers={"If-None-Match": all_etag})
+    assert response.status_code == 418
+
+
+def test_canteens_etag(client, admin_student, sample_canteen):
+    """Test that the canteens are answered with 304 until one of them changes"""
+    url = f"/canteens/{sample_canteen['id']}"
+    etag = client.get(url).headers["ETag"]
+    assert client.get(url, headers={"If-None-Match": f'"other", W/{etag}'}).status_code == 304
+    # every canteen has a tag of its own
+    assert client.get("/canteens", headers={"If-None-Match": etag}).status_code == 200
+    list_etag = client.get("/canteens").headers["ETag"]
+    assert client.get("/canteens", headers={"If-None-Match": list_etag}).status_code == 304
+    assert client.get("/canteens/999", headers={"If-None-Match": list_etag}).status_code == 404
+
+    client.put(
+        url,
+        headers={"studentId": str(admin_student["id"])},
+        json={"capacity": 20}
+    )
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["capacity"] == 20
+    assert response.headers["ETag"] != etag
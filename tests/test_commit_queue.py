@@ -0,0 +1,101 @@
+import asyncio
+import datetime as dt
+import pytest
+from models import commit_queue, database, persistence, sqlite_storage, student, canteen, reservation, capacity
+
+
+DAY = dt.date(2099, 12, 15)
+
+
+def make_db(capacity=2, store=None):
+    db = database.DB(store)
+    db.store_student(student.Student(name="Admin", email="admin@test.com", isAdmin=True))
+    for i in range(4):
+        db.store_student(student.Student(name="User", email="user{}@test.com".format(i), isAdmin=False))
+    db.store_canteen(canteen.Canteen(
+        name="Canteen", location="Location", capacity=capacity,
+        workingHours=[canteen.Meal(meal="lunch", **{"from": "11:00"}, to="15:00")]), 1)
+    return db
+
+
+def make_reservation(student_id, t="12:00"):
+    return reservation.Reservation(
+        canteenId=1, studentId=student_id, date=DAY, time=dt.time.fromisoformat(t), duration=30)
+
+
+async def submit_all(queue, rs):
+    return await asyncio.gather(*(queue.submit(r) for r in rs), return_exceptions=True)
+
+
+def test_concurrent_submits_share_a_commit(tmp_path, monkeypatch):
+    """Test that reservations submitted together are committed with one fsync"""
+    db = make_db(capacity=10)
+    persistence.Persistence(str(tmp_path)).recover(db)
+    syncs = []
+    monkeypatch.setattr(persistence.os, "fsync", syncs.append)
+
+    queue = commit_queue.CommitQueue(db)
+    rs = [make_reservation(s) for s in range(2, 6)]
+    assert asyncio.run(submit_all(queue, rs)) == [None] * 4
+
+    assert len(syncs) == 1
+    assert sorted(r.id for r in rs) == [1, 2, 3, 4]
+    assert db.storage.slot_count(1, DAY.toordinal(), capacity.slot_index(dt.time(12, 0))) == 4
+
+
+def test_rejections_dont_stop_the_group():
+    """Test that each reservation of a group is accepted or turned down on its own"""
+    db = make_db(capacity=2)
+    queue = commit_queue.CommitQueue(db, max_batch=2)
+    rs = [make_reservation(2), make_reservation(3), make_reservation(4),
+          make_reservation(2, "12:15"), make_reservation(5, "13:00")]
+    results = asyncio.run(submit_all(queue, rs))
+
+    assert results[:2] == [None, None]
+    # the canteen is full, then the student already has a reservation
+    assert isinstance(results[2], ValueError)
+    assert isinstance(results[3], ValueError)
+    assert results[4] is None
+    assert db.storage.get_next_reservation_id() == 4
+
+
+def test_writer_runs_on_every_loop():
+    """Test that a queue keeps working when used from another event loop"""
+    db = make_db()
+    queue = commit_queue.CommitQueue(db)
+    asyncio.run(queue.submit(make_reservation(2)))
+    asyncio.run(queue.submit(make_reservation(3)))
+    with pytest.raises(ValueError):
+        asyncio.run(queue.submit(make_reservation(4)))
+
+
+def test_rejected_reservation_leaves_no_trace(tmp_path):
+    """Test that a reservation turned down in a group isn't stored, counted or logged"""
+    db = make_db(capacity=1)
+    persistence.Persistence(str(tmp_path)).recover(db)
+    queue = commit_queue.CommitQueue(db)
+    results = asyncio.run(submit_all(queue, [make_reservation(2), make_reservation(3)]))
+
+    assert results[0] is None
+    assert isinstance(results[1], ValueError)
+    assert db.storage.get_next_reservation_id() == 2
+    assert db.storage.slot_count(1, DAY.toordinal(), capacity.slot_index(dt.time(12, 0))) == 1
+    assert db.storage.student_reservations_page(3, ("Active",), None, None, None, 10) == []
+    db.persistence.flush()
+    assert [op for _, op, _, _ in persistence.read_log(str(tmp_path / "db.wal"))] == ["store_reservation"]
+
+
+def test_failure_after_logging_fails_the_group(tmp_path, monkeypatch):
+    """Test that a failure once a reservation is logged rolls the group back and fails all of it"""
+    db = make_db(capacity=10, store=sqlite_storage.SQLiteStorage(str(tmp_path / "test.db")))
+
+    def fail(ct_id):
+        raise RuntimeError("broken")
+    monkeypatch.setattr(db, "bumpCanteenVersion", fail)
+    queue = commit_queue.CommitQueue(db)
+    results = asyncio.run(submit_all(queue, [make_reservation(s) for s in (2, 3, 4)]))
+
+    assert all(isinstance(e, RuntimeError) for e in results)
+    assert db.storage.get_next_reservation_id() == 1
+    assert db.storage.slot_count(1, DAY.toordinal(), capacity.slot_index(dt.time(12, 0))) == 0
+    db.storage.close()
@@ -0,0 +1,30 @@
+from perf import loadtest
+
+
+def test_scenarios_run():
+    """Test that every load test scenario runs and reports its routes"""
+    results = loadtest.run(list(loadtest.SCENARIOS), scale=0.05, concurrency=4)
+
+    assert set(results) == set(loadtest.SCENARIOS)
+    assert "POST /reservations" in results["lunch_rush"]["routes"]
+    assert "GET /canteens/status" in results["status_scan"]["routes"]
+    for result in results.values():
+        for stats in result["routes"].values():
+            assert stats["requests"] > 0
+            assert stats["p50"] <= stats["p95"] <= stats["p99"]
+            assert "500" not in stats["statuses"]
+    assert loadtest.compare(results, results, 0.0) == []
+
+
+def test_compare_finds_regressions():
+    """Test that slower routes and failed requests are reported"""
+    stats = {"requests": 10, "throughput": 100.0, "p50": 1.0, "p95": 2.0, "p99": 3.0, "statuses": {"201": 10}}
+    baselines = {"churn": {"routes": {"POST /reservations": stats}}}
+
+    slower = dict(stats, p95=4.0, throughput=40.0)
+    regressions = loadtest.compare({"churn": {"routes": {"POST /reservations": slower}}}, baselines, 0.5)
+    assert len(regressions) == 2
+
+    failing = dict(stats, statuses={"201": 9, "500": 1})
+    regressions = loadtest.compare({"churn": {"routes": {"POST /reservations": failing}}}, baselines, 0.5)
+    assert len(regressions) == 1
@@ -0,0 +1,59 @@
+import io
+import json
+import logging
+from models import logs
+
+
+def read_events(stream):
+    return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+
+def test_events_are_json_lines():
+    stream = io.StringIO()
+    listener = logs.setup("INFO", 1.0, stream)
+    logs.event(logs.get_logger("test"), logging.INFO, "something", id=1, reason="why")
+    logs.shutdown(listener)
+
+    [entry] = read_events(stream)
+    assert entry["event"] == "something"
+    assert entry["logger"] == "canteens.test"
+    assert entry["level"] == "INFO"
+    assert entry["id"] == 1
+    assert entry["reason"] == "why"
+
+
+def test_level_and_sampling():
+    stream = io.StringIO()
+    listener = logs.setup("INFO", 0.0, stream)
+    logger = logs.get_logger("test")
+    for i in range(100):
+        logs.event(logger, logging.DEBUG, "debug", i=i)
+        logs.event(logger, logging.INFO, "info", i=i)
+    logs.event(logger, logging.WARNING, "warning")
+    logs.shutdown(listener)
+
+    # debug is below the level, info is sampled away, warnings always pass
+    assert [e["event"] for e in read_events(stream)] == ["warning"]
+
+
+def test_reservation_events(client, regular_student, sample_canteen):
+    stream = io.StringIO()
+    listener = logs.setup("INFO", 1.0, stream)
+    reservation = {
+        "studentId": regular_student["id"],
+        "canteenId": sample_canteen["id"],
+        "date": "2099-12-15",
+        "time": "12:00",
+        "duration": 30
+    }
+    assert client.post("/reservations", json=reservation).status_code == 201
+    assert client.post("/reservations", json=reservation).status_code == 418
+    logs.shutdown(listener)
+
+    entries = read_events(stream)
+    events = [e["event"] for e in entries]
+    assert events == ["reservation_created", "request", "reservation_rejected", "request"]
+    assert entries[0]["studentId"] == regular_student["id"]
+    assert entries[2]["reason"] == "User cannot have two reservations that overlap"
+    assert entries[3]["status"] == 418
+    assert entries[3]["ms"] >= 0
@@ -0,0 +1,55 @@
+from models import metrics
+
+
+def metric_value(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics(client, regular_student, sample_canteen):
+    """Test that requests, db operations, rejections and sizes show up in /metrics"""
+    before = metrics.RESERVATION_REJECTIONS.get("overlap")
+    reservation = {
+        "studentId": regular_student["id"],
+        "canteenId": sample_canteen["id"],
+        "date": "2099-12-15",
+        "time": "12:00",
+        "duration": 30
+    }
+    assert client.post("/reservations", json=reservation).status_code == 201
+    assert client.post("/reservations", json=reservation).status_code == 418
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+
+    assert metric_value(
+        text, 'canteens_reservation_rejections_total{reason="overlap"}') == before + 1
+    assert metric_value(text, 'canteens_db_size{kind="students"}') == 2
+    assert metric_value(text, 'canteens_db_size{kind="active_reservations"}') == 1
+    assert metric_value(text, 'canteens_db_size{kind="canteen_capacity_days"}') == 1
+    assert metric_value(
+        text, 'canteens_request_seconds_count{method="POST",route="/reservations",status="418"}') >= 1
+    assert metric_value(
+        text, 'canteens_request_seconds_bucket{method="POST",route="/reservations",status="201",le="+Inf"}') >= 1
+    assert metric_value(
+        text, 'canteens_db_operation_seconds_count{operation="store_reservation"}') >= 2
+    assert metric_value(text, 'canteens_status_cache{stat="maxSize"}') == 4096
+
+
+def test_histogram_buckets():
+    """Test that histogram buckets are cumulative"""
+    h = metrics.Histogram("test_seconds", "Test", ("op",), buckets=(0.1, 1.0))
+    h.observe(0.05, "a")
+    h.observe(0.5, "a")
+    h.observe(5.0, "a")
+    lines = h.render()
+
+    assert 'test_seconds_bucket{op="a",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{op="a",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{op="a",le="+Inf"} 3' in lines
+    assert 'test_seconds_sum{op="a"} 5.55' in lines
+    assert 'test_seconds_count{op="a"} 3' in lines
@@ -0,0 +1,172 @@
+import asyncio
+import datetime as dt
+import pytest
+import handlers
+from models import database, persistence, student, canteen, reservation, capacity
+
+
+def make_db(tmp_path, snapshot_every=100000):
+    db = database.DB()
+    persistence.Persistence(str(tmp_path), snapshot_every=snapshot_every).recover(db)
+    return db
+
+
+def fill_db(db):
+    db.store_student(student.Student(name="Admin", email="admin@test.com", isAdmin=True))
+    db.store_student(student.Student(name="User", email="user@test.com", isAdmin=False))
+    db.store_canteen(canteen.Canteen(
+        name="Canteen", location="Location", capacity=10,
+        workingHours=[canteen.Meal(meal="lunch", **{"from": "11:00"}, to="15:00")]), 1)
+    for t in ("12:00", "13:00"):
+        db.store_reservation(reservation.Reservation(
+            canteenId=1, studentId=2, date=dt.date(2099, 12, 15),
+            time=dt.time.fromisoformat(t), duration=60))
+    db.delete_reservation(1, 2)
+
+
+def check_db(db):
+    assert db.retrieve_student(2).email == "user@test.com"
+    assert db.retrieve_canteen(1).workingHours[0].meal == "lunch"
+    assert db.storage.get_reservation(1).status == "Cancelled"
+    assert db.retrieve_reservation(2).time == dt.time(13, 0)
+    day = dt.date(2099, 12, 15).toordinal()
+    assert db.storage.slot_count(1, day, capacity.slot_index(dt.time(12, 0))) == 0
+    assert db.storage.slot_count(1, day, capacity.slot_index(dt.time(13, 0))) == 1
+    assert db.storage.get_next_reservation_id() == 3
+
+
+def test_recover_from_log(tmp_path):
+    """Test that mutations are replayed from the log after a crash"""
+    db = make_db(tmp_path)
+    fill_db(db)
+    db.persistence.flush()
+
+    # no close, as if the process died
+    check_db(make_db(tmp_path))
+
+
+def test_idle_log_is_synced_periodically(tmp_path, monkeypatch):
+    """Test that the last records before a quiet spell get fsync-ed without another write"""
+    db = database.DB()
+    persistence.Persistence(str(tmp_path), fsync_every=100, fsync_interval=60).recover(db)
+    fill_db(db)
+    assert db.persistence.wal.unsynced
+    monkeypatch.setattr(handlers, "db", db)
+
+    async def main():
+        syncer = asyncio.create_task(handlers.sync_periodically(0.01))
+        await asyncio.sleep(0.05)
+        syncer.cancel()
+    asyncio.run(main())
+    assert db.persistence.wal.unsynced == 0
+
+
+def test_recover_from_snapshot_and_log_tail(tmp_path):
+    """Test that recovery loads the snapshot and replays only the log after it"""
+    db = make_db(tmp_path, snapshot_every=3)
+    fill_db(db)
+    db.persistence.flush()
+
+    recovered = make_db(tmp_path, snapshot_every=3)
+    assert recovered.persistence.since_snapshot == 3
+    check_db(recovered)
+
+
+def test_recover_ignores_torn_record(tmp_path):
+    """Test that a half written record at the end of the log is dropped"""
+    db = make_db(tmp_path)
+    fill_db(db)
+    db.persistence.close(db)
+    with open(tmp_path / "db.wal", "ab") as f:
+        f.write(b"\x10\x00\x00\x00garbage")
+
+    recovered = make_db(tmp_path)
+    check_db(recovered)
+    recovered.store_student(student.Student(name="New", email="new@test.com", isAdmin=False))
+    recovered.persistence.flush()
+    assert make_db(tmp_path).retrieve_student(3).name == "New"
+
+
+def test_recover_batch(tmp_path):
+    """Test that a batch of reservations is replayed as a whole"""
+    db = make_db(tmp_path)
+    fill_db(db)
+    db.store_reservations([
+        reservation.Reservation(
+            canteenId=1, studentId=s, date=dt.date(2099, 12, 16),
+            time=dt.time(12, 0), duration=30)
+        for s in (1, 2)
+    ])
+    db.persistence.flush()
+
+    recovered = make_db(tmp_path)
+    assert recovered.retrieve_reservation(4).studentId == 2
+    assert recovered.storage.slot_count(1, dt.date(2099, 12, 16).toordinal(), capacity.slot_index(dt.time(12, 0))) == 2
+
+
+def test_rejected_batch_isnt_stored_or_logged(tmp_path):
+    """Test that a batch with a reservation that isn't Active is turned down as a whole"""
+    db = make_db(tmp_path)
+    fill_db(db)
+    with pytest.raises(ValueError):
+        db.store_reservations([
+            reservation.Reservation(
+                canteenId=1, studentId=s, date=dt.date(2099, 12, 16),
+                time=dt.time(12, 0), duration=30, status=status)
+            for s, status in ((1, "Active"), (2, "Bogus"))
+        ])
+    assert db.storage.get_next_reservation_id() == 3
+    db.persistence.flush()
+
+    check_db(make_db(tmp_path))
+
+
+def test_snapshot_with_other_slot_size(tmp_path):
+    """Test that slots are worked out again for a snapshot made with another slot size"""
+    db = database.DB()
+    fill_db(db)
+    state = db.get_state()
+    del state["slot_minutes"]
+    # counters and student slots of the old size mean nothing now
+    state["canteen_capacities"] = capacity.CapacityStore()
+    state["student_reservations"] = {1: set(), 2: set()}
+
+    loaded = database.DB()
+    loaded.load_state(state)
+    check_db(loaded)
+    assert loaded.storage.is_student_busy(
+        2, dt.date(2099, 12, 15).toordinal(), capacity.slot_mask(
+            capacity.slot_index(dt.time(13, 30)), capacity.slot_index(dt.time(13, 45))))
+
+
+def test_snapshot_with_models(tmp_path):
+    """Test loading a snapshot that holds students and reservations as models"""
+    db = database.DB()
+    fill_db(db)
+    state = db.get_state()
+    state["students"] = {id: db.storage.get_student(id) for id in (1, 2)}
+    state["reservations"] = {id: db.storage.get_reservation(id) for id in (1, 2)}
+
+    loaded = database.DB()
+    loaded.load_state(state)
+    check_db(loaded)
+
+
+def test_rejected_status_isnt_logged(tmp_path):
+    """Test that a reservation with a status other than Active is turned down before it's logged"""
+    db = make_db(tmp_path)
+    fill_db(db)
+    for status in ("Bogus", "Cancelled"):
+        with pytest.raises(ValueError):
+            db.store_reservation(reservation.Reservation(
+                canteenId=1, studentId=1, date=dt.date(2099, 12, 16),
+                time=dt.time(12, 0), duration=30, status=status))
+    db.store_reservation(reservation.Reservation(
+        canteenId=1, studentId=1, date=dt.date(2099, 12, 16), time=dt.time(12, 0), duration=30))
+    db.persistence.flush()
+
+    recovered = make_db(tmp_path)
+    day = dt.date(2099, 12, 16).toordinal()
+    assert recovered.retrieve_reservation(3).studentId == 1
+    assert recovered.storage.get_next_reservation_id() == 4
+    assert recovered.storage.slot_count(1, day, capacity.slot_index(dt.time(12, 0))) == 1
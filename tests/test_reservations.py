@@ -1,3 +1,6 @@
+from handlers import db, idempotent
+
+
 def test_create_reservation_30min(client, regular_student, sample_canteen):
     """Test creating a 30-minute reservation"""
     response = client.post(
@@ -89,3 +92,233 @@ def test_delete_other_student_reservation(client, sample_reservation):
     )
     
     assert response.status_code == 418
+
+
+def test_create_reservation_when_canteen_full(client, admin_student, regular_student):
+    """Test that reservations are rejected once a slot is at capacity"""
+    canteen = client.post(
+        "/canteens",
+        headers={"studentId": str(admin_student["id"])},
+        json={
+            "name": "Tiny Canteen",
+            "location": "Tiny Location",
+            "capacity": 1,
+            "workingHours": [
+                {"meal": "lunch", "from": "11:00", "to": "15:00"}
+            ]
+        }
+    ).json()
+
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:00",
+            "duration": 60
+        }
+    )
+    assert response.status_code == 201
+
+    # the 60 minute reservation also takes up the 12:30 slot
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": admin_student["id"],
+            "canteenId": canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:30",
+            "duration": 30
+        }
+    )
+    assert response.status_code == 418
+
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": admin_student["id"],
+            "canteenId": canteen["id"],
+            "date": "2099-12-15",
+            "time": "13:00",
+            "duration": 30
+        }
+    )
+    assert response.status_code == 201
+
+
+def test_create_reservation_off_slot_boundary(client, regular_student, sample_canteen):
+    """Test that reservations not starting on a slot boundary are rejected"""
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": regular_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "12:10",
+            "duration": 30
+        }
+    )
+
+    assert response.status_code == 418
+
+
+def test_create_reservation_batch(client, admin_student, regular_student, sample_canteen):
+    """Test creating several reservations at once"""
+    response = client.post(
+        "/reservations/batch",
+        json=[
+            {
+                "studentId": regular_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 60
+            },
+            {
+                "studentId": admin_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 30
+            }
+        ]
+    )
+
+    assert response.status_code == 201
+    data = response.json()
+    assert [r["id"] for r in data] == [1, 2]
+    assert all(r["status"] == "Active" for r in data)
+
+
+def test_create_reservation_batch_all_or_nothing(client, admin_student, regular_student, sample_canteen):
+    """Test that a batch with an invalid reservation stores none of them"""
+    response = client.post(
+        "/reservations/batch",
+        json=[
+            {
+                "studentId": admin_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "08:00",
+                "duration": 30
+            },
+            {
+                "studentId": regular_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 60
+            },
+            # overlaps with the one before it
+            {
+                "studentId": regular_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:30",
+                "duration": 30
+            }
+        ]
+    )
+
+    assert response.status_code == 418
+    assert response.json()["detail"].startswith("Reservation 2:")
+
+    # nothing was stored, so the first one can still be made on its own
+    response = client.post(
+        "/reservations",
+        json={
+            "studentId": admin_student["id"],
+            "canteenId": sample_canteen["id"],
+            "date": "2099-12-15",
+            "time": "08:00",
+            "duration": 30
+        }
+    )
+    assert response.status_code == 201
+    assert response.json()["id"] == 1
+
+
+def test_create_reservation_batch_over_capacity(client, admin_student, regular_student):
+    """Test that a batch can't go over the capacity of a slot together"""
+    canteen = client.post(
+        "/canteens",
+        headers={"studentId": str(admin_student["id"])},
+        json={
+            "name": "Tiny Canteen",
+            "location": "Tiny Location",
+            "capacity": 1,
+            "workingHours": [
+                {"meal": "lunch", "from": "11:00", "to": "15:00"}
+            ]
+        }
+    ).json()
+
+    response = client.post(
+        "/reservations/batch",
+        json=[
+            {
+                "studentId": student_id,
+                "canteenId": canteen["id"],
+                "date": "2099-12-15",
+                "time": "12:00",
+                "duration": 30
+            }
+            for student_id in (admin_student["id"], regular_student["id"])
+        ]
+    )
+
+    assert response.status_code == 418
+
+
+def test_create_reservation_any_duration(client, admin_student, regular_student, sample_canteen):
+    """Test reservations lasting any whole number of slots"""
+    def reserve(student, time, duration):
+        return client.post(
+            "/reservations",
+            json={
+                "studentId": student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": time,
+                "duration": duration
+            }
+        )
+
+    assert reserve(regular_student, "12:00", 90).status_code == 201
+    # falls inside the 90 minute reservation
+    assert reserve(regular_student, "13:15", 15).status_code == 418
+    # starts right as it ends
+    assert reserve(regular_student, "13:30", 15).status_code == 201
+    assert reserve(regular_student, "13:45", 45).status_code == 201
+    # not a whole number of slots
+    assert reserve(admin_student, "12:00", 20).status_code == 418
+    assert reserve(admin_student, "12:00", 0).status_code == 418
+    assert reserve(admin_student, "12:15", 15).status_code == 201
+
+
+def test_create_reservation_idempotency_key(client, regular_student, sample_canteen, monkeypatch):
+    """Test that a retried reservation isn't stored twice and keys can't be reused"""
+    body = {
+        "studentId": regular_student["id"],
+        "canteenId": sample_canteen["id"],
+        "date": "2099-12-15",
+        "time": "12:00",
+        "duration": 30
+    }
+    headers = {"Idempotency-Key": "reserve-1"}
+
+    first = client.post("/reservations", json=body, headers=headers)
+    retry = client.post("/reservations", json=body, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+    assert db.storage.get_next_reservation_id() == 2
+
+    # the same key with a different request
+    response = client.post("/reservations", json={**body, "time": "13:00"}, headers=headers)
+    assert response.status_code == 418
+
+    # once the key expired, the retry runs again and overlaps the first one
+    monkeypatch.setattr(idempotent.done, "clock", lambda: float("inf"))
+    response = client.post("/reservations", json=body, headers=headers)
+    assert response.status_code == 418
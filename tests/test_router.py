@@ -0,0 +1,186 @@
+import asyncio
+import importlib.util
+import json
+import httpx
+import pytest
+import handlers
+import router
+from models import sharding
+
+
+SHARDS = 2
+LUNCH = [{"meal": "lunch", "from": "11:00", "to": "15:00"}]
+
+
+# every shard is a copy of the handlers module of its own, so it has a db
+# of its own, like a shard process would
+def load_shard(i):
+    spec = importlib.util.spec_from_file_location("shard{}".format(i), handlers.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="module")
+def shards():
+    return [load_shard(i) for i in range(SHARDS)]
+
+
+@pytest.fixture
+def run(shards):
+    for shard in shards:
+        shard.db.__init__()
+        shard.idempotent.clear()
+    clients = [httpx.AsyncClient(transport=httpx.ASGITransport(app=shard.app), base_url="http://shard{}".format(i))
+               for i, shard in enumerate(shards)]
+    app = router.create_app(clients)
+
+    # runs 'test' with a client of the router
+    def run(test):
+        async def main():
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://router") as client:
+                return await test(client)
+        return asyncio.run(main())
+    return run
+
+
+async def setup(client):
+    admin = (await client.post("/students", json={"name": "Admin", "email": "admin@test.com", "isAdmin": True})).json()
+    user = (await client.post("/students", json={"name": "User", "email": "user@test.com", "isAdmin": False})).json()
+    canteens = []
+    for i in range(2):
+        response = await client.post("/canteens", headers={"studentId": str(admin["id"])}, json={
+            "name": "Canteen {}".format(i), "location": "Location {}".format(i),
+            "capacity": 1, "workingHours": LUNCH})
+        assert response.status_code == 201
+        canteens.append(response.json())
+    return admin, user, canteens
+
+
+def reservation(student, canteen, t, duration=30):
+    return {"studentId": student["id"], "canteenId": canteen["id"],
+            "date": "2099-12-15", "time": t, "duration": duration}
+
+
+def test_shard_map():
+    """Test that global ids and cursors map to the right shard"""
+    shard_map = sharding.ShardMap(3)
+    ids = [shard_map.to_global(local, shard) for local in (1, 2) for shard in range(3)]
+    assert sorted(ids) == [1, 2, 3, 4, 5, 6]
+    assert all(shard_map.to_global(shard_map.to_local(id), shard_map.shard_of(id)) == id for id in ids)
+    # shard 2 holds global ids 3 and 6, so after global id 4 comes its local id 2
+    assert shard_map.local_key((7 << 32) | 4, 2) == (7 << 32) | 1
+    assert shard_map.local_key((7 << 32) | 4, 0) == (7 << 32) | 2
+
+
+def test_canteens_spread_over_shards(run, shards):
+    """Test that canteens go to different shards but are listed together"""
+    async def test(client):
+        admin, _, canteens = await setup(client)
+        assert [ct["id"] for ct in canteens] == [1, 2]
+        assert [len(shard.db.retrieve_all_canteens()) for shard in shards] == [1, 1]
+        assert [ct["name"] for ct in (await client.get("/canteens")).json()] == ["Canteen 0", "Canteen 1"]
+        assert (await client.get("/canteens/2")).json()["name"] == "Canteen 1"
+
+        # names are unique over all shards
+        response = await client.post("/canteens", headers={"studentId": str(admin["id"])}, json={
+            "name": "Canteen 1", "location": "Elsewhere", "capacity": 1, "workingHours": LUNCH})
+        assert response.status_code == 418
+        # so are emails, and students get the same id in every shard
+        response = await client.post("/students", json={"name": "Again", "email": "user@test.com", "isAdmin": False})
+        assert response.status_code == 418
+        assert [shard.db.retrieve_student(2).email for shard in shards] == ["user@test.com"] * SHARDS
+
+    run(test)
+
+
+def test_student_copied_after_a_shard_failed(run, shards, monkeypatch):
+    """Test that a shard that missed a student is caught up with the next one"""
+    def fail(s):
+        raise RuntimeError("down")
+
+    async def test(client):
+        with monkeypatch.context() as patch:
+            patch.setattr(shards[1].db, "copy_student", fail)
+            response = await client.post("/students", json={"name": "A", "email": "a@test.com", "isAdmin": False})
+            assert response.status_code == 201
+        assert shards[0].db.retrieve_student(1).email == "a@test.com"
+        assert shards[1].db.storage.get_student(1) is None
+
+        response = await client.post("/students", json={"name": "B", "email": "b@test.com", "isAdmin": False})
+        assert response.status_code == 201
+        assert response.json()["id"] == 2
+        for shard in shards:
+            assert [shard.db.retrieve_student(id).email for id in (1, 2)] == ["a@test.com", "b@test.com"]
+        response = await client.post("/students", json={"name": "C", "email": "c@test.com", "isAdmin": False})
+        assert response.json()["id"] == 3
+
+    run(test)
+
+
+def test_overlap_across_shards(run):
+    """Test that a student can't have overlapping reservations at canteens of different shards"""
+    async def test(client):
+        _, user, canteens = await setup(client)
+        first = await client.post("/reservations", json=reservation(user, canteens[0], "12:00", 60))
+        assert first.status_code == 201
+        assert first.json()["canteenId"] == canteens[0]["id"]
+
+        response = await client.post("/reservations", json=reservation(user, canteens[1], "12:30"))
+        assert response.status_code == 418
+        response = await client.post("/reservations", json=reservation(user, canteens[1], "13:00"))
+        assert response.status_code == 201
+        second = response.json()
+        assert second["canteenId"] == canteens[1]["id"]
+
+        # once cancelled, the slots are free again
+        response = await client.delete(
+            "/reservations/{}".format(first.json()["id"]), headers={"studentId": str(user["id"])})
+        assert response.status_code == 200
+        assert response.json()["status"] == "Cancelled"
+        response = await client.post("/reservations", json=reservation(user, canteens[1], "12:00"))
+        assert response.status_code == 201
+
+        page = (await client.get("/students/{}/reservations".format(user["id"]), params={"limit": 2})).json()
+        assert [r["time"] for r in page["reservations"]] == ["12:00", "12:00"]
+        rest = (await client.get("/students/{}/reservations".format(user["id"]),
+                                 params={"cursor": page["nextCursor"]})).json()
+        assert [r["id"] for r in rest["reservations"]] == [second["id"]]
+        assert rest["nextCursor"] is None
+
+    run(test)
+
+
+def test_status_fans_out(run):
+    """Test that the status of all canteens and free slots come from every shard"""
+    async def test(client):
+        _, user, canteens = await setup(client)
+        await client.post("/reservations", json=reservation(user, canteens[1], "12:00"))
+
+        response = await client.get("/canteens/status", params={
+            "startDate": "2099-12-15", "endDate": "2099-12-15",
+            "startTime": "12:00", "endTime": "12:30", "duration": 30})
+        assert response.status_code == 200
+        status = response.json()
+        assert [s["canteenId"] for s in status] == [1, 2]
+        assert [s["slots"][0]["remainingCapacity"] for s in status] == [1, 0]
+
+        response = await client.get("/canteens/status", headers={"Accept": "application/x-ndjson"}, params={
+            "startDate": "2099-12-15", "endDate": "2099-12-16",
+            "startTime": "12:00", "endTime": "12:30", "duration": 30})
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["canteenId"] for line in lines] == [1, 1, 2, 2]
+        assert [line["slots"][0]["remainingCapacity"] for line in lines] == [1, 1, 0, 1]
+        response = await client.get("/canteens/status", headers={"Accept": "application/x-ndjson"}, params={
+            "startDate": "2099-12-15", "endDate": "2099-12-15",
+            "startTime": "12:00", "endTime": "12:30", "duration": 20})
+        assert response.status_code == 418
+
+        response = await client.get("/availability", params={
+            "from": "2099-12-15T12:00:00", "duration": 30, "limit": 4})
+        # canteen 2 is full until 12:30
+        assert [(s["canteenId"], s["startTime"]) for s in response.json()] == [
+            (1, "12:00"), (1, "12:15"), (1, "12:30"), (2, "12:30")]
+
+    run(test)
@@ -0,0 +1,238 @@
+import datetime as dt
+import json
+import multiprocessing
+import pytest
+from models import database, storage, sqlite_storage, student, canteen, reservation, capacity, cache
+
+
+DAY = dt.date(2099, 12, 15)
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def db(request, tmp_path):
+    if request.param == "memory":
+        store = storage.MemoryStorage()
+    else:
+        store = sqlite_storage.SQLiteStorage(str(tmp_path / "test.db"))
+    db = database.DB(store)
+    db.store_student(student.Student(name="Admin", email="admin@test.com", isAdmin=True))
+    db.store_student(student.Student(name="User", email="user@test.com", isAdmin=False))
+    db.store_canteen(canteen.Canteen(
+        name="Canteen", location="Location", capacity=2,
+        workingHours=[canteen.Meal(meal="lunch", **{"from": "11:00"}, to="15:00")]), 1)
+    yield db
+    store.close()
+
+
+def reserve(db, student_id, t, duration=30):
+    r = reservation.Reservation(
+        canteenId=1, studentId=student_id, date=DAY,
+        time=dt.time.fromisoformat(t), duration=duration)
+    db.store_reservation(r)
+    return r
+
+
+def test_unique_fields(db):
+    """Test that emails and canteen names and locations stay unique"""
+    with pytest.raises(ValueError):
+        db.store_student(student.Student(name="Other", email="user@test.com", isAdmin=False))
+    with pytest.raises(ValueError):
+        db.store_canteen(canteen.Canteen(
+            name="Canteen", location="Elsewhere", capacity=1, workingHours=[]), 1)
+    assert db.retrieve_student(2).name == "User"
+    assert [ct.name for ct in db.retrieve_all_canteens()] == ["Canteen"]
+
+
+def test_reservations_fill_canteen(db):
+    """Test that overlaps and full slots are rejected"""
+    assert reserve(db, 1, "12:00", 60).id == 1
+    with pytest.raises(ValueError):
+        reserve(db, 1, "12:30")
+    reserve(db, 2, "12:30")
+    db.store_student(student.Student(name="Third", email="third@test.com", isAdmin=False))
+    with pytest.raises(ValueError):
+        reserve(db, 3, "12:30")
+    reserve(db, 3, "12:00")
+
+    status = db.get_canteen_cap_status(1, DAY, DAY, dt.time(12), dt.time(13, 30), 30)
+    assert [s["remainingCapacity"] for s in status["slots"]] == [0, 0, 2]
+
+
+def test_long_durations_are_rejected(db):
+    """Test that durations longer than a day are turned down before their slots are gone through"""
+    for duration in (capacity.MINUTES_PER_DAY + capacity.SLOT_MINUTES, 150000000000):
+        with pytest.raises(ValueError):
+            reserve(db, 2, "12:00", duration)
+    assert db.storage.get_next_reservation_id() == 1
+
+
+def test_delete_reservation_frees_slot(db):
+    """Test that cancelled reservations no longer take up a spot"""
+    r = reserve(db, 2, "12:00", 60)
+    db.delete_reservation(r.id, 2)
+    assert db.storage.get_reservation(r.id).status == "Cancelled"
+    with pytest.raises(ValueError):
+        db.retrieve_reservation(r.id)
+    assert db.storage.slot_count(1, DAY.toordinal(), capacity.slot_index(dt.time(12, 30))) == 0
+    reserve(db, 2, "12:30")
+
+
+def test_update_and_delete_canteen(db):
+    """Test that updates are saved and deleting a canteen cancels its reservations"""
+    reserve(db, 2, "12:00")
+    ct = db.retrieve_canteen(1).model_copy(deep=True)
+    ct.capacity = 5
+    db.update_canteen(ct, 1)
+    assert db.retrieve_canteen(1).capacity == 5
+
+    db.delete_canteen(1, 1)
+    with pytest.raises(ValueError):
+        db.retrieve_canteen(1)
+    assert db.storage.get_reservation(1).status == "Cancelled"
+    assert db.storage.get_next_canteen_id() == 2
+
+
+def test_canteen_json_follows_changes(db):
+    """Test that the cached json of the canteens is rebuilt once a canteen changes"""
+    listed = json.loads(db.retrieve_all_canteens_json())
+    assert listed == [json.loads(db.retrieve_canteen_json(1))]
+    assert listed[0]["workingHours"] == [{"meal": "lunch", "from": "11:00", "to": "15:00"}]
+    # reservations don't change the canteens
+    reserve(db, 2, "12:00")
+    assert db.retrieve_all_canteens_json() is db.retrieve_all_canteens_json()
+
+    ct = db.retrieve_canteen(1).model_copy(deep=True)
+    ct.capacity = 5
+    db.update_canteen(ct, 1)
+    assert json.loads(db.retrieve_canteen_json(1))["capacity"] == 5
+    assert json.loads(db.retrieve_all_canteens_json())[0]["capacity"] == 5
+
+    db.delete_canteen(1, 1)
+    assert db.retrieve_all_canteens_json() == b"[]"
+    with pytest.raises(ValueError):
+        db.retrieve_canteen_json(1)
+
+
+def test_status_reads_a_snapshot(db):
+    """Test that a status being streamed doesn't see the writes made meanwhile"""
+    if not isinstance(db.storage, storage.MemoryStorage):
+        pytest.skip("every sqlite read is consistent by itself")
+    reserve(db, 2, "12:00")
+    counts = db.storage.read_snapshot().canteen_day_counts(1, DAY.toordinal(), DAY.toordinal())
+    lines = db.iter_all_canteens_cap_status(DAY, DAY, dt.time(12), dt.time(12, 30), 30)
+
+    reserve(db, 1, "12:00")
+    db.store_canteen(canteen.Canteen(
+        name="Other", location="Elsewhere", capacity=3,
+        workingHours=[canteen.Meal(meal="lunch", **{"from": "11:00"}, to="15:00")]), 1)
+    assert [line["slots"][0]["remainingCapacity"] for line in lines] == [1]
+    # the write went to a copy of the counters the snapshot holds
+    slot = capacity.slot_index(dt.time(12, 0))
+    assert counts.get(DAY.toordinal())[slot] == 1
+    assert db.storage.slot_count(1, DAY.toordinal(), slot) == 2
+
+    status = db.get_all_canteens_cap_status(DAY, DAY, dt.time(12), dt.time(12, 30), 30)
+    assert [s["slots"][0]["remainingCapacity"] for s in status] == [0, 3]
+
+
+def test_writes_copy_only_the_days_they_change():
+    """Test that a write after a freeze copies the day it changes, and frozen counters keep what was replaced"""
+    store = capacity.CapacityStore()
+    store.init_canteen(1)
+    for day in range(100):
+        store.add(1, day, 0)
+    first = store.freeze()
+    days, untouched = store.counters[1], store.day(1, 1)
+    store.add(1, 0, 0)
+    store.add(1, 0, 0)
+    store.add(1, 100, 0)
+    assert store.counters[1] is days and store.day(1, 1) is untouched
+    second = store.freeze()
+    store.init_canteen(1)
+    store.add(1, 0, 0)
+    store.drop_canteen(1)
+
+    assert first.days(1).get(0)[0] == 1 and first.days(1).get(100) is None
+    assert second.days(1).get(0)[0] == 3 and second.days(1).get(100)[0] == 1
+    assert store.freeze().days(1).get(0) is None
+
+
+def reserve_from_worker(args):
+    path, student_ids = args
+    db = database.DB(sqlite_storage.SQLiteStorage(path, timeout=30))
+    accepted = 0
+    for student_id in student_ids:
+        try:
+            reserve(db, student_id, "12:00")
+            accepted += 1
+        except ValueError:
+            pass
+    db.storage.close()
+    return accepted
+
+
+def test_student_reservations_pages(db):
+    """Test paging through a student's reservations, sorted by when they start"""
+    # made out of order, so the ids don't follow the times
+    for t in ("14:00", "11:00", "13:00", "12:00"):
+        reserve(db, 2, t)
+    db.delete_reservation(3, 2)
+
+    seen = []
+    cursor = None
+    while True:
+        rs, cursor = db.retrieve_student_reservations(2, cursor=cursor, limit=3)
+        seen.extend(r.time for r in rs)
+        if cursor is None:
+            break
+    assert seen == [dt.time(h, 0) for h in (11, 12, 13, 14)]
+
+    rs, cursor = db.retrieve_student_reservations(2, status="Active")
+    assert [r.id for r in rs] == [2, 4, 1]
+    assert cursor is None
+    rs, _ = db.retrieve_student_reservations(2, status="Cancelled")
+    assert [(r.id, r.status) for r in rs] == [(3, "Cancelled")]
+    rs, _ = db.retrieve_student_reservations(2, fromDate=DAY + dt.timedelta(days=1))
+    assert rs == []
+    with pytest.raises(ValueError):
+        db.retrieve_student_reservations(2, cursor="nope")
+    if isinstance(db.storage, sqlite_storage.SQLiteStorage):
+        # too big for an sqlite integer
+        with pytest.raises(ValueError):
+            db.retrieve_student_reservations(2, cursor=str(1 << 64))
+
+
+def test_sqlite_sizes_are_cached(tmp_path):
+    """Test that the sqlite sizes are only counted again once they're SIZES_TTL old"""
+    now = [0.0]
+    store = sqlite_storage.SQLiteStorage(str(tmp_path / "test.db"))
+    store.sizes_cache = cache.TTLCache(1, sqlite_storage.SIZES_TTL, clock=lambda: now[0])
+    db = database.DB(store)
+    db.store_student(student.Student(name="Admin", email="admin@test.com", isAdmin=True))
+    assert store.sizes()["students"] == 1
+
+    db.store_student(student.Student(name="User", email="user@test.com", isAdmin=False))
+    assert store.sizes()["students"] == 1
+    now[0] += sqlite_storage.SIZES_TTL
+    assert store.sizes()["students"] == 2
+    store.close()
+
+
+def test_sqlite_shared_between_processes(tmp_path):
+    """Test that several processes sharing an sqlite file can't overbook a slot"""
+    path = str(tmp_path / "shared.db")
+    db = database.DB(sqlite_storage.SQLiteStorage(path))
+    db.store_student(student.Student(name="Admin", email="admin@test.com", isAdmin=True))
+    for i in range(16):
+        db.store_student(student.Student(name="User", email="user{}@test.com".format(i), isAdmin=False))
+    db.store_canteen(canteen.Canteen(
+        name="Canteen", location="Location", capacity=5,
+        workingHours=[canteen.Meal(meal="lunch", **{"from": "11:00"}, to="15:00")]), 1)
+
+    work = [(path, list(range(first, 18, 4))) for first in range(2, 6)]
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        accepted = sum(pool.map(reserve_from_worker, work))
+
+    assert accepted == 5
+    assert db.storage.slot_count(1, DAY.toordinal(), capacity.slot_index(dt.time(12, 0))) == 5
+    db.storage.close()
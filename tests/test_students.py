@@ -67,3 +67,58 @@ def test_retrieve_nonexistent_student(client):
     response = client.get("/students/999")
     
     assert response.status_code == 404
+
+
+def test_list_student_reservations(client, regular_student, sample_canteen):
+    """Test listing a student's reservations a page at a time"""
+    for time in ("13:00", "12:00", "14:00"):
+        response = client.post(
+            "/reservations",
+            json={
+                "studentId": regular_student["id"],
+                "canteenId": sample_canteen["id"],
+                "date": "2099-12-15",
+                "time": time,
+                "duration": 30
+            }
+        )
+        assert response.status_code == 201
+
+    url = f"/students/{regular_student['id']}/reservations"
+    response = client.get(url, params={"limit": 2, "status": "Active"})
+    assert response.status_code == 200
+    page = response.json()
+    assert [r["time"] for r in page["reservations"]] == ["12:00", "13:00"]
+    assert page["nextCursor"] is not None
+
+    response = client.get(url, params={"limit": 2, "cursor": page["nextCursor"]})
+    page = response.json()
+    assert [r["time"] for r in page["reservations"]] == ["14:00"]
+    assert page["nextCursor"] is None
+
+    response = client.get(url, params={"fromDate": "2099-12-16"})
+    assert response.json() == {"reservations": [], "nextCursor": None}
+
+
+def test_list_student_reservations_invalid(client, regular_student):
+    """Test that unknown students and invalid filters are rejected"""
+    assert client.get("/students/999/reservations").status_code == 404
+
+    url = f"/students/{regular_student['id']}/reservations"
+    assert client.get(url, params={"status": "Pending"}).status_code == 418
+    assert client.get(url, params={"limit": 0}).status_code == 418
+    assert client.get(url, params={"cursor": "abc"}).status_code == 418
+
+
+def test_create_student_idempotency_key(client):
+    """Test that a retried request with the same Idempotency-Key gets the first response"""
+    body = {"name": "Retry", "email": "retry@example.com", "isAdmin": False}
+    headers = {"Idempotency-Key": "create-retry"}
+
+    first = client.post("/students", json=body, headers=headers)
+    retry = client.post("/students", json=body, headers=headers)
+    assert first.status_code == retry.status_code == 201
+    assert retry.json() == first.json()
+
+    # without the key it's a new student with a duplicate email
+    assert client.post("/students", json=body).status_code == 418